@@ -1,19 +1,47 @@
 import cv2
+import glob
+import hashlib
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
 import numpy as np
-from argparse import Namespace
+from argparse import ArgumentParser, Namespace
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor, as_completed
+from contextlib import nullcontext
+from cache import AnalysisCache, get_file_hash
+from report import AnalysisReport
+from templates import TemplateLibrary, get_camera
 
 
 # Global parameters
 jpeg_extensions = ['jpeg', 'jpg', 'jpe', 'jfif', 'jif', '.jpeg', '.jpg', '.jpe', '.jfif', '.jif', 'JPEG', 'JPG', 'JPE', 'JFIF', 'JIF', '.JPEG', '.JPG', '.JPE', '.JFIF', '.JIF']
 png_extensions = ['png', '.png', 'PNG', '.PNG']
 
+# Default analysis parameters (also identify cached manipulation maps, see cache.py, along with the version of the algorithm)
+analysis_parameters = {'win_size': 64, 'stop_threshold': 1e-3, 'prob_r_b_in_c1': 0.5, 'stride': 8, 'block_size': 8, 'version': 2}
+
+# Supported analysis precisions: blocks (the bulk of the analysis working set) and window probabilities are stored with the selected dtype,
+# while the 8x8 template c and all sums over blocks are always computed in double precision.
+# Single precision halves the working set; its results are checked against double precision with 'python -m analyze check-precision' (see README.md)
+analysis_dtypes = {'double': np.float64, 'single': np.float32}
+
+# Number of blocks summed at once in reduced precision (see weighted_block_sum)
+reduced_precision_chunk_size = 2 ** 14
+
 
 # PREPROCESSING
 
 # RGB to YCbCr conversion & luminance channel extraction
-def luminance(img):
+# Images are BGR (as loaded by OpenCV) unless rgb is set; any alpha channel is ignored, and grayscale images are their own luminance
+def luminance(img, rgb=False):
+    if len(img.shape) == 2:
+        return img
+
     # Convert image
-    img_y = cv2.cvtColor(img, cv2.COLOR_BGR2YCR_CB)
+    img_y = cv2.cvtColor(img, cv2.COLOR_RGB2YCR_CB if rgb else cv2.COLOR_BGR2YCR_CB)
     y, _, _ = cv2.split(img_y)
 
     return y
@@ -33,20 +61,90 @@ def mfr(img, size):
 def adjust_size(img, win_size, stride):
     # Check image size and add padding if needed
     img_h, img_w = get_image_size(img)
+    pad_bottom, pad_right = get_padding(img_h, img_w, win_size, stride)
 
-    if img_h % stride != 0 or img_h % win_size != 0:
-        img = cv2.copyMakeBorder(img, 0, stride - img_h % stride, 0, 0, cv2.BORDER_REPLICATE)
-
-    if img_w % stride != 0 or img_w % win_size != 0:
-        img = cv2.copyMakeBorder(img, 0, 0, 0, stride - img_w % stride, cv2.BORDER_REPLICATE)
+    if pad_bottom > 0 or pad_right > 0:
+        img = cv2.copyMakeBorder(img, 0, pad_bottom, 0, pad_right, cv2.BORDER_REPLICATE)
 
     return img
 
 
+# Padding added to the bottom and to the right of an image of the given size by adjust_size
+def get_padding(img_h, img_w, win_size, stride):
+    pad_bottom = stride - img_h % stride if img_h % stride != 0 or img_h % win_size != 0 else 0
+    pad_right = stride - img_w % stride if img_w % stride != 0 or img_w % win_size != 0 else 0
+
+    return pad_bottom, pad_right
+
+
 # Calculate overlapping windows of given size (extracted with given stride; non-overlapping if stride is zero)
 # and return their average block
 # along with their starting coordinates and ID in order to map them to each pixel (for postprocessing)
-def get_average_window_blocks(img, win_size, stride, block_size):
+#
+# Whenever the stride is a multiple of the block size, every window is aligned to the same grid of blocks,
+# so its average block is simply a box sum over that grid: the image is reshaped into a (H/8, W/8, 8, 8) block grid
+# and all windows are computed at once from its summed-area table.
+# The original (per-window loop) implementation is still available by setting legacy=True, so that results can be compared.
+# Blocks are returned as floating point numbers of the given dtype (see analysis_dtypes)
+def get_average_window_blocks(img, win_size, stride, block_size, legacy=False, dtype=np.float64):
+    if legacy or stride % block_size != 0:
+        blocks, blocks_map = get_average_window_blocks_legacy(img, win_size, stride, block_size)
+        return blocks.astype(dtype, copy=False), blocks_map
+
+    # Adjust image size
+    img = adjust_size(img, win_size, stride)
+
+    return get_window_grid_blocks(img, win_size, stride, block_size, dtype)
+
+
+# Average block of every window of an image whose size has already been adjusted (see get_average_window_blocks)
+def get_window_grid_blocks(img, win_size, stride, block_size, dtype=np.float64):
+    img_h, img_w = get_image_size(img)
+
+    # Number of windows along each dimension
+    n_y = (img_h - win_size) // stride + 1
+    n_x = (img_w - win_size) // stride + 1
+
+    # Number of blocks per window side
+    # (same as get_non_overlapping_blocks, which does not include the last row and column of blocks of each window)
+    k = len(range(0, win_size - block_size, block_size))
+
+    # Block grid: the image is seen as grid_h x grid_w blocks, block (i, j) having its top left pixel at (i * block_size, j * block_size)
+    grid_h = img_h // block_size
+    grid_w = img_w // block_size
+    grid = img[:grid_h * block_size, :grid_w * block_size].reshape(grid_h, block_size, grid_w * block_size)
+
+    # Top left block of each window
+    step = stride // block_size
+    i = np.arange(n_y) * step
+    j = np.arange(n_x) * step
+
+    # Box sum over the k x k blocks of each window, computed separably from cumulative sums over the block grid:
+    # first over the rows of blocks of each window row, then over the columns of blocks of each window.
+    # Sums are exact integers; int32 cannot overflow, as they are at most 255 * max(grid_h, k * grid_w)
+    sum_rows = np.zeros((grid_h + 1, block_size, grid_w * block_size), dtype=np.int32)
+    sum_rows[1:] = grid
+    for row in range(2, grid_h + 1):  # Row by row (each row being vectorized), which is much faster than np.cumsum along the first axis
+        sum_rows[row] += sum_rows[row - 1]
+    sum_rows = (sum_rows[i + k] - sum_rows[i]).reshape(n_y, block_size, grid_w, block_size)
+
+    sum_blocks = np.zeros((n_y, block_size, grid_w + 1, block_size), dtype=np.int32)
+    np.cumsum(sum_rows, axis=2, out=sum_blocks[:, :, 1:])
+    sum_blocks = (sum_blocks[:, :, j + k] - sum_blocks[:, :, j]).transpose(0, 2, 1, 3)
+
+    blocks = np.divide(sum_blocks.reshape(n_y * n_x, block_size, block_size), k * k, dtype=dtype)
+
+    # Each row of blocks_map contains the coordinates of the top left pixel of the window (columns 0 and 1) and its ID (column 2)
+    blocks_map = np.zeros((n_y * n_x, 3), dtype=np.int32)
+    blocks_map[:, 0] = np.tile(j * block_size, n_y)
+    blocks_map[:, 1] = np.repeat(i * block_size, n_x)
+    blocks_map[:, 2] = np.arange(n_y * n_x)
+
+    return blocks, blocks_map
+
+
+# Original implementation of get_average_window_blocks (one window at a time)
+def get_average_window_blocks_legacy(img, win_size, stride, block_size):
     # Adjust image size
     img = adjust_size(img, win_size, stride)
     img_h, img_w = get_image_size(img)
@@ -64,7 +162,7 @@ def get_average_window_blocks(img, win_size, stride, block_size):
     # Variable initialization
     window_id = 0  # Simple index to keep track of the current window
     blocks = np.zeros((len(x)*len(y), block_size, block_size))  # Final array of blocks (there is one block per window)
-    blocks_map = np.zeros((len(x)*len(y), 3), dtype=np.int)  # Each row of blocks_map contains the coordinates of the top left pixel of the window (columns 0 and 1) and its ID (column 2)
+    blocks_map = np.zeros((len(x)*len(y), 3), dtype=np.int32)  # Each row of blocks_map contains the coordinates of the top left pixel of the window (columns 0 and 1) and its ID (column 2)
 
     # Window average and mapping
     for i in y:
@@ -113,20 +211,45 @@ def get_non_overlapping_blocks(window, block_size):
 # EM ALGORITHM
 
 
+# Normalize blocks for correlation: each block is flattened, made zero-mean and scaled to unit norm,
+# so that the correlation of all blocks with a (normalized) template is a single matrix-vector product
+# Constant blocks have no defined correlation (np.corrcoef returns NaN for them): their rows are set to zero and they are flagged in the returned mask
+# Single precision blocks are normalized in single precision, any other blocks in double precision
+def normalize_blocks(blocks):
+    dtype = np.float32 if blocks.dtype == np.float32 else np.float64
+    blocks_norm = blocks.reshape(blocks.shape[0], -1).astype(dtype)
+    blocks_norm -= np.mean(blocks_norm, axis=1, keepdims=True)
+
+    norm = np.linalg.norm(blocks_norm, axis=1)
+    constant = np.ptp(blocks.reshape(blocks.shape[0], -1), axis=1) == 0
+
+    blocks_norm[constant] = 0
+    blocks_norm[~constant] /= norm[~constant, np.newaxis]
+
+    return blocks_norm, constant
+
+
 # Expectation step
-def expectation(blocks, c, prob_r_b_in_c1, first_iteration=False):
+# Blocks must have been normalized beforehand (see normalize_blocks); probabilities are computed with the same precision
+def expectation(blocks_norm, constant, c, prob_r_b_in_c1, first_iteration=False):
 
     # Compute correlation r
-    r = np.zeros(blocks.shape[0])
-    for i in range(blocks.shape[0]):
-        r[i] = np.corrcoef(blocks[i].flatten(), c.flatten())[0, 1]
+    c_norm = c.flatten() - np.mean(c)
+    c_norm_len = np.linalg.norm(c_norm)
+
+    if c_norm_len > 0:
+        r = blocks_norm @ (c_norm / c_norm_len).astype(blocks_norm.dtype)  # A template of higher precision would upcast (i.e. copy) all blocks
+        undefined = constant
+    else:  # Constant template: the correlation is undefined for every block
+        r = np.zeros(blocks_norm.shape[0], dtype=blocks_norm.dtype)
+        undefined = np.ones(blocks_norm.shape[0], dtype=bool)
 
     # Initialize probabilities
-    prob_b_in_c1 = np.ones(blocks.shape[0]) * 0.5
-    prob_b_in_c2 = np.ones(blocks.shape[0]) * 0.5
+    prob_b_in_c1 = np.full(blocks_norm.shape[0], 0.5, dtype=r.dtype)
+    prob_b_in_c2 = np.full(blocks_norm.shape[0], 0.5, dtype=r.dtype)
 
     if first_iteration:  # The first iteration uses arbitrary probabilities
-        prob_r_b_in_c1 = np.ones(blocks.shape[0]) * prob_r_b_in_c1
+        prob_r_b_in_c1 = np.full(blocks_norm.shape[0], prob_r_b_in_c1, dtype=r.dtype)
         prob_r_b_in_c2 = 1 - prob_r_b_in_c1
     else:  # Successive iterations are estimated by the correlation r
         prob_r_b_in_c1 = abs(r)
@@ -138,87 +261,620 @@ def expectation(blocks, c, prob_r_b_in_c1, first_iteration=False):
 
     prob_b_in_c1_r = num / den
 
+    # Blocks without a defined correlation carry no information: they keep their prior probability
+    prob_b_in_c1_r[undefined] = prob_b_in_c1[undefined]
+
     return prob_b_in_c1_r
 
 
 # Maximization step
-def maximization(blocks, prob_b_in_c1_r):
+# The weighted sum of all blocks is computed as a single contraction; if given, the result is written into out (a preallocated block-sized buffer)
+def maximization(blocks, prob_b_in_c1_r, out=None):
     # Calculate template c
-    num = np.sum(np.array([prob_b_in_c1_r * blocks for (prob_b_in_c1_r, blocks) in zip(prob_b_in_c1_r, blocks)]), axis=0)
-    den = np.sum(prob_b_in_c1_r, axis=0)
+    num = weighted_block_sum(blocks.reshape(blocks.shape[0], -1), prob_b_in_c1_r, out=None if out is None else out.reshape(-1))
+    den = np.sum(prob_b_in_c1_r, axis=0, dtype=np.float64)
 
-    c = num / den
+    num /= den
+    c = num.reshape(blocks.shape[1:])
 
     return c
 
 
+# Weighted sum of (flattened) blocks, in double precision
+# Reduced precision blocks are summed in chunks (in their own precision, without copying them) and the partial sums are accumulated in double precision,
+# so that rounding errors do not grow with the number of blocks
+def weighted_block_sum(blocks, prob_b_in_c1_r, out=None):
+    if blocks.dtype == np.float64:
+        return np.dot(prob_b_in_c1_r.astype(np.float64, copy=False), blocks, out=out)
+
+    if out is None:
+        out = np.zeros(blocks.shape[1])
+    else:
+        out[:] = 0
+
+    for start in range(0, blocks.shape[0], reduced_precision_chunk_size):
+        end = start + reduced_precision_chunk_size
+        out += np.dot(prob_b_in_c1_r[start:end].astype(blocks.dtype, copy=False), blocks[start:end])
+
+    return out
+
+
 # Expectation-maximization algorithm
-def expectation_maximization(blocks, threshold, prob_r_b_in_c1):
+# The template c is randomly initialized with a generator seeded by seed; note that this initialization does not affect the result,
+# since the first iteration uses arbitrary probabilities. A starting template c_init can be given instead, in which case the first iteration is a regular one.
+def expectation_maximization(blocks, threshold, prob_r_b_in_c1, seed=None, c_init=None, report=None):
+    # Normalize blocks once for all E steps
+    blocks_norm, constant = normalize_blocks(blocks)
+
+    return run_expectation_maximization(blocks, blocks_norm, constant, threshold, prob_r_b_in_c1, np.random.default_rng(seed), c_init, report=report)
+
+
+# EM iterations over already normalized blocks (see expectation_maximization)
+# If given, should_stop(prob_b_in_c1_r, c, diff_history) is called at each iteration boundary and stops the algorithm early if it returns True
+# If given, the time of each iteration and the result are recorded in report (see report.py)
+def run_expectation_maximization(blocks, blocks_norm, constant, threshold, prob_r_b_in_c1, rng, c_init=None, should_stop=None, report=None):
     # Initialize logging array for the differences plot
     diff_history = []
 
-    # Random initialize template c
-    c = np.random.uniform(0, 1, (8, 8))
+    if report is not None:
+        report.start_iterations()
 
-    # Initialize difference matrix
+    if c_init is None:
+        # Random initialize template c
+        c = rng.uniform(0, 1, (8, 8))
+    else:
+        c = np.array(c_init, dtype=np.float64).reshape(8, 8)
+
+    # Preallocate buffers for the previous estimate of c and the difference matrix, which are reused by all iterations
+    c_prev = np.empty((8, 8))
     diff = np.ones((8, 8))  # Difference between successive estimates of c is an 8x8 matrix
 
     # First iteration
-    prob_b_in_c1_r = expectation(blocks, c, prob_r_b_in_c1, first_iteration=True)
-    c = maximization(blocks, prob_b_in_c1_r)
+    prob_b_in_c1_r = expectation(blocks_norm, constant, c, prob_r_b_in_c1, first_iteration=c_init is None)
+    c = maximization(blocks, prob_b_in_c1_r, out=c)
+
+    if report is not None:
+        report.end_iteration()
 
     # Main EM loop
     while np.all(diff > threshold):  # Iterate E-M steps until difference is lower than threshold
-        # Store last iteration's template
-        c_prev = np.copy(c)
+        if should_stop is not None and should_stop(prob_b_in_c1_r, c, diff_history):
+            break
+
+        # Store last iteration's template (swapping buffers instead of copying)
+        c, c_prev = c_prev, c
 
         # E step
-        prob_b_in_c1_r = expectation(blocks, c, prob_r_b_in_c1)
+        prob_b_in_c1_r = expectation(blocks_norm, constant, c_prev, prob_r_b_in_c1)
 
         # M step
-        c = maximization(blocks, prob_b_in_c1_r)
+        c = maximization(blocks, prob_b_in_c1_r, out=c)
 
         # Calculate difference between successive estimates of c
-        diff = abs(c - c_prev)
+        np.subtract(c, c_prev, out=diff)
+        np.abs(diff, out=diff)
         diff_history.append(np.average(diff))  # Add the difference matrix' average to the difference log
 
+        if report is not None:
+            report.end_iteration(diff_history[-1])
+
+    if report is not None:
+        report.set_em_result(c, diff_history)
+
     return prob_b_in_c1_r, c, diff_history
 
 
+# Fit of an EM result: the average probability of (non-constant) blocks of belonging to the template c
+def get_fit(prob_b_in_c1_r, constant):
+    if np.all(constant):
+        return 0.0
+
+    return float(np.mean(prob_b_in_c1_r[~constant]))
+
+
+# Multi-start expectation-maximization algorithm
+# Runs n_starts independent EM starts concurrently, in threads (the vectorized NumPy steps release the GIL), and returns the result with the best fit
+# (the one which converged first in case of ties, then the first start). The first start uses the default initialization (or c_init, if given), the others start from random templates
+# drawn from independent generators derived from seed, so results are reproducible.
+# Starts run in lock step: at each iteration boundary, a start waits until all other starts have reached the same boundary (or ended), and is then cancelled
+# if its current fit is worse by more than margin than the final fit of a start which converged within the same number of iterations. Cancellations thus only depend
+# on the iteration index, and never on thread timing. Starts are also stopped after max_iterations iterations. If given, the result and iteration times of the chosen start are recorded in report.
+def expectation_maximization_multistart(blocks, threshold, prob_r_b_in_c1, n_starts=4, seed=0, margin=0.01, max_iterations=100, c_init=None, report=None):
+    # Normalize blocks once for all starts and E steps
+    blocks_norm, constant = normalize_blocks(blocks)
+
+    rngs = [np.random.default_rng(s) for s in np.random.SeedSequence(seed).spawn(n_starts)]
+
+    condition = threading.Condition()
+    positions = [-1] * n_starts  # Last iteration boundary reached by each start
+    ended = [False] * n_starts
+    converged = {}  # Final fit and number of iterations of converged starts, indexed by start
+
+    def run_start(i):
+        cancelled = [False]
+
+        def should_stop(prob_b_in_c1_r, c, diff_history):
+            k = len(diff_history)
+            fit = get_fit(prob_b_in_c1_r, constant)
+
+            with condition:
+                positions[i] = k
+                condition.notify_all()
+                condition.wait_for(lambda: all(ended[j] or positions[j] >= k for j in range(n_starts)))
+                best_fit = max([f for f, iterations in converged.values() if iterations <= k], default=-np.inf)
+
+            cancelled[0] = fit < best_fit - margin or k >= max_iterations
+            return cancelled[0]
+
+        try:
+            start_c = c_init if i == 0 else rngs[i].uniform(0, 1, (8, 8))
+            start_report = AnalysisReport() if report is not None else None  # Each start records its own iterations
+            prob_b_in_c1_r, c, diff_history = run_expectation_maximization(blocks, blocks_norm, constant, threshold, prob_r_b_in_c1, rngs[i], start_c, should_stop, start_report)
+            fit = get_fit(prob_b_in_c1_r, constant)
+
+            if not cancelled[0]:
+                with condition:
+                    converged[i] = (fit, len(diff_history))
+        finally:
+            with condition:  # Other starts stop waiting for this one (even if it failed)
+                ended[i] = True
+                condition.notify_all()
+
+        return not cancelled[0], fit, len(diff_history), (prob_b_in_c1_r, c, diff_history), start_report
+
+    with ThreadPoolExecutor(max_workers=n_starts) as executor:  # All starts must run at once, as they wait for each other
+        results = list(executor.map(run_start, range(n_starts)))
+
+    # Prefer converged starts, then the best fit, then the fastest convergence, then the first start
+    _, _, _, best, best_report = max(results, key=lambda r: (r[0], r[1], -r[2]))
+
+    if report is not None:
+        report.set_em_result(best[1], best[2], best_report.iteration_times)
+
+    return best
+
+
 # POSTPROCESSING
 
 # Get output map
+# Each pixel gets the average probability of all the windows containing it.
+# Whenever the window size is a multiple of the stride, the image is partitioned into stride x stride cells which are all covered by the same windows:
+# window probabilities are then accumulated on the (much smaller) cell grid with a box filter, averaged and upsampled to the image size.
 def get_output_map(prob_b_in_c1_r, blocks_map, img_w, img_h, show=False, save=False, img_path=None, win_size=None, stop_threshold=None):
 
-    # Initialize empty map
-    output_map = np.empty((img_h, img_w, 2))
+    stride = get_window_stride(blocks_map, win_size)
 
-    for w in blocks_map:  # For each element in the window list...
-        output_map[w[1]:w[1] + win_size, w[0]:w[0] + win_size, 0] += prob_b_in_c1_r[w[2]]
-        output_map[w[1]:w[1] + win_size, w[0]:w[0] + win_size, 1] += 1
+    if win_size % stride == 0:  # Thresholding is done on the cell grid, before upsampling
+        cell_map = get_cell_average_grid(prob_b_in_c1_r, blocks_map, img_w, img_h, win_size, stride)
+        output_map_thr = upsample_cell_grid(threshold_output_map(cell_map), stride, img_w, img_h)
+    else:
+        output_map = get_window_average_map(prob_b_in_c1_r, blocks_map, img_w, img_h, win_size)
+        output_map_thr = threshold_output_map(output_map)
 
-    for i in range(0, output_map.shape[0]):  # Average
-        for j in range(0, output_map.shape[1]):
-            output_map[i, j, 0] = output_map[i, j, 0] / output_map[i, j, 1]
+    return output_map_thr
 
-    output_map = 1 - output_map[:, :, 0]  # Because the map computed so far actually shows the probability that a pixel has not been modified
+
+# Threshold a map of the probability that each pixel has not been modified
+def threshold_output_map(output_map):
+    output_map = 1 - output_map  # Because the map computed so far actually shows the probability that a pixel has not been modified
 
     # Replace NaNs with a neutral probability (0.5)
     output_map = np.nan_to_num(output_map, nan=0.5)
 
-    # Normalization/thresholding
+    # Thresholding
     output_map_thr = np.where(output_map > 0.8, 255, 0).astype(np.uint8)  # Pixels with probability of being manipulated lower than 80% are masked
-    output_map_norm = cv2.normalize(output_map, None, alpha=0, beta=255, norm_type=cv2.NORM_MINMAX, dtype=cv2.CV_32F)
 
     return output_map_thr
 
 
+# Get the stride between windows from their starting coordinates (defaults to the window size if there is a single window)
+def get_window_stride(blocks_map, win_size):
+    stride = int(np.gcd.reduce(np.unique(blocks_map[:, :2])))
+
+    if stride > 0:
+        return stride
+    else:
+        return win_size
+
+
+# Sum of each k x k box of a 2D array, anchored at its bottom right element (elements outside the array count as zero)
+def box_sum(a, k):
+    box = np.cumsum(np.cumsum(a, axis=0), axis=1)
+    box[k:] -= box[:-k].copy()
+    box[:, k:] -= box[:, :-k].copy()
+
+    return box
+
+
+# Average window probability for each cell of a grid of stride x stride cells covering the image (see upsample_cell_grid)
+def get_cell_average_grid(prob_b_in_c1_r, blocks_map, img_w, img_h, win_size, stride):
+    k = win_size // stride  # Number of cells per window side
+
+    # Window probabilities on the window grid (which is the cell grid of their top left pixel)
+    cell_y = blocks_map[:, 1] // stride
+    cell_x = blocks_map[:, 0] // stride
+
+    # Cell grid (covering at least the whole image, so that pixels which are not covered by any window are NaN)
+    grid_h = max(cell_y.max() + k, -(-img_h // stride))
+    grid_w = max(cell_x.max() + k, -(-img_w // stride))
+
+    prob_grid = np.zeros((grid_h, grid_w))
+    count_grid = np.zeros((grid_h, grid_w), dtype=np.int64)
+
+    prob_grid[cell_y, cell_x] = prob_b_in_c1_r[blocks_map[:, 2]]
+    count_grid[cell_y, cell_x] = 1
+
+    # NaN probabilities would spread to every following cell through the cumulative sums,
+    # so they are zeroed here and only their own cells are set back to NaN (as if they had been summed)
+    nan_grid = np.isnan(prob_grid)
+    has_nan = np.any(nan_grid)
+    if has_nan:
+        prob_grid[nan_grid] = 0
+
+    # Accumulate and average the probabilities of all windows covering each cell
+    with np.errstate(invalid='ignore', divide='ignore'):  # Cells not covered by any window are NaN
+        cell_map = box_sum(prob_grid, k) / box_sum(count_grid, k)
+
+    if has_nan:
+        cell_map[box_sum(nan_grid.astype(np.int64), k) > 0] = np.nan
+
+    return cell_map[:-(-img_h // stride), :-(-img_w // stride)]
+
+
+# Upsample a grid of stride x stride cells to the image size
+def upsample_cell_grid(cell_map, stride, img_w, img_h):
+    return np.repeat(np.repeat(cell_map, stride, axis=0), stride, axis=1)[:img_h, :img_w]
+
+
+# Average window probability for each pixel, computed one window at a time (for window sizes which are not a multiple of the stride)
+def get_window_average_map(prob_b_in_c1_r, blocks_map, img_w, img_h, win_size):
+    # Initialize empty map (with the precision of the probabilities)
+    output_map = np.zeros((img_h, img_w, 2), dtype=np.result_type(prob_b_in_c1_r.dtype, np.float32))
+
+    for w in blocks_map:  # For each element in the window list...
+        output_map[w[1]:w[1] + win_size, w[0]:w[0] + win_size, 0] += prob_b_in_c1_r[w[2]]
+        output_map[w[1]:w[1] + win_size, w[0]:w[0] + win_size, 1] += 1
+
+    with np.errstate(invalid='ignore', divide='ignore'):  # Average
+        output_map = output_map[:, :, 0] / output_map[:, :, 1]
+
+    return output_map
+
+
+# TILED ANALYSIS
+# For images too large to be analyzed at once, the residual is processed in horizontal tiles of window rows.
+# Each tile also includes the pixels of its last row of windows (a halo of win_size pixels), so windows on tile borders are exactly the same as in the whole image.
+# Blocks are stored in memory-mapped files, EM statistics are accumulated across tiles and the output map is written one band at a time,
+# so that the analysis working set is bounded by the given memory budget regardless of the image size.
+
+# Split a grid of n_rows x n_cols windows into tiles of consecutive rows, each fitting into the memory budget (at least one row per tile)
+def get_tiles(n_rows, n_cols, memory_budget, bytes_per_window):
+    tile_rows = max(1, memory_budget // (n_cols * bytes_per_window))
+
+    return [(i, min(i + tile_rows, n_rows)) for i in range(0, n_rows, tile_rows)]
+
+
+# Single EM iteration over all tiles (given as ranges of block indices): the posterior probabilities of each tile are written into prob_b_in_c1_r,
+# while the weighted sum of blocks needed by the M step is accumulated across tiles
+def tiled_em_step(blocks, blocks_norm, constant, tiles, c, prob_r_b_in_c1, prob_b_in_c1_r, first_iteration=False):
+    num = np.zeros(blocks.shape[1])
+    den = 0
+
+    for start, end in tiles:
+        # E step
+        tile_prob = expectation(blocks_norm[start:end], constant[start:end], c, prob_r_b_in_c1, first_iteration)
+        prob_b_in_c1_r[start:end] = tile_prob
+
+        # M step statistics
+        num += weighted_block_sum(blocks[start:end], tile_prob)
+        den += np.sum(tile_prob, dtype=np.float64)
+
+    c = (num / den).reshape(c.shape)
+
+    return c
+
+
+# Expectation-maximization algorithm over tiles (same as expectation_maximization)
+# Blocks are given as flattened (N x 64) arrays, along with their normalized version and constant blocks mask (see normalize_blocks)
+def expectation_maximization_tiled(blocks, blocks_norm, constant, tiles, threshold, prob_r_b_in_c1, prob_b_in_c1_r, seed=None, c_init=None, report=None):
+    # Initialize logging array for the differences plot
+    diff_history = []
+
+    if report is not None:
+        report.start_iterations()
+
+    if c_init is None:
+        # Random initialize template c
+        c = np.random.default_rng(seed).uniform(0, 1, (8, 8))
+    else:
+        c = np.array(c_init, dtype=np.float64).reshape(8, 8)
+
+    # Initialize difference matrix
+    diff = np.ones((8, 8))  # Difference between successive estimates of c is an 8x8 matrix
+
+    # First iteration
+    c = tiled_em_step(blocks, blocks_norm, constant, tiles, c, prob_r_b_in_c1, prob_b_in_c1_r, first_iteration=c_init is None)
+
+    if report is not None:
+        report.end_iteration()
+
+    # Main EM loop
+    while np.all(diff > threshold):  # Iterate E-M steps until difference is lower than threshold
+        c_prev = c
+
+        # E and M steps
+        c = tiled_em_step(blocks, blocks_norm, constant, tiles, c_prev, prob_r_b_in_c1, prob_b_in_c1_r)
+
+        # Calculate difference between successive estimates of c
+        diff = abs(c - c_prev)
+        diff_history.append(np.average(diff))  # Add the difference matrix' average to the difference log
+
+        if report is not None:
+            report.end_iteration(diff_history[-1])
+
+    if report is not None:
+        report.set_em_result(c, diff_history)
+
+    return prob_b_in_c1_r, c, diff_history
+
+
+# Write the thresholded output map one band of stride x stride cells at a time (see get_cell_average_grid)
+# Each band is computed from the windows covering it, i.e. its own window rows plus the win_size / stride - 1 rows above it
+def get_output_map_tiled(prob_b_in_c1_r, n_y, n_x, img_w, img_h, win_size, stride, memory_budget, output_map):
+    k = win_size // stride  # Number of cells per window side
+    bytes_per_cell = 4 * 8 + stride * stride  # Cell grids and upsampled thresholded map
+
+    for start, end in get_tiles(n_y + k - 1, n_x, memory_budget, bytes_per_cell):
+        if start * stride >= img_h:  # Cells in the padding only
+            break
+
+        # Windows covering the band
+        win_start = max(start - k + 1, 0)
+        win_end = min(end, n_y)
+
+        band_map = np.zeros(((win_end - win_start) * n_x, 3), dtype=np.int32)
+        band_map[:, 0] = np.tile(np.arange(n_x) * stride, win_end - win_start)
+        band_map[:, 1] = np.repeat(np.arange(win_end - win_start) * stride, n_x)
+        band_map[:, 2] = np.arange((win_end - win_start) * n_x)
+
+        band_prob = np.asarray(prob_b_in_c1_r[win_start * n_x:win_end * n_x])
+
+        # Average map of the band (which starts from the top of the first covering window), cropped to the band's own cells
+        band_h = min(end * stride, img_h) - win_start * stride
+        band = get_cell_average_grid(band_prob, band_map, img_w, band_h, win_size, stride)[start - win_start:]
+        band = upsample_cell_grid(threshold_output_map(band), stride, img_w, min(end * stride, img_h) - start * stride)
+
+        output_map[start * stride:start * stride + band.shape[0]] = band
+
+    return output_map
+
+
+# Analyze an image in tiles (see above), returning its output map and the final template c (None if the image is smaller than the analysis window)
+# The decoded image is the only full size array held in memory: luminance and median filter residual are computed band by band, along with the average blocks
+# of each tile (see get_residual_band); blocks, normalized blocks and probabilities are stored in temporary memory-mapped files.
+# The output map is written to a memory-mapped .npy file if output_path is given, otherwise it is kept in memory (1 byte per pixel)
+# Temporary memory-mapped files are created in work_dir (defaults to the system temporary directory); blocks and probabilities are stored with the given dtype
+# If given, stage times are recorded in report (blocks are normalized in the get_average_window_blocks stage)
+def analyze_tiled(img, win_size, stop_threshold, prob_r_b_in_c1, memory_budget, output_path=None, work_dir=None, stride=8, block_size=8, seed=None, c_init=None, dtype=np.float64, report=None, rgb=False):
+    if stride % block_size != 0 or win_size % stride != 0:
+        raise ValueError('Tiled analysis requires the stride to be a multiple of the block size, and the window size to be a multiple of the stride.')
+
+    img_h, img_w = get_image_size(img)
+
+    if output_path is not None:
+        output_map = np.lib.format.open_memmap(output_path, mode='w+', dtype=np.uint8, shape=(img_h, img_w))
+    else:
+        output_map = np.zeros((img_h, img_w), dtype=np.uint8)
+
+    if not has_windows(img, win_size, stride):  # Empty output map
+        if output_path is not None:
+            output_map.flush()
+        return output_map, None
+
+    # Size of the residual once padded (see adjust_size)
+    pad_bottom, pad_right = get_padding(img_h, img_w, win_size, stride)
+    pad_h, pad_w = img_h + pad_bottom, img_w + pad_right
+
+    # Window grid
+    n_y = (pad_h - win_size) // stride + 1
+    n_x = (pad_w - win_size) // stride + 1
+
+    bytes_per_window = 4 * block_size * block_size * np.dtype(dtype).itemsize  # Block, normalized block and their temporaries
+    bytes_per_window += 8 * stride * stride  # Pixels of the band of the tile (color conversion, luminance, median and residual)
+    tiles = get_tiles(n_y, n_x, memory_budget, bytes_per_window)
+    block_tiles = [(start * n_x, end * n_x) for start, end in tiles]
+
+    with tempfile.TemporaryDirectory(dir=work_dir) as tmp_dir:
+        blocks = np.memmap(os.path.join(tmp_dir, 'blocks.dat'), dtype=dtype, mode='w+', shape=(n_y * n_x, block_size * block_size))
+        blocks_norm = np.memmap(os.path.join(tmp_dir, 'blocks_norm.dat'), dtype=dtype, mode='w+', shape=(n_y * n_x, block_size * block_size))
+        constant = np.memmap(os.path.join(tmp_dir, 'constant.dat'), dtype=bool, mode='w+', shape=(n_y * n_x,))
+        prob_b_in_c1_r = np.memmap(os.path.join(tmp_dir, 'prob.dat'), dtype=dtype, mode='w+', shape=(n_y * n_x,))
+
+        # Luminance, median filter residual and average blocks from overlapping windows generation, tile by tile (each tile includes its halo)
+        for (start, end), (block_start, block_end) in zip(tiles, block_tiles):
+            band = get_residual_band(img, start * stride, (end - 1) * stride + win_size, pad_w, rgb, report)
+
+            with measure(report, 'get_average_window_blocks'):
+                tile_blocks, _ = get_window_grid_blocks(band, win_size, stride, block_size, dtype)
+                tile_blocks = tile_blocks.reshape(tile_blocks.shape[0], -1)
+
+                blocks[block_start:block_end] = tile_blocks
+                blocks_norm[block_start:block_end], constant[block_start:block_end] = normalize_blocks(tile_blocks)
+
+        if report is not None:
+            report.windows = n_y * n_x
+
+        # Expectation-maximization algorithm
+        with measure(report, 'expectation_maximization'):
+            prob_b_in_c1_r, c, diff_history = expectation_maximization_tiled(blocks, blocks_norm, constant, block_tiles, stop_threshold, prob_r_b_in_c1, prob_b_in_c1_r, seed, c_init, report)
+
+        # Output map
+        with measure(report, 'get_output_map'):
+            get_output_map_tiled(prob_b_in_c1_r, n_y, n_x, img_w, img_h, win_size, stride, memory_budget, output_map)
+
+        # Release memory-mapped files before their directory is removed
+        del blocks, blocks_norm, constant, prob_b_in_c1_r
+
+    if output_path is not None:
+        output_map.flush()
+
+    return output_map, c
+
+
+# Median filter residual of the rows y_start to y_end of an image (see analyze_tiled), padded as by adjust_size to y_end - y_start rows of pad_w pixels
+# Luminance and residual are only computed on these rows, plus a 1 pixel halo above and below them (all the 3x3 median filter needs),
+# so that the band is the same as the corresponding rows of the residual of the whole image; rows and columns past the image replicate its last ones.
+# If given, stage times are recorded in report (times of all bands are added up)
+def get_residual_band(img, y_start, y_end, pad_w, rgb=False, report=None):
+    img_h, img_w = get_image_size(img)
+
+    halo_start = max(y_start - 1, 0)
+    halo_end = min(y_end + 1, img_h)
+
+    # RGB to YCbCr conversion & luminance channel extraction
+    with measure(report, 'luminance'):
+        lum = luminance(img[halo_start:halo_end], rgb)
+
+    # 3x3 median filter residual, cropped to the band and padded
+    with measure(report, 'mfr'):
+        band = mfr(lum, 3)[y_start - halo_start:min(y_end, img_h) - halo_start]
+        band = cv2.copyMakeBorder(band, 0, y_end - y_start - band.shape[0], 0, pad_w - img_w, cv2.BORDER_REPLICATE)
+
+    return band
+
+
+# PROGRESSIVE ANALYSIS
+# Coarse-to-fine analysis: EM is first run on a subsampled grid of windows (extracted with coarse_stride instead of stride),
+# which gives a rough output map in a fraction of the time, then on the dense grid, whose output map is the same as the one computed by main.
+# If suspicious_only is set, the dense pass is restricted to the windows overlapping the regions flagged by the coarse pass:
+# their probabilities are estimated with the coarse template (a single E step), while the coarse map is kept everywhere else.
+# The output map of each pass is yielded as soon as it is available, along with its stride.
+# If a report is given (see report.py), the times of the stages of both passes are added up, while its EM result is the one of the last pass.
+# An already decoded image can be given as img (see main).
+def main_progressive(img_path, coarse_stride=32, suspicious_only=False, cache=None, seed=None, templates=None, camera=None, precision='double', report=None, img=None, rgb=False):
+    # Arguments
+    args = get_args(img_path, coarse_stride=coarse_stride, suspicious_only=suspicious_only, cache=cache, seed=seed, templates=templates, camera=camera, precision=precision, report=report, img=img, rgb=rgb)
+
+    if args.win_size % args.coarse_stride != 0 or args.coarse_stride % args.block_size != 0:
+        raise ValueError('Progressive analysis requires the window size to be a multiple of the coarse stride, and the coarse stride to be a multiple of the block size.')
+
+    # Return the cached map, if any
+    args.file_hash = get_image_hash(args)
+    cache_key = get_cache_key(args)
+    if cache_key is not None:
+        output_map = args.cache.get(cache_key)
+
+        if output_map is not None:
+            if args.report is not None:
+                args.report.cached = True
+            yield args.stride, output_map
+            return
+
+    # Load image (unless already decoded)
+    with measure(args.report, 'load_image'):
+        img = get_image(args)
+        img_h, img_w = get_image_size(img)
+
+    # Images smaller than the analysis window have an empty output map (and leave the template library unchanged)
+    if not has_windows(img, args.win_size, args.stride) or not has_windows(img, args.win_size, args.coarse_stride):
+        output_map = np.zeros((img_h, img_w), dtype=np.uint8)
+
+        if cache_key is not None:
+            args.cache.put(cache_key, output_map)
+
+        yield args.stride, output_map
+        return
+
+    # Warm-start template
+    args.c_init = get_warm_start(args)
+
+    # RGB to YCbCr conversion & luminance channel extraction
+    with measure(args.report, 'luminance'):
+        lum = luminance(img, args.rgb)
+
+    # 3x3 median filter residual
+    with measure(args.report, 'mfr'):
+        filtered_lum = mfr(lum, 3)
+
+    # Coarse pass
+    with measure(args.report, 'get_average_window_blocks'):
+        blocks, blocks_map = get_average_window_blocks(filtered_lum, args.win_size, args.coarse_stride, args.block_size, dtype=analysis_dtypes[args.precision])
+
+    with measure(args.report, 'expectation_maximization'):
+        prob_b_in_c1_r, c, diff_history = expectation_maximization(blocks, args.stop_threshold, args.prob_r_b_in_c1, args.seed, args.c_init, args.report)
+
+    with measure(args.report, 'get_output_map'):
+        coarse_cell_map = get_cell_average_grid(prob_b_in_c1_r, blocks_map, img_w, img_h, args.win_size, args.coarse_stride)
+        coarse_map = upsample_cell_grid(threshold_output_map(coarse_cell_map), args.coarse_stride, img_w, img_h)
+
+    yield args.coarse_stride, coarse_map
+
+    # Dense pass
+    with measure(args.report, 'get_average_window_blocks'):
+        blocks, blocks_map = get_average_window_blocks(filtered_lum, args.win_size, args.stride, args.block_size, dtype=analysis_dtypes[args.precision])
+
+    if args.report is not None:
+        args.report.windows = blocks.shape[0]
+
+    if args.suspicious_only:
+        with measure(args.report, 'expectation_maximization'):
+            output_map = refine_suspicious_windows(blocks, blocks_map, c, coarse_map, coarse_cell_map, img_w, img_h, args)
+    else:
+        with measure(args.report, 'expectation_maximization'):
+            prob_b_in_c1_r, c, diff_history = expectation_maximization(blocks, args.stop_threshold, args.prob_r_b_in_c1, args.seed, args.c_init, args.report)
+
+        with measure(args.report, 'get_output_map'):
+            output_map = get_output_map(prob_b_in_c1_r, blocks_map, img_w, img_h, args.show, args.save, args.img_path, args.win_size, args.stop_threshold)
+
+    # Update the template library with the converged template (unless the same image has already been added to it)
+    if args.templates is not None:
+        args.templates.update(args.camera, c, get_image_key(args))
+
+    # Store the map in the cache
+    if cache_key is not None:
+        args.cache.put(cache_key, output_map)
+
+    yield args.stride, output_map
+
+
+# Dense output map of the windows overlapping the pixels flagged in the coarse map (see main_progressive), combined with the coarse map everywhere else
+def refine_suspicious_windows(blocks, blocks_map, c, coarse_map, coarse_cell_map, img_w, img_h, args):
+    # Number of flagged pixels in each window (from the integral image of the coarse map, with window extents clipped to the image)
+    flagged = np.zeros((img_h + 1, img_w + 1), dtype=np.int64)
+    flagged[1:, 1:] = np.cumsum(np.cumsum(coarse_map > 0, axis=0), axis=1)
+
+    x0 = np.minimum(blocks_map[:, 0], img_w)
+    y0 = np.minimum(blocks_map[:, 1], img_h)
+    x1 = np.minimum(blocks_map[:, 0] + args.win_size, img_w)
+    y1 = np.minimum(blocks_map[:, 1] + args.win_size, img_h)
+
+    selected = (flagged[y1, x1] - flagged[y0, x1] - flagged[y1, x0] + flagged[y0, x0]) > 0
+
+    if not np.any(selected):
+        return coarse_map
+
+    # Probabilities of the selected windows, given the coarse template
+    blocks_norm, constant = normalize_blocks(blocks[selected])
+    prob_b_in_c1_r = np.zeros(blocks.shape[0], dtype=blocks.dtype)
+    prob_b_in_c1_r[selected] = expectation(blocks_norm, constant, c, args.prob_r_b_in_c1)
+
+    # Dense map where available (cells which are not covered by any selected window are NaN), coarse map elsewhere
+    # (coarse cells are upsampled to dense cells, which are aligned with them)
+    dense_cell_map = get_cell_average_grid(prob_b_in_c1_r, blocks_map[selected], img_w, img_h, args.win_size, args.stride)
+    coarse_cell_map = upsample_cell_grid(coarse_cell_map, args.coarse_stride // args.stride, dense_cell_map.shape[1], dense_cell_map.shape[0])
+    cell_map = np.where(np.isnan(dense_cell_map), coarse_cell_map, dense_cell_map)
+
+    return upsample_cell_grid(threshold_output_map(cell_map), args.stride, img_w, img_h)
+
+
 # UTILS
 
 # Load image
+# Images are analyzed as stored: the EXIF orientation of JPEG images is not applied, so that their pixels (and manipulation maps) match their JPEG block grid,
+# as well as the images decoded by the GUI (see model.py)
 def load_image(img_path, raise_io=True):
     # Load image
-    img = cv2.imread(img_path)
+    img = cv2.imread(img_path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
 
     # Check image correctness
     if img is not None:
@@ -241,6 +897,31 @@ def get_image_size(img):
     return img_h, img_w
 
 
+# Whether an image contains at least one analysis window once padded for the given stride (see adjust_size)
+# Smaller images cannot be analyzed: their output map is empty, i.e. all zeros
+def has_windows(img, win_size, stride):
+    img_h, img_w = get_image_size(img)
+    pad_bottom, pad_right = get_padding(img_h, img_w, win_size, stride)
+
+    return img_h + pad_bottom >= win_size and img_w + pad_right >= win_size
+
+
+# Context manager measuring an analysis stage in a report (see report.py); does nothing if there is no report
+def measure(report, stage):
+    if report is None:
+        return nullcontext()
+
+    return report.stage(stage)
+
+
+# Context manager around a whole analysis, needed by reports tracking memory (see report.py); does nothing if there is no report
+def profile(report):
+    if report is None:
+        return nullcontext()
+
+    return report
+
+
 # Get filename from path
 def get_filename(file_path):
     tmp_filename = file_path.split('/')[-1]
@@ -259,36 +940,352 @@ def get_filename(file_path):
 
 # MAIN
 
-def main(img_path):
+# Default memory budget for tiled analysis (bytes)
+default_memory_budget = 256 * 2 ** 20
+
+
+# Analysis arguments: default parameters and options, updated with the given ones (see main)
+def get_args(img_path, **options):
     # Arguments
     args = Namespace()
     args.img_path = img_path
-    args.win_size = 64
-    args.stop_threshold = 1e-3
-    args.prob_r_b_in_c1 = 0.5
+    args.win_size = analysis_parameters['win_size']
+    args.stop_threshold = analysis_parameters['stop_threshold']
+    args.prob_r_b_in_c1 = analysis_parameters['prob_r_b_in_c1']
+    args.stride = analysis_parameters['stride']
+    args.block_size = analysis_parameters['block_size']
     args.show = False
     args.save = False
     args.show_roc_plot = False
     args.save_roc_plot = False
     args.show_diff_plot = False
     args.save_diff_plot = False
+    args.tiled = False  # Bounded-memory analysis (see analyze_tiled)
+    args.memory_budget = default_memory_budget
+    args.output_path = None
+    args.cache = None  # On-disk cache of manipulation maps (see cache.py)
+    args.n_starts = 1  # Number of concurrent EM starts (see expectation_maximization_multistart; not available for tiled analysis)
+    args.seed = None
+    args.templates = None  # Library of warm-start templates (see templates.py)
+    args.c_init = None  # Warm-start template of the image (see get_warm_start)
+    args.file_hash = None  # Hash of the contents of the image file (see get_image_hash)
+    args.camera = None  # Camera (make, model) of the image; read from its EXIF data if not given
+    args.coarse_stride = 32  # Stride of the coarse pass of progressive analysis (see main_progressive)
+    args.suspicious_only = False
+    args.precision = 'double'  # Precision of the analysis working set (see analysis_dtypes)
+    args.report = None  # Report of the analysis stages (see report.py)
+    args.img = None  # Already decoded image (if given, img_path is only used to identify the image for the cache and the template library, and can be None)
+    args.rgb = False  # Channel order of the decoded image (BGR, as loaded by OpenCV, unless set)
+
+    for option, value in options.items():
+        setattr(args, option, value)
+
+    if args.n_starts > 1 and args.seed is None:  # Multi-start EM is reproducible (and cached) with the default seed of expectation_maximization_multistart
+        args.seed = 0
+
+    return args
+
+
+# Cache key of the analysis (None if no cache is used)
+# Maps of warm-started analyses are keyed by the use of the template library, not by the template itself: since the library keeps being updated,
+# keying maps by template would make every new analysis of an image miss the cache
+def get_cache_key(args):
+    if args.cache is None or args.img_path is None:
+        return None
+
+    cache_parameters = dict(analysis_parameters)
+    if args.n_starts > 1 and not args.tiled:  # Multi-start EM may give a different result
+        cache_parameters.update(n_starts=args.n_starts, seed=args.seed)
+    if args.templates is not None:  # So may warm-started EM
+        cache_parameters.update(warm_start=True)
+    if args.suspicious_only:  # And partial progressive analysis
+        cache_parameters.update(suspicious_only=True, coarse_stride=args.coarse_stride)
+    if args.precision != 'double':  # And reduced precision analysis
+        cache_parameters.update(precision=args.precision)
+
+    return args.cache.get_key(args.img_path, cache_parameters, args.file_hash)
+
+
+# Hash of the contents of the image file (see cache.get_file_hash), shared by the cache key and the template library (None if neither is used, or if there is no file)
+def get_image_hash(args):
+    if args.img_path is None or (args.cache is None and args.templates is None):
+        return None
+
+    return get_file_hash(args.img_path)
+
+
+# Key identifying the analyzed image in the template library (see TemplateLibrary.update), None if unknown
+def get_image_key(args):
+    return args.file_hash.hexdigest() if args.file_hash is not None else None
+
+
+# Image to analyze: the already decoded one, if given, otherwise the one loaded from its path
+def get_image(args):
+    if args.img is not None:
+        return args.img
+
+    return load_image(args.img_path)
+
+
+# Warm-start template for the camera of the image, if known (otherwise None, i.e. random initialization)
+def get_warm_start(args):
+    if args.templates is None:
+        return None
+
+    if args.camera is None and args.img_path is not None:
+        args.camera = get_camera(args.img_path)
+
+    return args.templates.get(args.camera)
 
-    # Load image
-    img = load_image(args.img_path)
+
+# If a report is given (see report.py), it is filled with the time of each stage and EM iteration, the number of windows and the EM result
+# An already decoded image (e.g. the one displayed by the GUI) can be analyzed without decoding its file again by giving it as img, a NumPy array
+# (BGR, RGB if rgb is set, with an optional alpha channel, or grayscale); it is never copied. img_path can then be None, in which case the cache is not used.
+def main(img_path, tiled=False, memory_budget=default_memory_budget, output_path=None, cache=None, n_starts=1, seed=None, templates=None, camera=None, precision='double', report=None, img=None, rgb=False):
+    # Arguments
+    args = get_args(img_path, tiled=tiled, memory_budget=memory_budget, output_path=output_path, cache=cache, n_starts=n_starts, seed=seed, templates=templates, camera=camera, precision=precision, report=report, img=img, rgb=rgb)
+
+    # Return the cached map, if any
+    args.file_hash = get_image_hash(args)
+    cache_key = get_cache_key(args)
+    if cache_key is not None:
+        output_map = args.cache.get(cache_key)
+
+        if output_map is not None:
+            if args.report is not None:
+                args.report.cached = True
+            if args.output_path is not None:
+                np.save(args.output_path, output_map)
+            return output_map
+
+    with profile(args.report):
+        # Load image (unless already decoded)
+        with measure(args.report, 'load_image'):
+            img = get_image(args)
+
+        # Warm-start template
+        args.c_init = get_warm_start(args)
+
+        if args.tiled:
+            output_map, c = analyze_tiled(img, args.win_size, args.stop_threshold, args.prob_r_b_in_c1, args.memory_budget, args.output_path, stride=args.stride, block_size=args.block_size, seed=args.seed, c_init=args.c_init, dtype=analysis_dtypes[args.precision], report=args.report, rgb=args.rgb)
+        else:
+            output_map, c = analyze_image(img, args)
+
+    # Update the template library with the converged template (if any, see analyze_image), unless the same image has already been added to it
+    if args.templates is not None and c is not None:
+        args.templates.update(args.camera, c, get_image_key(args))
+
+    # Store the map in the cache
+    if cache_key is not None:
+        args.cache.put(cache_key, output_map)
+
+    return output_map
+
+
+# Analyze a loaded image at once (see main for the arguments), returning its output map and the final template c (None if the image is smaller than the analysis window)
+def analyze_image(img, args):
+    if not has_windows(img, args.win_size, args.stride):
+        return np.zeros(get_image_size(img), dtype=np.uint8), None
 
     # RGB to YCbCr conversion & luminance channel extraction
-    lum = luminance(img)
+    with measure(args.report, 'luminance'):
+        lum = luminance(img, args.rgb)
 
     # 3x3 median filter residual
-    filtered_lum = mfr(lum, 3)
+    with measure(args.report, 'mfr'):
+        filtered_lum = mfr(lum, 3)
 
     # Average blocks from overlapping windows generation
-    blocks, blocks_map = get_average_window_blocks(filtered_lum, args.win_size, 8, 8)
+    with measure(args.report, 'get_average_window_blocks'):
+        blocks, blocks_map = get_average_window_blocks(filtered_lum, args.win_size, args.stride, args.block_size, dtype=analysis_dtypes[args.precision])
+
+    if args.report is not None:
+        args.report.windows = blocks.shape[0]
 
     # Expectation-maximization algorithm
-    prob_b_in_c1_r, c, diff_history = expectation_maximization(blocks, args.stop_threshold, args.prob_r_b_in_c1)
+    with measure(args.report, 'expectation_maximization'):
+        if args.n_starts > 1:
+            prob_b_in_c1_r, c, diff_history = expectation_maximization_multistart(blocks, args.stop_threshold, args.prob_r_b_in_c1, args.n_starts, args.seed, c_init=args.c_init, report=args.report)
+        else:
+            prob_b_in_c1_r, c, diff_history = expectation_maximization(blocks, args.stop_threshold, args.prob_r_b_in_c1, args.seed, args.c_init, args.report)
 
     # Output map & difference plot
-    output_map = get_output_map(prob_b_in_c1_r, blocks_map, img.shape[1], img.shape[0], args.show, args.save, args.img_path, args.win_size, args.stop_threshold)
+    with measure(args.report, 'get_output_map'):
+        output_map = get_output_map(prob_b_in_c1_r, blocks_map, img.shape[1], img.shape[0], args.show, args.save, args.img_path, args.win_size, args.stop_threshold)
 
-    return output_map
+    return output_map, c
+
+
+# BATCH ANALYSIS
+
+# Get the list of image paths to analyze from a directory (including its subdirectories, if recursive is set), a glob pattern or a list file (one path per line)
+def get_image_paths(source, recursive=False):
+    if os.path.isdir(source) and recursive:  # Directory tree (JPEG and PNG images only)
+        paths = []
+        for root, dirs, files in os.walk(source):
+            dirs.sort()
+            paths += [os.path.join(root, f) for f in sorted(files) if is_image_file(f)]
+    elif os.path.isdir(source):  # Directory (JPEG and PNG images only)
+        paths = [os.path.join(source, f) for f in sorted(os.listdir(source)) if is_image_file(f)]
+    elif os.path.isfile(source):  # List file (empty lines and comments are skipped)
+        with open(source) as f:
+            paths = [line.strip() for line in f if line.strip() != '' and not line.startswith('#')]
+    else:  # Glob pattern
+        paths = sorted(glob.glob(source, recursive=True))
+
+    return paths
+
+
+# Check whether a file name has a JPEG or PNG extension
+def is_image_file(filename):
+    return '.' in filename and get_filename(filename)[1] in jpeg_extensions + png_extensions
+
+
+# Worker process initializer: each process works on a single image at a time, so OpenCV should not spawn threads of its own
+def init_batch_worker():
+    cv2.setNumThreads(1)
+
+
+# Analyze a single image and save its manipulation map (meant to be run in a worker process)
+# Returns a summary of the analysis (including its report, see report.py, if profile is set); invalid images are reported instead of interrupting the batch
+def analyze_file(img_path, output_dir, tiled=False, memory_budget=default_memory_budget, cache=None, n_starts=1, seed=None, templates=None, precision='double', profile=False):
+    start = time.perf_counter()
+    summary = {'path': img_path}
+    report = AnalysisReport(track_memory=True) if profile else None
+
+    try:
+        output_map = main(img_path, tiled, memory_budget, cache=cache, n_starts=n_starts, seed=seed, templates=templates, precision=precision, report=report)
+    except IOError as e:
+        summary['status'] = 'invalid'
+        summary['error'] = str(e)
+    except Exception as e:
+        summary['status'] = 'error'
+        summary['error'] = repr(e)
+    else:
+        # The path hash avoids name clashes between images with the same file name in different directories
+        filename, _ = get_filename(os.path.basename(img_path))
+        path_hash = hashlib.sha1(os.path.abspath(img_path).encode()).hexdigest()[:8]
+        map_path = os.path.join(output_dir, filename + '_' + path_hash + '_map.png')
+        cv2.imwrite(map_path, output_map)
+
+        summary['status'] = 'ok'
+        summary['width'] = output_map.shape[1]
+        summary['height'] = output_map.shape[0]
+        summary['manipulated'] = float(np.count_nonzero(output_map)) / output_map.size  # Fraction of pixels marked as manipulated
+        summary['map_path'] = map_path
+
+        if report is not None:
+            summary['report'] = report.to_dict()
+
+    summary['time'] = time.perf_counter() - start
+
+    return summary
+
+
+# Analyze all images from a source (see get_image_paths) in parallel, writing one JSON summary line per image as soon as it is done
+def batch(source, output_dir, workers=None, summary_path=None, tiled=False, memory_budget=default_memory_budget, cache=None, n_starts=1, seed=None, templates=None, precision='double', profile=False):
+    paths = get_image_paths(source)
+
+    os.makedirs(output_dir, exist_ok=True)
+    if summary_path is None:
+        summary_path = os.path.join(output_dir, 'summary.jsonl')
+
+    start = time.perf_counter()
+    failed = 0
+
+    with ProcessPoolExecutor(max_workers=workers, initializer=init_batch_worker) as executor, open(summary_path, 'w') as summary_file:
+        futures = [executor.submit(analyze_file, p, output_dir, tiled, memory_budget, cache, n_starts, seed, templates, precision, profile) for p in paths]
+
+        for future in as_completed(futures):
+            summary = future.result()
+            if summary['status'] != 'ok':
+                failed += 1
+
+            summary_file.write(json.dumps(summary) + '\n')
+            summary_file.flush()
+
+    elapsed = time.perf_counter() - start
+    print('Analyzed {} images ({} failed) in {:.2f} s ({:.2f} images/s).'.format(len(paths), failed, elapsed, len(paths) / elapsed if elapsed > 0 else 0), file=sys.stderr)
+
+
+# PRECISION CHECK
+
+# Analyze all images from a source (see get_image_paths) in both double and single precision, and compare the results
+# Returns one result per image: the fraction of output map pixels which differ, the largest difference between window probabilities,
+# the size of the blocks in each precision (bytes) and whether the maps are within the tolerance (i.e. the fraction of differing pixels is at most tolerance)
+def check_precision(source, tolerance=0.0):
+    results = []
+
+    for img_path in get_image_paths(source):
+        img = load_image(img_path, raise_io=False)
+        if img is None:
+            continue
+
+        filtered_lum = mfr(luminance(img), 3)
+        result = {'path': img_path}
+        output = {}
+
+        for precision, dtype in analysis_dtypes.items():
+            blocks, blocks_map = get_average_window_blocks(filtered_lum, analysis_parameters['win_size'], analysis_parameters['stride'], analysis_parameters['block_size'], dtype=dtype)
+            prob_b_in_c1_r, c, diff_history = expectation_maximization(blocks, analysis_parameters['stop_threshold'], analysis_parameters['prob_r_b_in_c1'], seed=0)
+            output_map = get_output_map(prob_b_in_c1_r, blocks_map, img.shape[1], img.shape[0], win_size=analysis_parameters['win_size'])
+
+            output[precision] = (prob_b_in_c1_r.astype(np.float64), output_map)
+            result[precision + '_blocks_bytes'] = blocks.nbytes + blocks_map.nbytes
+            result[precision + '_iterations'] = len(diff_history) + 1
+
+        result['map_difference'] = float(np.count_nonzero(output['double'][1] != output['single'][1])) / output['double'][1].size
+        result['max_probability_difference'] = float(np.nanmax(np.abs(output['double'][0] - output['single'][0]), initial=0))
+        result['ok'] = result['map_difference'] <= tolerance
+
+        results.append(result)
+
+    return results
+
+
+# COMMAND LINE
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='python -m analyze', description='Photo manipulation analysis from rounding artifacts.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    # Batch analysis
+    batch_parser = subparsers.add_parser('batch', help='analyze a directory, glob pattern or list file of images')
+    batch_parser.add_argument('source', help='directory, glob pattern (quoted) or text file with one image path per line')
+    batch_parser.add_argument('-o', '--output', default='output', help='output directory for the manipulation maps (default: output)')
+    batch_parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+    batch_parser.add_argument('-s', '--summary', default=None, help='JSONL summary file (default: <output>/summary.jsonl)')
+    batch_parser.add_argument('-m', '--memory-budget', type=int, default=None, help='analyze images in tiles, using at most this many MB per worker')
+    batch_parser.add_argument('--cache-dir', default=None, help='manipulation map cache directory (default: ~/.ieviewer/cache)')
+    batch_parser.add_argument('--no-cache', action='store_true', help='do not use the manipulation map cache')
+    batch_parser.add_argument('--starts', type=int, default=1, help='number of concurrent EM starts per image (default: 1)')
+    batch_parser.add_argument('--seed', type=int, default=0, help='random seed of the EM starts (default: 0)')
+    batch_parser.add_argument('--warm-start', action='store_true', help='start EM from the template of the camera of each image, and update it (see templates.py)')
+    batch_parser.add_argument('--templates', default=None, help='template library file (default: ~/.ieviewer/templates.json; implies --warm-start)')
+    batch_parser.add_argument('--precision', choices=list(analysis_dtypes), default='double', help='precision of the analysis (single precision halves its memory usage; default: double)')
+    batch_parser.add_argument('--profile', action='store_true', help='add the time and peak memory of each analysis stage and EM iteration to the summary')
+
+    # Precision check
+    check_parser = subparsers.add_parser('check-precision', help='compare single and double precision manipulation maps')
+    check_parser.add_argument('source', nargs='?', default='test', help='directory, glob pattern (quoted) or text file with one image path per line (default: test)')
+    check_parser.add_argument('-t', '--tolerance', type=float, default=0.0, help='maximum fraction of differing map pixels (default: 0)')
+
+    cli_args = parser.parse_args()
+
+    if cli_args.command == 'batch':
+        batch_cache = None if cli_args.no_cache else AnalysisCache(cli_args.cache_dir)
+        batch_templates = TemplateLibrary(cli_args.templates) if cli_args.warm_start or cli_args.templates is not None else None
+
+        if cli_args.memory_budget is not None:
+            batch(cli_args.source, cli_args.output, cli_args.workers, cli_args.summary, tiled=True, memory_budget=cli_args.memory_budget * 2 ** 20, cache=batch_cache, seed=cli_args.seed, templates=batch_templates, precision=cli_args.precision, profile=cli_args.profile)
+        else:
+            batch(cli_args.source, cli_args.output, cli_args.workers, cli_args.summary, cache=batch_cache, n_starts=cli_args.starts, seed=cli_args.seed, templates=batch_templates, precision=cli_args.precision, profile=cli_args.profile)
+
+    elif cli_args.command == 'check-precision':
+        check_results = check_precision(cli_args.source, cli_args.tolerance)
+
+        for result in check_results:
+            print(json.dumps(result))
+
+        if not all(result['ok'] for result in check_results):
+            sys.exit(1)
@@ -0,0 +1,191 @@
+import cv2
+import json
+import os
+import platform
+import sys
+import tempfile
+import numpy as np
+from argparse import ArgumentParser
+from analyze import analysis_dtypes, get_filename, get_image_paths, load_image, main
+from report import AnalysisReport
+
+
+# Global parameters
+benchmark_version = 1
+
+# Synthetic image sizes (megapixels) and aspect ratio (width / height)
+synthetic_megapixels = [1, 4, 12, 24, 50]
+synthetic_aspect_ratio = 3 / 2
+
+# Analysis stages, in pipeline order
+stages = ['load_image', 'luminance', 'mfr', 'get_average_window_blocks', 'expectation_maximization', 'get_output_map']
+
+# Stage times shorter than this (seconds) are too noisy to be compared against the baseline
+min_compared_time = 0.005
+
+
+# SYNTHETIC IMAGES
+
+# Create a synthetic JPEG image of (about) the given size, with smooth content and noise (so that it looks like a photograph to the analysis)
+# Images are generated deterministically, so that results are comparable across runs
+def create_synthetic_image(megapixels, img_path, seed=0):
+    img_h = int(round(np.sqrt(megapixels * 1e6 / synthetic_aspect_ratio)))
+    img_w = int(round(img_h * synthetic_aspect_ratio))
+
+    rng = np.random.default_rng(seed)
+
+    # Smooth content: a small random image upsampled to the final size
+    img = cv2.resize(rng.integers(0, 256, (16, 24, 3), dtype=np.uint8), (img_w, img_h), interpolation=cv2.INTER_CUBIC)
+
+    # Noise (added in place, row band by row band, to keep memory usage low)
+    for start in range(0, img_h, 512):
+        band = img[start:start + 512]
+        cv2.add(band, rng.integers(0, 16, band.shape, dtype=np.uint8), dst=band)
+
+    cv2.imwrite(img_path, img, [cv2.IMWRITE_JPEG_QUALITY, 90])
+
+    return img_w, img_h
+
+
+# BENCHMARK
+
+# Run the whole analysis on an image (see analyze.main), returning its report (see report.py)
+# Peak memory is measured only if track_memory is set, since it slows down the analysis
+def run_stages(img_path, precision='double', track_memory=False):
+    report = AnalysisReport(track_memory)
+    main(img_path, seed=0, precision=precision, report=report)
+
+    return report
+
+
+# Benchmark an image: each stage is timed repeat times (keeping the fastest run, which is the least affected by other processes), then its peak memory is measured
+# The peak memory of each stage includes the arrays it receives from previous stages, i.e. it is the peak memory of the pipeline up to that stage
+def benchmark_image(img_path, repeat=3, precision='double'):
+    reports = [run_stages(img_path, precision) for _ in range(repeat)]
+    memory_report = run_stages(img_path, precision, track_memory=True)
+
+    img = load_image(img_path)
+    fastest_iterations = min((report.iteration_times for report in reports), key=sum)
+
+    result = {
+        'width': img.shape[1],
+        'height': img.shape[0],
+        'megapixels': img.shape[0] * img.shape[1] / 1e6,
+        'windows': reports[0].windows,
+        'stages': {stage: {'time': min(report.stages[stage] for report in reports), 'peak_memory': memory_report.stage_peak_memory[stage]} for stage in stages},
+        'em_iterations': len(fastest_iterations),
+        'em_iteration_times': fastest_iterations,
+    }
+    result['total_time'] = sum(stage['time'] for stage in result['stages'].values())
+
+    return result
+
+
+# Benchmark all test images and synthetic images up to max_megapixels, printing progress on stderr
+# Returns the results as a JSON-serializable dictionary, indexed by image name
+def benchmark(source='test', max_megapixels=50, repeat=3, precision='double'):
+    results = {
+        'version': benchmark_version,
+        'environment': {
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv2.__version__,
+            'platform': platform.platform(),
+            'cpus': os.cpu_count(),
+        },
+        'precision': precision,
+        'repeat': repeat,
+        'images': {},
+    }
+
+    # Test images (invalid ones are skipped)
+    images = [(get_filename(os.path.basename(p))[0], p) for p in get_image_paths(source) if load_image(p, raise_io=False) is not None]
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        # Synthetic images
+        for megapixels in synthetic_megapixels:
+            if megapixels <= max_megapixels:
+                img_path = os.path.join(tmp_dir, 'synthetic_{}mp.jpg'.format(megapixels))
+                create_synthetic_image(megapixels, img_path)
+                images.append(('synthetic_{}mp'.format(megapixels), img_path))
+
+        for name, img_path in images:
+            print('Benchmarking {}...'.format(name), file=sys.stderr)
+            results['images'][name] = benchmark_image(img_path, repeat, precision)
+
+    return results
+
+
+# BASELINE COMPARISON
+
+# Compare results against a baseline, returning a list of regressions (as strings)
+# A stage regresses if its time (or peak memory) exceeds the baseline by more than the given relative tolerance;
+# stages which are too fast to be timed reliably (see min_compared_time) are only compared by memory.
+def compare(results, baseline, time_tolerance=0.25, memory_tolerance=0.1):
+    regressions = []
+
+    for name, result in results['images'].items():
+        if name not in baseline['images']:
+            continue
+
+        for stage, current in result['stages'].items():
+            reference = baseline['images'][name]['stages'].get(stage)
+            if reference is None:
+                continue
+
+            if reference['time'] >= min_compared_time and current['time'] > reference['time'] * (1 + time_tolerance):
+                regressions.append('{} {}: time {:.4f} s (baseline {:.4f} s, +{:.0%})'.format(name, stage, current['time'], reference['time'], current['time'] / reference['time'] - 1))
+
+            if current['peak_memory'] > reference['peak_memory'] * (1 + memory_tolerance):
+                regressions.append('{} {}: peak memory {:.1f} MB (baseline {:.1f} MB, +{:.0%})'.format(name, stage, current['peak_memory'] / 2 ** 20, reference['peak_memory'] / 2 ** 20, current['peak_memory'] / max(reference['peak_memory'], 1) - 1))
+
+    return regressions
+
+
+# Print the time and peak memory of each stage for each image
+def print_results(results):
+    for name, result in results['images'].items():
+        print('{} ({}x{}, {:.2f} MP, {} windows, {} EM iterations): {:.3f} s'.format(name, result['width'], result['height'], result['megapixels'], result['windows'], result['em_iterations'], result['total_time']))
+
+        for stage in stages:
+            print('    {:<28} {:>9.4f} s {:>10.1f} MB'.format(stage, result['stages'][stage]['time'], result['stages'][stage]['peak_memory'] / 2 ** 20))
+
+
+# COMMAND LINE
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='python -m benchmark', description='Stage-level benchmark of the photo manipulation analysis.')
+    parser.add_argument('source', nargs='?', default='test', help='directory, glob pattern (quoted) or text file with one image path per line (default: test)')
+    parser.add_argument('-o', '--output', default=None, help='JSON results file')
+    parser.add_argument('-b', '--baseline', default=None, help='JSON results file to compare against (exits with an error on regressions)')
+    parser.add_argument('-r', '--repeat', type=int, default=3, help='number of timed runs per image (default: 3)')
+    parser.add_argument('--max-megapixels', type=float, default=50, help='size of the largest synthetic image (default: 50; 0 for none)')
+    parser.add_argument('--precision', choices=list(analysis_dtypes), default='double', help='precision of the analysis (default: double)')
+    parser.add_argument('--time-tolerance', type=float, default=0.25, help='maximum relative time increase over the baseline (default: 0.25)')
+    parser.add_argument('--memory-tolerance', type=float, default=0.1, help='maximum relative peak memory increase over the baseline (default: 0.1)')
+
+    args = parser.parse_args()
+
+    benchmark_results = benchmark(args.source, args.max_megapixels, args.repeat, args.precision)
+    print_results(benchmark_results)
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(benchmark_results, f, indent=4)
+
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            baseline_results = json.load(f)
+
+        if baseline_results.get('version') != benchmark_version or baseline_results.get('precision') != benchmark_results['precision']:
+            sys.exit('Baseline results are not comparable (different benchmark version or precision).')
+
+        benchmark_regressions = compare(benchmark_results, baseline_results, args.time_tolerance, args.memory_tolerance)
+
+        for regression in benchmark_regressions:
+            print('REGRESSION ' + regression, file=sys.stderr)
+
+        if benchmark_regressions:
+            sys.exit(1)
+        else:
+            print('No regressions against the baseline.', file=sys.stderr)
@@ -0,0 +1,110 @@
+import cv2
+import hashlib
+import json
+import os
+
+
+class AnalysisCache():
+    """Persistent, content-addressed cache for manipulation maps.
+
+    Maps are stored as PNG files named after a hash of the analyzed file's bytes and of the analysis parameters,
+    so the same evidence file is never analyzed twice (regardless of its name or location), while changing any parameter invalidates its maps.
+    The total size of the cache is capped: whenever it is exceeded, the least recently used maps are evicted (file modification times are used to keep track of their last use).
+
+    Attributes:
+        cache_dir: The directory containing the cached maps.
+        max_size: The maximum total size of the cached maps, in bytes.
+    """
+    def __init__(self, cache_dir=None, max_size=512 * 2 ** 20):
+        """Inits the class."""
+        if cache_dir is None:
+            cache_dir = os.path.join(os.path.expanduser('~'), '.ieviewer', 'cache')
+
+        self.cache_dir = cache_dir
+        self.max_size = max_size
+
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_key(self, file_path, parameters, file_hash=None):
+        """Returns the cache key of a file analyzed with the given parameters (a dictionary).
+
+        The hash of the file's bytes (see get_file_hash) can be given as file_hash, if already computed, so that the file is not read again.
+        """
+        if file_hash is None:
+            file_hash = get_file_hash(file_path)
+
+        key = file_hash.copy()
+        key.update(json.dumps(parameters, sort_keys=True).encode())
+
+        return key.hexdigest()
+
+    def get_path(self, key):
+        """Returns the path of the cached map for a key."""
+        return os.path.join(self.cache_dir, key + '.png')
+
+    def get(self, key):
+        """Returns the cached map for a key (None if there is none), marking it as recently used."""
+        path = self.get_path(key)
+
+        if not os.path.isfile(path):
+            return None
+
+        output_map = cv2.imread(path, cv2.IMREAD_GRAYSCALE)
+
+        if output_map is not None:
+            try:
+                os.utime(path)
+            except OSError:  # Evicted in the meantime by another process
+                pass
+
+        return output_map
+
+    def put(self, key, output_map):
+        """Stores a map in the cache, then evicts the least recently used maps if needed."""
+        path = self.get_path(key)
+        tmp_path = path + '.' + str(os.getpid()) + '.tmp.png'  # Maps are written atomically, so that concurrent processes never read partial files
+
+        cv2.imwrite(tmp_path, output_map)
+        os.replace(tmp_path, path)
+
+        self.evict()
+
+    def evict(self):
+        """Removes the least recently used maps until the cache size is within its limit."""
+        entries = []
+        total_size = 0
+
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.png') and not entry.name.endswith('.tmp.png'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total_size += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                os.remove(path)
+            except OSError:  # Already evicted by another process
+                pass
+            total_size -= size
+
+    def clear(self):
+        """Removes all cached maps."""
+        for entry in os.scandir(self.cache_dir):
+            if entry.name.endswith('.png'):
+                os.remove(entry.path)
+
+
+def get_file_hash(file_path):
+    """Returns the SHA-256 hash (a hashlib object) of the bytes of a file, which identifies its contents regardless of its name or location."""
+    file_hash = hashlib.sha256()
+
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b''):
+            file_hash.update(chunk)
+
+    return file_hash
@@ -1,7 +1,32 @@
+import os
 import sys
 from PIL import Image
-from analyze import main as mm
+from PyQt5.QtCore import QThread
+from PyQt5.QtWidgets import QMessageBox
+from cache import AnalysisCache
+from imagecache import ImageCache, get_file_stat
 from observer import Observer
+from templates import TemplateLibrary
+from thumbnails import ThumbnailCache, get_folder
+from worker import AnalysisWorker, DecodeWorker, PrefetchWorker, ThumbnailWorker
+
+
+# Maximum dimension (width or height) of images when first displayed (see View.load_image)
+# JPEG images are opened by decoding a reduced resolution preview of (at least) this size, while the full resolution image is decoded in the background
+preview_size = 512
+
+# Extensions of the image files which can be opened (those of the "Open" dialog), and navigated to within the folder of the opened image
+image_extensions = ['bmp', 'gif', 'jpg', 'jpeg', 'png', 'pbm', 'pgm', 'ppm', 'xbm', 'xpm']
+
+# Number of images decoded in the background on each side of the opened image in its folder (see Controller.prefetch)
+prefetch_count = 2
+
+# Maximum memory used by prefetched and recently closed images (bytes, see imagecache.py)
+image_cache_size = 512 * 2 ** 20
+
+# Maximum disk space used by cached thumbnails (bytes, see thumbnails.py), and number of threads making them
+thumbnail_cache_size = 256 * 2 ** 20
+thumbnail_workers = 4
 
 
 class Controller(Observer):
@@ -14,6 +39,16 @@ class Controller(Observer):
     Attributes:
         model: The model for the image.
         view: The view for the image.
+        cache: The on-disk cache of manipulation maps, shared with batch analyses (see cache.py).
+        templates: The library of EM templates used to warm-start analyses of images from known cameras (see templates.py).
+        worker: The background thread running the current analysis (None if no analysis is running, see worker.py).
+        decoder: The background thread decoding the opened image at full resolution (None if not needed, see worker.py).
+        prefetcher: The background thread decoding the neighbours of the opened image in its folder (None if not running, see worker.py).
+        prefetch_paths: The neighbours of the opened image in its folder, in order of priority (i.e. of distance from the opened image, next images first).
+        image_cache: The memory-bounded cache of prefetched and recently closed images (see imagecache.py).
+        thumbnails: The persistent cache of the thumbnails displayed in the thumbnail strip (see thumbnails.py).
+        thumbnailer: The background thread making the missing thumbnails of the folder of the opened image (None if not needed, see worker.py).
+        workers: All analysis, decoding, prefetching and thumbnail threads which might still be running, including cancelled ones (their objects must be kept until their threads end).
     """
     def __init__(self, model, view):
         """Inits the class with the view and model."""
@@ -21,6 +56,16 @@ class Controller(Observer):
 
         self.model = model
         self.view = view
+        self.cache = AnalysisCache()
+        self.templates = TemplateLibrary()
+        self.worker = None
+        self.decoder = None
+        self.prefetcher = None
+        self.prefetch_paths = []
+        self.image_cache = ImageCache(image_cache_size)
+        self.thumbnails = ThumbnailCache(max_size=thumbnail_cache_size)
+        self.thumbnailer = None
+        self.workers = []
 
         self.update()
 
@@ -32,6 +77,7 @@ class Controller(Observer):
         if state == 'close':  # Close opened image
             self.close()
         if state == 'exit':  # Exit application
+            self.stop_workers()
             sys.exit()
         if state == 'save':  # Save image
             self.save()
@@ -39,6 +85,24 @@ class Controller(Observer):
             self.saveas()
         if state == 'analyze':  # Analyze image
             self.analyze()
+        if state == 'cancel_analysis':  # Stop running analysis
+            self.cancel_analysis()
+        if state == 'analysis_result':  # Display a manipulation map received from the analysis worker
+            self.load_analysis_result()
+        if state == 'analysis_end':  # Analysis worker done
+            self.end_analysis()
+        if state == 'decoded':  # Full resolution image received from the decoding worker
+            self.load_decoded_image()
+        if state == 'previous':  # Open the previous image in the folder
+            self.navigate(-1)
+        if state == 'next':  # Open the next image in the folder
+            self.navigate(1)
+        if state == 'prefetched':  # Neighbouring image received from the prefetching worker
+            self.load_prefetched_image()
+        if state == 'open_thumbnail':  # Open the image of a clicked thumbnail
+            self.open_thumbnail()
+        if state == 'thumbnails':  # Thumbnails received from the thumbnail worker
+            self.load_thumbnails()
 
     def get_main_window(self):
         """View (main window) getter."""
@@ -56,42 +120,130 @@ class Controller(Observer):
         # Load image and EXIF data
         # Only proceeds if a file has been chosen; if the user chose "Cancel" in the file dialog, or closed it, the program just returns to its previous state
         if image_path is not None:
-            # Get file name from the absolute image path
-            filename = image_path.split('/')
-            filename = filename[len(filename)-1]
+            self.open_path(image_path)
+        else:  # No image has been chosen
+            pass
+
+    def open_path(self, image_path, show_errors=True):
+        """Opens an image file, from the cache of prefetched and recently closed images if available (see prefetch and cache_image), then starts prefetching its neighbours in its folder
+        and displays the thumbnails of the folder (see show_thumbnails).
+
+        Returns whether the image has been opened; if it is not a valid image, an error message is shown (if show_errors is set).
+        """
+        # Get file name from the absolute image path
+        filename = image_path.split('/')
+        filename = filename[len(filename)-1]
 
-            # Check if the image is valid
+        # Check if the image is valid (cached images are valid, and already decoded)
+        decoded = self.image_cache.get(image_path)
+        if decoded is None:
             try:
                 image = Image.open(image_path)
             except IOError:
-                self.view.show_message_box(title='IEViewer', text='Could not open "{}". \nInvalid file or format not supported.'.format(filename))
-                return
+                if show_errors:
+                    self.view.show_message_box(title='IEViewer', text='Could not open "{}". \nInvalid file or format not supported.'.format(filename))
+                return False
 
-            # Close an image that has been already opened in the viewer (needed for correct display and EXIF data)
-            if self.model.image is not None:
-                self.view.close()
+        # Close an image that has been already opened in the viewer (needed for correct display and EXIF data)
+        if self.model.image is not None:
+            self.view.close()
 
-            # Update model and view
-            self.model.load_image(image, image_path)
+        # Update model and view (the thumbnail strip is shown first, so that the window is resized to fit it)
+        image_paths = get_folder_images(image_path)
+        if decoded is not None:  # Cached images are displayed at full resolution right away, from their already computed downsampled level (if any), along with their manipulation map (if analyzed)
+            self.model.load_decoded_image(decoded)
+            self.show_thumbnails(image_paths)
+            self.view.load_image(decoded.preview)
+        else:  # JPEG images are displayed as a reduced resolution preview at first, while the full resolution image is decoded in the background
+            self.model.load_image(image, image_path, preview_size)
+            self.show_thumbnails(image_paths)
             self.view.load_image()
 
-            return image
-        else:  # No image has been chosen
-            pass
+            if not self.model.full_resolution:
+                self.start_decoding()
+
+        self.prefetch(image_paths)
+
+        return True
+
+    def open_thumbnail(self):
+        """Opens the image whose thumbnail has been clicked (unless already opened)."""
+        image_path = self.view.selected_image
+
+        if self.model.image is not None and image_path == self.model.image_path:
+            return
+
+        self.open_path(image_path)
+
+    def navigate(self, step):
+        """Opens the next (step 1) or previous (step -1) image in the folder of the opened image, skipping invalid files.
+
+        The folder is listed again at each step, so that files added or removed in the meantime are taken into account.
+        """
+        if self.model.image is None:
+            return
+
+        image_paths = get_folder_images(self.model.image_path)
+        if self.model.image_path in image_paths:
+            index = image_paths.index(self.model.image_path) + step
+        else:  # The opened image has been removed or renamed: its position is that of the first image which follows it
+            index = sum(1 for p in image_paths if get_sort_key(p) < get_sort_key(self.model.image_path))
+            if step < 0:
+                index -= 1
+
+        while 0 <= index < len(image_paths):
+            if self.open_path(image_paths[index], show_errors=False):
+                return
+            index += step
+
+        self.view.show_progress('Last image in folder.' if step > 0 else 'First image in folder.')
 
     def close(self):
-        """Closes an image (model method wrapper)."""
+        """Closes an image (model method wrapper), stopping its analysis and the prefetching of its neighbours (if running).
+
+        The image is kept in the image cache (see cache_image), so that it is not decoded, processed or analyzed again if it is opened again soon (e.g. when comparing two images).
+        """
+        self.cache_image()
         self.model.close_image()
+        self.cancel_decoding()
+        self.cancel_prefetching()
+        self.cancel_analysis()
+
+    def cache_image(self):
+        """Stores the state of the opened image in the image cache (see ImageModel.get_decoded_image), as the most recently used image.
+
+        Its downsampled level for display is only stored if the image itself is displayed (and not its manipulation map), and its manipulation map only if its analysis is complete
+        (a running analysis is cancelled when the image is closed, and only the map of its first pass might have been received).
+        """
+        preview = None
+        if self.model.original_displayed and self.view.image_area.preview is not None:
+            preview = self.view.image_area.preview.toImage()
+
+        decoded = self.model.get_decoded_image(preview)
+        if decoded is None:
+            return
+
+        if self.worker is not None:
+            decoded.analyzed_image = None
+
+        self.image_cache.put(decoded)
 
     def save(self):
-        """Saves an image (model method wrapper)."""
-        self.model.image.save(self.model.filename)
+        """Saves an image (model method wrapper), overwriting the original file."""
+        if not self.model.can_save_losslessly(self.model.image_path):
+            self.decode_full_resolution()
+
+        self.model.save_image(self.model.image_path)
 
     def saveas(self):
         """Saves an image with a different name (mainly a model method wrapper)."""
         image_path, format = self.view.get_save_file_dialog(caption='Save As', filter='JPEG (*.jpg; *.jpeg);; PNG (*.png);; BMP (*.bmp);; PPM (*.ppm);; XBM (*.xbm);; XPM (*.xpm)')
         if image_path is not None:
-            self.model.modified_image.save(image_path + '.' + format)
+            image_path = image_path + '.' + format
+            if not self.model.can_save_losslessly(image_path):
+                self.decode_full_resolution()
+
+            self.model.save_image(image_path)
         else:
             pass
 
@@ -99,38 +251,280 @@ class Controller(Observer):
         """Analyzes the image to find photo manipulations using an EM algorithm.
 
         More details about how the algorithm works and its implementation can be found in the "About" section. Default parameters are used. Note that the original source code has been modified to fit into a single Python script.
+        The analysis runs in a background thread (see worker.py), so the interface stays responsive: its progress is shown in the status bar, and manipulation maps are displayed as soon as they are received (see load_analysis_result).
         """
-        # Original image
-        image_path = self.model.image_path
-        image = Image.open(image_path)  # Reload image using PIL (needed because model.image is a PyQt5 image)
-
-        # Generate manipulation map if non-existent
-        if self.model.analyzed_image is None:
-            # Original image parameters
-            width = image.width
-            height = image.height
-
-            # Get manipulation map
-            manipulation_map = Image.fromarray(mm(self.model.image_path))
+        # Generate manipulation map if non-existent (and not already being generated)
+        if self.model.analyzed_image is None and self.worker is None:
+            # Camera of the image (for warm-starting the analysis)
+            camera = None
+            if self.model.exif_data is not None:
+                camera = (self.model.exif_data.get('Make'), self.model.exif_data.get('Model'))
 
-            # Create new image
-            analyzed_image = Image.new('RGBA', (width, height))
-            analyzed_image.paste(manipulation_map, (0, 0))
+            # Start the analysis
+            # The analysis is progressive: a rough map is displayed as soon as possible, then replaced by the full resolution one
+            # (instantly, if the same file has already been analyzed)
+            # The worker analyzes the pixels already decoded for display, instead of reading the file again
+            self.decode_full_resolution()
+            self.worker = AnalysisWorker(self.model.image_path, img=self.model.pixels, rgb=True, cache=self.cache, templates=self.templates, camera=camera)
+            self.worker.progress.connect(self.view.show_progress)
+            self.worker.result.connect(self.view.receive_analysis_result)
+            self.worker.ended.connect(self.view.receive_analysis_end)
+            self.worker.finished.connect(self.release_workers)
+            self.workers.append(self.worker)
 
-            # Store analyzed image
-            self.model.analyzed_image = analyzed_image
-
-            # Update model and view
-            self.model.load_image(analyzed_image, image_path)
-            self.model.manipulation_flag = True
-            self.view.load_image()
+            self.view.set_analysis_running(True)
+            self.view.show_progress('Analyzing image...')
+            self.worker.start()
 
         # Otherwise, load existing map
-        elif self.model.analyzed_image is not None and not self.view.menu_bar.menus['view']['analyze'].isChecked():
+        elif not self.view.menu_bar.menus['view']['analyze'].isChecked():
             # Update model and view
-            self.model.load_image(image, self.model.image_path)
+            self.model.display_pixels(self.model.pixels)
             self.view.load_image()
-        else:
+        elif self.model.analyzed_image is not None:
             # Update model and view
-            self.model.load_image(self.model.analyzed_image, self.model.image_path)
+            self.model.display_pixels(self.model.analyzed_image)
             self.view.load_image()
+
+    def load_analysis_result(self):
+        """Stores a manipulation map received from the analysis worker, and displays it (unless the user has switched back to the original image)."""
+        worker, stride, output_map = self.view.analysis_result
+
+        if worker is not self.worker:  # Result of a cancelled analysis
+            return
+
+        # Store analyzed image (displayed as a grayscale image, without copying it)
+        self.model.analyzed_image = output_map
+        self.model.manipulation_flag = True
+
+        # Update model and view
+        if self.view.menu_bar.menus['view']['analyze'].isChecked():
+            self.model.display_pixels(output_map)
+            self.view.load_image()
+
+    def start_decoding(self):
+        """Starts decoding the opened image at full resolution in the background."""
+        self.decoder = DecodeWorker(self.model.image_path)
+        self.decoder.decoded.connect(self.view.receive_decoded_image)
+        self.decoder.finished.connect(self.release_workers)
+        self.workers.append(self.decoder)
+
+        self.decoder.start()
+
+    def load_decoded_image(self):
+        """Replaces the displayed preview with the full resolution image received from the decoding worker."""
+        worker, pixels = self.view.decoded_image
+
+        if worker is not self.decoder:  # Decoded image of a closed image (or already loaded, see decode_full_resolution)
+            return
+
+        self.decoder = None
+
+        if pixels is not None:  # Otherwise the preview is kept, and decoding is retried when needed
+            self.model.set_full_pixels(pixels)
+            self.view.refresh_image()
+
+    def decode_full_resolution(self):
+        """Makes sure that the opened image has been decoded at full resolution (needed to analyze it or re-encode it), waiting for the decoding worker if needed."""
+        if self.model.full_resolution:
+            return
+
+        if self.decoder is not None:
+            self.decoder.wait()
+            if self.decoder.pixels is not None:
+                self.model.set_full_pixels(self.decoder.pixels)
+            self.decoder = None
+
+        self.model.load_full_resolution()  # Only if decoding failed in the background
+        self.view.refresh_image()
+
+    def cancel_decoding(self):
+        """Discards the full resolution image being decoded in the background (if any)."""
+        if self.decoder is not None:
+            self.decoder.cancel()
+            self.decoder = None
+
+    def prefetch(self, image_paths):
+        """Starts decoding the neighbours of the opened image in its folder (given its images, see get_folder_images; prefetch_count on each side, nearest first)
+        in the background, unless already cached.
+
+        Neighbours are marked as recently used in the cache, nearest last, so that they are the last images to be evicted; images which are no longer neighbours are evicted first.
+        """
+        self.cancel_prefetching()
+
+        if self.model.image_path not in image_paths:
+            self.prefetch_paths = []
+            return
+
+        index = image_paths.index(self.model.image_path)
+        self.prefetch_paths = []
+        for i in range(1, prefetch_count + 1):
+            self.prefetch_paths += [image_paths[j] for j in (index + i, index - i) if 0 <= j < len(image_paths)]
+
+        self.touch_neighbours(self.prefetch_paths)
+
+        missing_paths = [p for p in self.prefetch_paths if self.image_cache.get(p) is None]
+        if missing_paths:
+            self.prefetcher = PrefetchWorker(missing_paths)
+            self.prefetcher.prefetched.connect(self.view.receive_prefetched_image)
+            self.prefetcher.finished.connect(self.release_workers)
+            self.workers.append(self.prefetcher)
+
+            self.prefetcher.start(QThread.LowPriority)  # The opened image (and its own decoding) comes first
+
+    def load_prefetched_image(self):
+        """Stores a neighbouring image received from the prefetching worker in the cache.
+
+        Prefetching stops as soon as the cache cannot hold the image along with the opened image and all nearer neighbours, so that they are never evicted in favour of farther ones.
+        """
+        worker, decoded = self.view.prefetched_image
+
+        if worker is not self.prefetcher:  # Neighbour of a closed image
+            return
+
+        nearer_paths = self.prefetch_paths[:self.prefetch_paths.index(decoded.image_path)]
+        if self.image_cache.get_total_size(nearer_paths + [self.model.image_path]) + decoded.get_size() > self.image_cache.max_size:
+            self.cancel_prefetching()
+            return
+
+        self.image_cache.put(decoded)
+        self.touch_neighbours(nearer_paths)
+
+    def touch_neighbours(self, image_paths):
+        """Marks the given neighbours (in order of priority) and then the opened image as recently used in the cache."""
+        for image_path in reversed(image_paths):
+            self.image_cache.touch(image_path)
+        self.image_cache.touch(self.model.image_path)
+
+    def cancel_prefetching(self):
+        """Stops decoding the neighbours of the opened image (if running); images already decoded stay cached."""
+        if self.prefetcher is not None:
+            self.prefetcher.cancel()
+            self.prefetcher = None
+
+    def show_thumbnails(self, image_paths):
+        """Displays the thumbnails of the images in the folder of the opened image (given its images, see get_folder_images), selecting the opened image.
+
+        Only the file stats of the images and the list of cached thumbnails of the folder are read here (thumbnails themselves are read when displayed, see widgets.ThumbnailListModel);
+        missing (or outdated) thumbnails are made in the background, starting from those nearest to the opened image.
+        The thumbnails are not loaded again while the images of the folder stay the same (e.g. while navigating through it).
+        """
+        if image_paths != self.view.thumbnail_strip.get_image_paths():
+            self.cancel_thumbnails()
+
+            file_stats = [get_file_stat(p) for p in image_paths]
+            cached = self.thumbnails.get_folder(get_folder(self.model.image_path))
+            self.view.set_thumbnails(image_paths, file_stats, self.thumbnails)
+
+            missing = [(p, file_stat) for p, file_stat in zip(image_paths, file_stats) if file_stat is not None and cached.get(p) != file_stat]
+            if missing:
+                index = image_paths.index(self.model.image_path) if self.model.image_path in image_paths else 0
+                rows = {p: i for i, p in enumerate(image_paths)}
+                missing.sort(key=lambda m: abs(rows[m[0]] - index))
+
+                self.thumbnailer = ThumbnailWorker(missing, thumbnail_workers)
+                self.thumbnailer.generated.connect(self.view.receive_thumbnails)
+                self.thumbnailer.finished.connect(self.release_workers)
+                self.workers.append(self.thumbnailer)
+
+                self.thumbnailer.start(QThread.LowPriority)
+
+        self.view.select_thumbnail(self.model.image_path)
+
+    def load_thumbnails(self):
+        """Stores a batch of thumbnails received from the thumbnail worker in the thumbnail cache, and displays them."""
+        worker, thumbnails = self.view.generated_thumbnails
+
+        if worker is not self.thumbnailer:  # Thumbnails of another folder
+            return
+
+        self.thumbnails.put(thumbnails)
+        self.view.thumbnail_strip.update_thumbnails([path for path, file_stat, data in thumbnails])
+
+    def cancel_thumbnails(self):
+        """Stops making the thumbnails of the folder of the opened image (if running); thumbnails already made stay cached."""
+        if self.thumbnailer is not None:
+            self.thumbnailer.cancel()
+            self.thumbnailer = None
+
+    def cancel_analysis(self):
+        """Stops the running analysis (if any) at its next stage or EM iteration boundary.
+
+        The analysis is considered ended immediately, without waiting for its thread (whose results are ignored from now on).
+        """
+        if self.worker is None:
+            return
+
+        self.worker.cancel()
+        self.end_analysis(self.worker, 'cancelled', '')
+
+    def release_workers(self):
+        """Releases the analysis threads which have ended."""
+        self.workers = [w for w in self.workers if not w.isFinished()]
+
+    def stop_workers(self):
+        """Stops all analysis, decoding, prefetching and thumbnail threads and waits for them to end (needed before exiting the application)."""
+        for w in self.workers:
+            w.cancel()
+        for w in self.workers:
+            w.wait()
+
+        self.workers = []
+        self.worker = None
+        self.decoder = None
+        self.prefetcher = None
+        self.thumbnailer = None
+
+    def end_analysis(self, worker=None, status=None, message=None):
+        """Handles the end of an analysis (received from its worker, unless given).
+
+        Cancelled or failed analyses leave no manipulation map behind, so that the image is analyzed again the next time the user requests it.
+        """
+        if worker is None:
+            worker, status, message = self.view.analysis_end
+
+        if worker is not self.worker:  # Already handled (i.e. cancelled)
+            return
+
+        self.worker = None
+        self.view.set_analysis_running(False)
+
+        if status == 'done':
+            self.view.show_progress('Analysis complete.')
+        else:
+            # Discard any preview map and switch back to the original image
+            self.model.analyzed_image = None
+            self.model.manipulation_flag = False
+            self.view.menu_bar.menus['view']['analyze'].setChecked(False)
+
+            if self.model.image is not None:  # The image is still open
+                self.model.display_pixels(self.model.pixels)
+                self.view.load_image()
+
+            if status == 'cancelled':
+                self.view.show_progress('Analysis cancelled.')
+            else:
+                self.view.show_progress('Analysis failed.')
+                self.view.show_message_box(title='IEViewer', text='Could not analyze "{}". \n{}'.format(self.model.filename, message), icon=QMessageBox.Warning)
+
+
+def get_folder_images(image_path):
+    """Returns the paths of the image files (see image_extensions) in the folder of an image, sorted by name (case-insensitively).
+
+    Paths are built with forward slashes (as returned by Qt file dialogs, on all platforms), so that they can be compared with the path of the opened image.
+    """
+    folder = get_folder(image_path)
+
+    try:
+        filenames = os.listdir(folder)
+    except OSError:  # The folder has been removed
+        return []
+
+    image_paths = [folder + '/' + f for f in filenames if '.' in f and f.split('.')[-1].lower() in image_extensions]
+
+    return sorted(image_paths, key=get_sort_key)
+
+
+def get_sort_key(image_path):
+    """Returns the key by which the images of a folder are sorted (see get_folder_images)."""
+    return image_path.lower(), image_path
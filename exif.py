@@ -0,0 +1,253 @@
+import io
+from PIL import ExifTags, Image
+
+
+# Global parameters
+
+# EXIF Orientation tag, and its values for clockwise rotations of the stored image (mirrored orientations are not used)
+# See: https://exiftool.org/TagNames/EXIF.html
+orientation_tag = 0x0112
+rotation_orientations = {0: 1, 90: 6, 180: 3, 270: 8}
+orientation_rotations = {v: k for k, v in rotation_orientations.items()}
+
+# Tags pointing to the EXIF sub-IFDs (Exif and GPS)
+exif_ifd_tag = 0x8769
+gps_ifd_tag = 0x8825
+
+# GPS tag names, indexed by tag number
+# See: https://exiftool.org/TagNames/GPS.html
+gps_tag_names = ['GPSVersionID', 'GPSLatitudeRef', 'GPSLatitude', 'GPSLongitudeRef', 'GPSLongitude', 'GPSAltitudeRef', 'GPSAltitude', 'GPSTimeStamp',
+                 'GPSSatellites', 'GPSStatus', 'GPSMeasureMode', 'GPSDOP', 'GPSSpeedRef', 'GPSSpeed', 'GPSTrackRef', 'GPSTrack',
+                 'GPSImgDirectionRef', 'GPSImgDirection', 'GPSMapDatum', 'GPSDestLatitudeRef', 'GPSDestLatitude', 'GPSDestLongitudeRef', 'GPSDestLongitude', 'GPSDestBearingRef',
+                 'GPSDestBearing', 'GPSDestDistanceRef', 'GPSDestDistance', 'GPSProcessingMethod', 'GPSAreaInformation', 'GPSDateStamp', 'GPSDifferential', 'GPSHPositioningError']
+
+# JPEG markers
+jpeg_soi = b'\xff\xd8'  # Start of image
+jpeg_app0 = 0xE0  # JFIF header (which must be the first segment, if present)
+jpeg_app1 = 0xE1  # EXIF data
+jpeg_sos = 0xDA  # Start of scan (followed by the compressed image data)
+jpeg_eoi = 0xD9  # End of image
+exif_header = b'Exif\x00\x00'
+
+
+# TAGS
+
+# Return the EXIF data of an opened PIL image (PIL's Image.Exif) read from its headers only, without decoding its pixels
+# PIL's getexif decodes PNG images whose EXIF data has not been found before their image data (as an eXIf chunk might also follow it):
+# for PNG images, only an eXIf chunk preceding the image data is read (which is where PIL, among others, writes it)
+def get_header_exif(image):
+    if image.format != 'PNG':
+        return image.getexif()
+
+    exif = Image.Exif()
+    if 'exif' in image.info:
+        exif.load(image.info['exif'])
+
+    return exif
+
+
+# Return all tags of an EXIF object (PIL's Image.Exif, read from the image header) as a dictionary indexed by tag name, including the tags of the Exif sub-IFD
+# GPS tags are returned as a dictionary indexed by tag number, under 'GPSInfo' (i.e. the result is the same as PIL's _getexif, with tag names)
+def get_exif_dict(exif):
+    tags = dict(exif)
+    tags.update(exif.get_ifd(exif_ifd_tag))
+    if gps_ifd_tag in exif:
+        tags[gps_ifd_tag] = exif.get_ifd(gps_ifd_tag)
+
+    return {ExifTags.TAGS[k]: v for k, v in tags.items() if k in ExifTags.TAGS}
+
+
+# GPS
+
+# Return the value of a rational EXIF value, given either as a number (e.g. PIL's IFDRational) or as a (numerator, denominator) pair (as returned by some PIL versions)
+# Zero denominators give NaN
+def get_rational_value(value):
+    if isinstance(value, (tuple, list)):
+        numerator, denominator = value
+        return numerator / denominator if denominator != 0 else float('nan')
+
+    return float(value)
+
+
+# Return the GPS tags of a GPSInfo dictionary (indexed by tag number, see get_exif_dict) indexed by tag name, in tag number order
+def get_gps_tags(gps_info):
+    return {gps_tag_names[k]: v for k, v in sorted(gps_info.items()) if isinstance(k, int) and 0 <= k < len(gps_tag_names) and v is not None}
+
+
+# Format a GPS coordinate (degrees, minutes and seconds, each either a number or a rational pair) and its reference (N, S, E or W) as text, e.g. 45°30'12.5"N
+def format_gps_coordinate(dms, ref):
+    degrees, minutes, seconds = (get_rational_value(v) for v in dms)
+
+    return str(int(degrees)) + '°' + str(int(minutes)) + '\'' + str(seconds) + '\"' + ref
+
+
+# Build a Google Maps link for the specified GPS location
+# Coordinates are formatted the same way whatever the format of their values (see get_rational_value), i.e. whatever the PIL version and however the program has been started
+def build_gmaps_link(lat, lat_ref, lon, lon_ref):
+    return 'https://www.google.com/maps/place/' + format_gps_coordinate(lat, lat_ref) + '+' + format_gps_coordinate(lon, lon_ref)
+
+
+# Return the location of named GPS tags (see get_gps_tags) as decimal degrees (latitude, longitude; negative south and west), or None if they have no valid location
+def get_gps_coordinates(gps_tags):
+    try:
+        coordinates = []
+        for key, negative_ref in (('GPSLatitude', 'S'), ('GPSLongitude', 'W')):
+            degrees, minutes, seconds = (get_rational_value(v) for v in gps_tags[key])
+            value = degrees + minutes / 60 + seconds / 3600
+            coordinates.append(-value if gps_tags[key + 'Ref'] == negative_ref else value)
+    except (KeyError, TypeError, ValueError):
+        return None
+
+    latitude, longitude = coordinates
+    if not (-90 <= latitude <= 90 and -180 <= longitude <= 180):  # Also excludes NaN
+        return None
+
+    return latitude, longitude
+
+
+# Return a copy of EXIF data (see get_exif_dict) in which the GPSInfo dictionary is replaced by named GPS tags, preceded by a link to the GPS location (GPSLocation), if known
+# Return None if there is no GPS data
+def process_gps_data(exif_data):
+    gps_info = exif_data.get('GPSInfo')
+    if not isinstance(gps_info, dict):  # No GPS EXIF data available
+        return None
+
+    gps_tags = get_gps_tags(gps_info)
+
+    exif_data_updated = {}  # Contains the original EXIF data + the new GPS EXIF data
+    if all(key in gps_tags for key in ('GPSLatitude', 'GPSLatitudeRef', 'GPSLongitude', 'GPSLongitudeRef')):
+        exif_data_updated['GPSLocation'] = build_gmaps_link(gps_tags['GPSLatitude'], gps_tags['GPSLatitudeRef'], gps_tags['GPSLongitude'], gps_tags['GPSLongitudeRef'])
+    exif_data_updated.update(gps_tags)
+    exif_data_updated.update((k, v) for k, v in exif_data.items() if k != 'GPSInfo')
+
+    return exif_data_updated
+
+
+# ORIENTATION
+
+# Return the clockwise rotation (degrees) described by an EXIF orientation value (0 for missing, mirrored or invalid values)
+def get_orientation_rotation(orientation):
+    return orientation_rotations.get(orientation, 0)
+
+
+# Return the EXIF orientation value describing a clockwise rotation (degrees), or None if it cannot be described by one (i.e. it is not a multiple of 90 degrees)
+def get_rotation_orientation(rotation):
+    return rotation_orientations.get(rotation % 360)
+
+
+# JPEG SEGMENTS
+
+# Iterate over the segments of a JPEG file (bytes) preceding its compressed image data, yielding the marker, start and end offsets of each segment (marker included)
+# Raise ValueError if the data is not a valid JPEG file
+def get_jpeg_segments(data):
+    if data[:2] != jpeg_soi:
+        raise ValueError('Not a JPEG file.')
+
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            raise ValueError('Invalid JPEG segment.')
+
+        marker = data[pos + 1]
+        if marker == 0xFF:  # Fill byte
+            pos += 1
+            continue
+        if marker in (jpeg_sos, jpeg_eoi):
+            return
+
+        end = pos + 2 + int.from_bytes(data[pos + 2:pos + 4], 'big')
+        if end > len(data):
+            raise ValueError('Truncated JPEG segment.')
+
+        yield marker, pos, end
+        pos = end
+
+    raise ValueError('Truncated JPEG file.')
+
+
+# Return the start and end offsets of the EXIF segment of a JPEG file (bytes), or None if it has none
+def get_exif_segment(data):
+    for marker, start, end in get_jpeg_segments(data):
+        if marker == jpeg_app1 and data[start + 4:start + 10] == exif_header:
+            return start, end
+
+    return None
+
+
+# Return the offset of the Orientation value in the EXIF segment of a JPEG file (bytes) and its byte order, or None if the first IFD of the segment has no (valid) Orientation tag
+def find_orientation(data, segment):
+    start, end = segment
+    tiff = start + 10  # TIFF header (offsets in the EXIF data are relative to it)
+
+    byte_order = {b'II': 'little', b'MM': 'big'}.get(data[tiff:tiff + 2])
+    if byte_order is None:
+        raise ValueError('Invalid EXIF data.')
+
+    ifd = tiff + int.from_bytes(data[tiff + 4:tiff + 8], byte_order)
+    if ifd + 2 > end:
+        raise ValueError('Invalid EXIF data.')
+
+    for i in range(int.from_bytes(data[ifd:ifd + 2], byte_order)):
+        entry = ifd + 2 + 12 * i  # Tag (2 bytes), type (2), count (4), value (4)
+        if entry + 12 > end:
+            raise ValueError('Invalid EXIF data.')
+
+        if int.from_bytes(data[entry:entry + 2], byte_order) == orientation_tag:
+            # Orientation is a single SHORT (type 3), stored in the first two bytes of the value field
+            if int.from_bytes(data[entry + 2:entry + 4], byte_order) == 3 and int.from_bytes(data[entry + 4:entry + 8], byte_order) == 1:
+                return entry + 8, byte_order
+            return None
+
+    return None
+
+
+# Return a copy of a JPEG file (bytes) with the given EXIF orientation, without decoding (or re-encoding) its image data
+# The Orientation tag is rewritten in place if it exists (leaving all other EXIF data untouched); otherwise the EXIF segment is rebuilt (or created) with it
+# Raise ValueError if the data is not a valid JPEG file, or its EXIF data cannot be rewritten
+def set_jpeg_orientation(data, orientation):
+    segment = get_exif_segment(data)
+
+    if segment is not None:
+        value = find_orientation(data, segment)
+        if value is not None:
+            offset, byte_order = value
+            return data[:offset] + orientation.to_bytes(2, byte_order) + data[offset + 2:]
+
+    if segment is None and orientation == 1:  # No EXIF data means the default orientation
+        return data
+
+    # Rebuild the EXIF segment with the Orientation tag (PIL only reads the headers of the file here, not its image data)
+    exif = Image.open(io.BytesIO(data)).getexif()
+    exif[orientation_tag] = orientation
+    payload = exif.tobytes()
+    if not payload.startswith(exif_header) or len(payload) + 2 > 0xFFFF:
+        raise ValueError('EXIF data too large to be rewritten.')
+    new_segment = bytes([0xFF, jpeg_app1]) + (len(payload) + 2).to_bytes(2, 'big') + payload
+
+    if segment is not None:  # Replace the existing EXIF segment
+        start, end = segment
+        return data[:start] + new_segment + data[end:]
+
+    # Insert a new EXIF segment right after the JFIF header (if any)
+    pos = 2
+    for marker, start, end in get_jpeg_segments(data):
+        if marker == jpeg_app0:
+            pos = end
+        break
+
+    return data[:pos] + new_segment + data[pos:]
+
+
+# Save a rotated copy of a JPEG file losslessly, by only rewriting its EXIF orientation (its image data is neither decoded nor re-encoded)
+# The rotation (clockwise, in degrees) must be a multiple of 90 degrees, relative to the stored image (i.e. ignoring the file's current orientation)
+# Raise ValueError if the rotation cannot be saved this way, or the file is not a valid JPEG file (in which case nothing is written)
+def save_rotated_jpeg(src_path, dst_path, rotation):
+    orientation = get_rotation_orientation(rotation)
+    if orientation is None:
+        raise ValueError('Only rotations by multiples of 90 degrees can be saved losslessly.')
+
+    with open(src_path, 'rb') as f:
+        data = set_jpeg_orientation(f.read(), orientation)
+
+    with open(dst_path, 'wb') as f:
+        f.write(data)
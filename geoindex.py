@@ -0,0 +1,239 @@
+import json
+import math
+import os
+import sqlite3
+import sys
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from analyze import get_image_paths
+from metadata import chunk_size, read_metadata
+
+
+# Global parameters
+
+# Mean Earth radius (km)
+earth_radius = 6371.0088
+
+# Size of the cells of the spatial grid (degrees of latitude and longitude, i.e. about 1.1 km of latitude)
+cell_size = 0.01
+grid_rows = int(round(180 / cell_size))
+grid_columns = int(round(360 / cell_size))
+
+
+class GeoIndex():
+    """Persistent spatial index of the GPS locations of a photo library.
+
+    Photo locations (decimal degrees, see exif.get_gps_coordinates) are stored in an SQLite database along with the grid cell containing them
+    (a cell_size x cell_size degrees grid, indexed by a B-tree): a radius query only reads the cells overlapping its bounding box,
+    a few contiguous ranges of cell numbers per grid row, and then computes the exact (great-circle) distance of the photos they contain.
+    The index is built incrementally: only new or modified files (according to their size and modification time) are read, and only their headers (see metadata.py).
+    Photos without a GPS location are indexed too, so that they are not read again.
+
+    Attributes:
+        path: The path of the SQLite database containing the index.
+        connection: The connection to the database.
+    """
+    def __init__(self, path=None):
+        """Inits the class."""
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.ieviewer', 'geoindex.sqlite')
+
+        self.path = path
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS photos (path TEXT PRIMARY KEY, mtime_ns INTEGER, size INTEGER, latitude REAL, longitude REAL, cell INTEGER)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS photos_cell ON photos (cell)')
+        self.connection.commit()
+
+    def close(self):
+        """Closes the connection to the database."""
+        self.connection.close()
+
+    def update(self, source, workers=None):
+        """Indexes all images from a source (see analyze.get_image_paths; directories are searched recursively), reading only new or modified files in a pool of worker processes.
+
+        Photos of a directory which no longer exist are removed from the index. Returns the number of read, unchanged and removed files.
+        """
+        paths = [os.path.abspath(p) for p in get_image_paths(source, recursive=True)]
+        indexed = {path: (mtime_ns, size) for path, mtime_ns, size in self.connection.execute('SELECT path, mtime_ns, size FROM photos')}
+
+        # Files to read (new or modified)
+        stats = {}
+        for path in paths:
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if indexed.get(path) != (stat.st_mtime_ns, stat.st_size):
+                stats[path] = (stat.st_mtime_ns, stat.st_size)
+
+        # Read and index them
+        if stats:
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                for record in executor.map(read_metadata, list(stats), chunksize=chunk_size):
+                    mtime_ns, size = stats[record['path']]
+                    self.put(record['path'], mtime_ns, size, record.get('latitude'), record.get('longitude'))
+
+        # Remove deleted files
+        removed = 0
+        if os.path.isdir(source):
+            existing = set(paths)
+            prefix = os.path.join(os.path.abspath(source), '')
+            deleted = [path for path in indexed if path.startswith(prefix) and path not in existing]
+            self.connection.executemany('DELETE FROM photos WHERE path = ?', [(path,) for path in deleted])
+            removed = len(deleted)
+
+        self.connection.commit()
+
+        return len(stats), len(paths) - len(stats), removed
+
+    def put(self, path, mtime_ns, size, latitude, longitude):
+        """Adds (or replaces) a photo in the index (its location can be None); changes are saved by update."""
+        cell = get_cell(latitude, longitude) if latitude is not None and longitude is not None else None
+
+        self.connection.execute('INSERT OR REPLACE INTO photos VALUES (?, ?, ?, ?, ?, ?)', (path, mtime_ns, size, latitude, longitude, cell))
+
+    def get_location(self, path):
+        """Returns the indexed location of a photo as (latitude, longitude), or None if it is not indexed or has no location."""
+        row = self.connection.execute('SELECT latitude, longitude FROM photos WHERE path = ?', (os.path.abspath(path),)).fetchone()
+
+        if row is None or row[0] is None:
+            return None
+
+        return row
+
+    def within(self, latitude, longitude, radius, limit=None):
+        """Returns the photos within radius km of a location, as (path, latitude, longitude, distance in km) tuples sorted by distance (at most limit, if given)."""
+        results = []
+
+        for cell_range in get_cell_ranges(latitude, longitude, radius):
+            for path, lat, lon in self.connection.execute('SELECT path, latitude, longitude FROM photos WHERE cell BETWEEN ? AND ?', cell_range):
+                distance = get_distance(latitude, longitude, lat, lon)
+                if distance <= radius:
+                    results.append((path, lat, lon, distance))
+
+        results.sort(key=lambda r: (r[3], r[0]))
+
+        return results[:limit] if limit is not None else results
+
+    def near(self, path, radius, limit=None):
+        """Returns the photos within radius km of a photo (excluding itself, see within), which is read if it is not indexed; None if it has no location."""
+        location = self.get_location(path)
+        if location is None:
+            record = read_metadata(path)
+            location = record.get('latitude'), record.get('longitude')
+            if location[0] is None:
+                return None
+
+        path = os.path.abspath(path)
+        results = [r for r in self.within(location[0], location[1], radius) if r[0] != path]
+
+        return results[:limit] if limit is not None else results
+
+    def count(self):
+        """Returns the number of indexed photos, and of those with a location."""
+        return self.connection.execute('SELECT COUNT(*), COUNT(cell) FROM photos').fetchone()
+
+
+# Great-circle distance (km) between two locations (decimal degrees), computed with the haversine formula
+def get_distance(lat1, lon1, lat2, lon2):
+    lat1, lon1, lat2, lon2 = (math.radians(v) for v in (lat1, lon1, lat2, lon2))
+    h = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+
+    return 2 * earth_radius * math.asin(min(1.0, math.sqrt(h)))
+
+
+# Grid row and column of a latitude and longitude
+def get_grid_position(latitude, longitude):
+    row = min(int((latitude + 90) / cell_size), grid_rows - 1)
+    column = min(int((longitude + 180) / cell_size), grid_columns - 1)
+
+    return row, column
+
+
+# Grid cell number of a location (cells are numbered row by row, from south to north and from west to east)
+def get_cell(latitude, longitude):
+    row, column = get_grid_position(latitude, longitude)
+
+    return row * grid_columns + column
+
+
+# Ranges of grid cell numbers (first and last cell) covering the bounding box of a circle of given radius (km) around a location
+# Each grid row of the box is covered by one range, or by two if the box crosses the antimeridian
+def get_cell_ranges(latitude, longitude, radius):
+    angle = radius / earth_radius  # Angular radius (radians)
+    lat_min = max(-90.0, latitude - math.degrees(angle))
+    lat_max = min(90.0, latitude + math.degrees(angle))
+
+    # Longitude span of the circle (the whole parallel if it contains a pole)
+    lon_ranges = [(-180.0, 180.0)]
+    if lat_min > -90 and lat_max < 90:
+        ratio = math.sin(angle) / math.cos(math.radians(latitude))
+        if angle < math.pi / 2 and ratio < 1:
+            delta = math.degrees(math.asin(ratio))
+            lon_min, lon_max = longitude - delta, longitude + delta
+            if lon_min < -180:
+                lon_ranges = [(lon_min + 360, 180.0), (-180.0, lon_max)]
+            elif lon_max > 180:
+                lon_ranges = [(lon_min, 180.0), (-180.0, lon_max - 360)]
+            else:
+                lon_ranges = [(lon_min, lon_max)]
+
+    row_min, _ = get_grid_position(lat_min, 0)
+    row_max, _ = get_grid_position(lat_max, 0)
+
+    ranges = []
+    for row in range(row_min, row_max + 1):
+        for lon_min, lon_max in lon_ranges:
+            _, column_min = get_grid_position(0, lon_min)
+            _, column_max = get_grid_position(0, lon_max)
+            ranges.append((row * grid_columns + column_min, row * grid_columns + column_max))
+
+    return ranges
+
+
+# COMMAND LINE
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='python -m geoindex', description='Persistent spatial index of the GPS locations of a photo library.')
+    parser.add_argument('--index', default=None, help='index file (default: ~/.ieviewer/geoindex.sqlite)')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    update_parser = subparsers.add_parser('update', help='index (or update the index of) a directory tree, glob pattern or list file of images')
+    update_parser.add_argument('source', help='directory (searched recursively), glob pattern (quoted) or text file with one image path per line')
+    update_parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+
+    within_parser = subparsers.add_parser('within', help='list the photos within a radius of a location')
+    within_parser.add_argument('latitude', type=float, help='latitude (decimal degrees, negative south)')
+    within_parser.add_argument('longitude', type=float, help='longitude (decimal degrees, negative west)')
+    within_parser.add_argument('-r', '--radius', type=float, default=1.0, help='radius (km, default: 1)')
+    within_parser.add_argument('-n', '--limit', type=int, default=None, help='maximum number of photos (the nearest ones)')
+
+    near_parser = subparsers.add_parser('near', help='list the photos within a radius of a photo')
+    near_parser.add_argument('path', help='image path')
+    near_parser.add_argument('-r', '--radius', type=float, default=1.0, help='radius (km, default: 1)')
+    near_parser.add_argument('-n', '--limit', type=int, default=None, help='maximum number of photos (the nearest ones)')
+
+    args = parser.parse_args()
+
+    geo_index = GeoIndex(args.index)
+
+    if args.command == 'update':
+        n_read, n_unchanged, n_removed = geo_index.update(args.source, args.workers)
+        n_photos, n_located = geo_index.count()
+        print('Read {} files ({} unchanged, {} removed); {} photos indexed, {} with a GPS location.'.format(n_read, n_unchanged, n_removed, n_photos, n_located), file=sys.stderr)
+    else:
+        if args.command == 'within':
+            photos = geo_index.within(args.latitude, args.longitude, args.radius, args.limit)
+        else:
+            photos = geo_index.near(args.path, args.radius, args.limit)
+            if photos is None:
+                geo_index.close()
+                sys.exit('"{}" has no GPS location.'.format(args.path))
+
+        for photo_path, photo_latitude, photo_longitude, photo_distance in photos:
+            print(json.dumps({'path': photo_path, 'latitude': photo_latitude, 'longitude': photo_longitude, 'distance': photo_distance}))
+
+    geo_index.close()
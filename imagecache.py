@@ -0,0 +1,131 @@
+import os
+from collections import OrderedDict
+
+
+class DecodedImage():
+    """An image file decoded ahead of time (e.g. by the prefetcher, see worker.py), or the state of an image kept after being closed (see ImageModel.get_decoded_image),
+    holding everything needed to display it without reading the file again.
+
+    Attributes:
+        image_path: The path of the image file.
+        file_stat: The size and modification time of the file when it was decoded (see get_file_stat).
+        image_format: The format of the image file, as detected by PIL (e.g. 'JPEG').
+        pixels: The decoded pixels of the image at full resolution (NumPy array, see model.get_pixels).
+        preview: The downsampled level of the image used by the image widget for rescaling (QImage, see widgets.get_preview_image), or None if not computed.
+        orientation_rotation: The clockwise rotation described by the EXIF orientation of the image (degrees).
+        exif_data: The processed EXIF data of the image (see model.get_exif_data), or None if it has none (or if it has not been processed yet).
+        exif_source: The unprocessed EXIF data of the image (see model.get_exif_source), if it has not been processed yet (None otherwise).
+        analyzed_image: The manipulation map of the image (NumPy array, grayscale), or None if it has not been analyzed.
+    """
+    def __init__(self, image_path, file_stat, image_format, pixels, orientation_rotation=0, exif_data=None, exif_source=None, analyzed_image=None):
+        """Inits the class."""
+        self.image_path = image_path
+        self.file_stat = file_stat
+        self.image_format = image_format
+        self.pixels = pixels
+        self.preview = None
+        self.orientation_rotation = orientation_rotation
+        self.exif_data = exif_data
+        self.exif_source = exif_source
+        self.analyzed_image = analyzed_image
+
+    def get_size(self):
+        """Returns the memory used by the decoded pixels, the preview and the manipulation map (bytes); EXIF data is negligible in comparison."""
+        size = self.pixels.nbytes
+
+        if self.analyzed_image is not None:
+            size += self.analyzed_image.nbytes
+
+        if self.preview is not None:
+            size += self.preview.bytesPerLine() * self.preview.height()
+
+        return size
+
+
+class ImageCache():
+    """In-memory, least recently used cache of decoded images (see DecodedImage), i.e. of prefetched and recently closed images, indexed by file path and bounded by their total size in bytes.
+
+    Entries are only valid as long as their files do not change: each lookup checks the size and modification time of the file, and discards stale entries.
+    The cache is meant to be used from the GUI thread only (worker threads send their decoded images to it through Qt signals).
+
+    Attributes:
+        max_size: The maximum total size of the cached images, in bytes.
+        size: The current total size of the cached images, in bytes.
+        entries: The cached images, indexed by path, from the least to the most recently used.
+    """
+    def __init__(self, max_size=512 * 2 ** 20):
+        """Inits the class."""
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+
+    def __contains__(self, image_path):
+        """Checks whether an image is cached (without checking its file, nor marking it as recently used)."""
+        return image_path in self.entries
+
+    def get(self, image_path):
+        """Returns the cached image for a path (None if there is none, or if its file has changed), marking it as recently used."""
+        decoded = self.entries.get(image_path)
+
+        if decoded is None:
+            return None
+
+        if get_file_stat(image_path) != decoded.file_stat:  # Stale entry
+            self.remove(image_path)
+            return None
+
+        self.entries.move_to_end(image_path)
+
+        return decoded
+
+    def touch(self, image_path):
+        """Marks an image as recently used (if cached), without checking its file."""
+        if image_path in self.entries:
+            self.entries.move_to_end(image_path)
+
+    def get_total_size(self, image_paths):
+        """Returns the total size of the cached images among the given paths (bytes)."""
+        return sum(self.entries[p].get_size() for p in set(image_paths) if p in self.entries)
+
+    def put(self, decoded):
+        """Stores a decoded image in the cache (replacing any previous entry for its path), then evicts the least recently used images if needed.
+
+        Images larger than the cache itself are not stored.
+        """
+        self.remove(decoded.image_path)
+
+        if decoded.get_size() > self.max_size:
+            return
+
+        self.entries[decoded.image_path] = decoded
+        self.size += decoded.get_size()
+
+        self.evict()
+
+    def remove(self, image_path):
+        """Removes an image from the cache (if cached)."""
+        decoded = self.entries.pop(image_path, None)
+
+        if decoded is not None:
+            self.size -= decoded.get_size()
+
+    def evict(self):
+        """Removes the least recently used images until the cache size is within its limit."""
+        while self.size > self.max_size and self.entries:
+            _, decoded = self.entries.popitem(last=False)
+            self.size -= decoded.get_size()
+
+    def clear(self):
+        """Removes all images from the cache."""
+        self.entries.clear()
+        self.size = 0
+
+
+def get_file_stat(path):
+    """Returns the size and modification time of a file, or None if it does not exist (anymore)."""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+
+    return stat.st_size, stat.st_mtime_ns
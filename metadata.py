@@ -0,0 +1,127 @@
+import csv
+import json
+import math
+import numbers
+import sys
+import time
+from argparse import ArgumentParser
+from concurrent.futures import ProcessPoolExecutor
+from PIL import Image
+from analyze import get_image_paths
+from exif import get_exif_dict, get_gps_coordinates, get_header_exif, process_gps_data
+
+
+# Global parameters
+
+# Binary EXIF values (e.g. MakerNote data) longer than this (bytes) are replaced by their length in the output
+max_binary_length = 256
+
+# Number of files sent to a worker process at once
+chunk_size = 32
+
+# CSV columns (the full EXIF data is only written to JSONL files)
+csv_fields = ['path', 'status', 'format', 'width', 'height', 'Make', 'Model', 'DateTime', 'DateTimeOriginal', 'latitude', 'longitude', 'GPSLocation', 'error']
+
+
+# METADATA
+
+# Convert an EXIF value to a JSON-serializable value: rationals become numbers (None if undefined), tuples become lists
+# and binary data becomes a hexadecimal string (or its length, if longer than max_binary_length)
+def get_json_value(value):
+    if isinstance(value, bytes):
+        if len(value) > max_binary_length:
+            return '<{} bytes>'.format(len(value))
+        return value.hex()
+    elif isinstance(value, (bool, int, str)) or value is None:
+        return value
+    elif isinstance(value, numbers.Real):  # Including PIL's IFDRational
+        value = float(value)
+        return value if math.isfinite(value) else None
+    elif isinstance(value, (tuple, list)):
+        return [get_json_value(v) for v in value]
+    elif isinstance(value, dict):
+        return {str(k): get_json_value(v) for k, v in value.items()}
+    else:
+        return str(value)
+
+
+# Read the metadata of an image file (meant to be run in a worker process): format, size, EXIF data and GPS location (decimal degrees)
+# Only the headers of the file are read (for JPEG images, the segments preceding the image data, and for PNG images, the chunks preceding it; see exif.get_header_exif):
+# pixels are never decoded.
+# EXIF and GPS data are processed exactly as in the GUI (see ImageModel.exif_data), including the GPSLocation link.
+# Returns a JSON-serializable record; invalid images are reported instead of interrupting the extraction
+def read_metadata(img_path):
+    record = {'path': img_path}
+
+    try:
+        with Image.open(img_path) as image:
+            record['format'] = image.format
+            record['width'], record['height'] = image.size
+            exif = get_header_exif(image)
+            exif_data = get_exif_dict(exif) if len(exif) > 0 else {}
+
+        exif_data_gps = process_gps_data(exif_data)
+        if exif_data_gps is not None:
+            exif_data = exif_data_gps
+    except IOError as e:
+        record['status'] = 'invalid'
+        record['error'] = str(e)
+    except Exception as e:
+        record['status'] = 'error'
+        record['error'] = repr(e)
+    else:
+        coordinates = get_gps_coordinates(exif_data)
+
+        record['status'] = 'ok'
+        record['latitude'], record['longitude'] = coordinates if coordinates is not None else (None, None)
+        record['exif'] = get_json_value(exif_data)
+
+    return record
+
+
+# EXTRACTION
+
+# Extract the metadata of all images from a source (see analyze.get_image_paths; directories are searched recursively) in parallel,
+# writing one record per image to output_file (JSONL or CSV, see csv_fields) in the order of the source, as soon as it is read
+# Returns the number of files read and the elapsed time (seconds)
+def extract(source, output_file, output_format='jsonl', workers=None):
+    paths = get_image_paths(source, recursive=True)
+
+    if output_format == 'csv':
+        writer = csv.DictWriter(output_file, fieldnames=csv_fields, extrasaction='ignore')
+        writer.writeheader()
+
+    start = time.perf_counter()
+
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        for record in executor.map(read_metadata, paths, chunksize=chunk_size):
+            if output_format == 'csv':
+                writer.writerow(dict(record.get('exif', {}), **{k: v for k, v in record.items() if k != 'exif'}))
+            else:
+                output_file.write(json.dumps(record, ensure_ascii=False) + '\n')
+
+    return len(paths), time.perf_counter() - start
+
+
+# COMMAND LINE
+
+if __name__ == '__main__':
+    parser = ArgumentParser(prog='python -m metadata', description='Extract EXIF and GPS metadata from images, without decoding them.')
+    parser.add_argument('source', help='directory (searched recursively), glob pattern (quoted) or text file with one image path per line')
+    parser.add_argument('-o', '--output', default=None, help='output file (default: standard output)')
+    parser.add_argument('-f', '--format', choices=['jsonl', 'csv'], default=None, help='output format (default: csv for .csv output files, jsonl otherwise)')
+    parser.add_argument('-j', '--workers', type=int, default=None, help='number of worker processes (default: number of CPUs)')
+
+    args = parser.parse_args()
+
+    metadata_format = args.format
+    if metadata_format is None:
+        metadata_format = 'csv' if args.output is not None and args.output.lower().endswith('.csv') else 'jsonl'
+
+    if args.output is not None:
+        with open(args.output, 'w', newline='' if metadata_format == 'csv' else None, encoding='utf-8') as f:
+            n_files, elapsed = extract(args.source, f, metadata_format, args.workers)
+    else:
+        n_files, elapsed = extract(args.source, sys.stdout, metadata_format, args.workers)
+
+    print('Read the metadata of {} images in {:.2f} s ({:.1f} files/s).'.format(n_files, elapsed, n_files / elapsed if elapsed > 0 else 0), file=sys.stderr)
@@ -1,44 +1,68 @@
-from PIL import ImageQt, ExifTags
+import math
+import os
+import numpy as np
+from PIL import Image
+from PyQt5.QtCore import Qt
+from PyQt5.QtGui import QImage, QTransform
+from exif import get_exif_dict, get_orientation_rotation, orientation_tag, process_gps_data, save_rotated_jpeg
+from imagecache import DecodedImage, get_file_stat
 
 
 class ImageModel():
     """Model class for the image.
 
-    Basically, this is the class which holds the loaded image, its EXIF data and the modified image which might be eventually saved by the user.
-    It also processes said EXIF data, including GPS data (with the relative Google Maps link).
+    Basically, this is the class which holds the loaded image, its EXIF data and the edits which might be eventually saved by the user.
+    It also processes said EXIF data, including GPS data (with the relative Google Maps link, see exif.py).
 
     Attributes:
-        image: the current loaded image (PyQt5 image).
-        analyzed_image: An image combining both the original image and its manipulation map.
-        exif_data: A dictionary containing all EXIF data available for the image (None if there is none).
+        pixels: The decoded pixels of the loaded image (NumPy array, RGB or RGBA). The image file is decoded only once:
+                the displayed image and the manipulation analysis share this buffer, without copying it.
+        full_resolution: Whether the pixels have been decoded at full resolution (JPEG images are first decoded as a reduced resolution preview, see load_image).
+        image: the current displayed image (PyQt5 image), i.e. a view of either the loaded image's pixels or its manipulation map.
+        original_displayed: Whether the displayed image is the loaded image (and not its manipulation map).
+        image_format: The format of the loaded image file, as detected by PIL (e.g. 'JPEG').
+        file_stat: The size and modification time of the loaded image file (needed to check that it has not changed before saving a copy of it).
+        file_overwritten: Whether the loaded image file has been overwritten since it was loaded (its orientation and EXIF data might then differ from the loaded ones).
+        analyzed_image: The manipulation map of the image (NumPy array, grayscale).
+        exif_data: A dictionary containing all EXIF data available for the image (None if there is none), processed only once, the first time it is needed.
+        exif_source: The EXIF data of the image (PIL's Image.Exif, or the PNG metadata dictionary) until it is processed into exif_data (None afterwards).
         filename: The original image's file name (needed for saving).
         path: The original image's absolute path (needed for finding the ground truth when analyzing the image).
-        modified_image: A PyQt image (QImage) modified by the user (i.e. a rotated version of the original image). Also needed for saving.
-        terminal_flag: Boolean flag needed to determine if the main program has been started from the terminal or an IDE (see main.py).
+        edits: The edit stack, i.e. the edits of the displayed image made by the user, as a list of (name, value) tuples in order of application (e.g. ('rotate', 90)).
+               Edits are not applied to the full resolution image, but only to the displayed pixmap (see ImageWidget); they are materialized once, when saving (see get_edited_image).
+               The stack initially holds the rotation described by the EXIF orientation of the image (if any), as pixels are decoded as stored in the file.
+        orientation_rotation: The clockwise rotation described by the EXIF orientation of the loaded image (degrees).
     """
-    def __init__(self, terminal_flag):
+    def __init__(self):
         """Inits the class."""
+        self.pixels = None
+        self.full_resolution = False
         self.image = None
+        self.original_displayed = False
+        self.image_format = None
+        self.file_stat = None
+        self.file_overwritten = False
         self.original_image = None
         self.analyzed_image = None
-        self.exif_data = None
+        self.exif_source = None
+        self._exif_data = None
         self.filename = None
         self.path = None
 
-        self.modified_image = None
+        self.edits = []
+        self.orientation_rotation = 0
         self.manipulation_flag = False
-        self.terminal_flag = terminal_flag
 
     def set_image(self, image):
         """Image setter."""
         self.image = image
 
-    def set_modified_image(self, modified_image):
-        """Modified image setter.."""
-        self.modified_image = modified_image
+    def load_image(self, image, image_path, preview_size=None):
+        """Processes an image loaded by and received from the Controller (a PIL image), decoding its pixels.
 
-    def load_image(self, image, image_path):
-        """Processes an image loaded by and received from the Controller."""
+        If preview_size is given, JPEG images are only decoded as a reduced resolution preview, large enough to be displayed within a preview_size x preview_size box (see get_pixels);
+        the full resolution pixels must then be decoded later, when needed (see load_full_resolution and set_full_pixels).
+        """
         # Get file name from the absolute image path
         filename = image_path.split('/')
         filename = filename[len(filename) - 1]
@@ -46,149 +70,276 @@ class ImageModel():
         # Store needed data in model
         self.filename = filename
         self.image_path = image_path
-        self.image = ImageQt.ImageQt(image)
-        self.modified_image = self.image
-
-        # Get file format (needed for the check below)
-        format = self.filename.split('.')
-        format = format[len(format)-1]
-
-        # PIL only gets EXIF data from JPEG images.
-        # To an extent, it also supports PNG EXIF data; however,
-        # the image must be loaded before trying to extract these attributes.
-        if '_getexif' in dir(image) and image._getexif() is not None:  # JPEG with EXIF data
-            self.exif_data = {ExifTags.TAGS[k]: v for k, v in image._getexif().items() if k in ExifTags.TAGS}
-            self.set_gps_data()
-        elif format == 'png':  # PNG
-            image.load()
-            self.exif_data = image.info
+        self.image_format = image.format
+        self.file_stat = get_file_stat(image_path)
+        self.file_overwritten = False
+        size = image.size  # Full resolution size (a preview changes the size of the image)
+        self.pixels = get_pixels(image, preview_size)
+        self.full_resolution = self.pixels.shape[1::-1] == size
+        self.display_pixels(self.pixels)
+
+        # Only the first IFD of the EXIF data is read here (once), for the orientation; all other tags are only processed when needed (see exif_data)
+        exif = image.getexif()
+        self.exif_source = get_exif_source(image, exif, filename)
+        self.orientation_rotation = get_orientation_rotation(exif.get(orientation_tag))
+        self.reset_edits()
+
+    def load_decoded_image(self, decoded):
+        """Loads an image which has already been decoded at full resolution (e.g. by the prefetcher, see imagecache.DecodedImage),
+        along with its EXIF data and its manipulation map, if it has been cached after being analyzed (see get_decoded_image)."""
+        # Get file name from the absolute image path
+        filename = decoded.image_path.split('/')
+        filename = filename[len(filename) - 1]
+
+        # Store needed data in model
+        self.filename = filename
+        self.image_path = decoded.image_path
+        self.image_format = decoded.image_format
+        self.file_stat = decoded.file_stat
+        self.file_overwritten = False
+        self.pixels = decoded.pixels
+        self.full_resolution = True
+        self.display_pixels(self.pixels)
+
+        self.exif_data = decoded.exif_data
+        self.exif_source = decoded.exif_source
+        self.orientation_rotation = decoded.orientation_rotation
+        self.reset_edits()
+
+        self.analyzed_image = decoded.analyzed_image
+        self.manipulation_flag = decoded.analyzed_image is not None
+
+    def get_decoded_image(self, preview=None):
+        """Returns the state of the loaded image (decoded pixels, EXIF data and manipulation map, along with the given downsampled level, if any) as a decoded image (see imagecache.DecodedImage),
+        so that it can be cached when the image is closed, and loaded again later without being decoded, processed or analyzed again (see load_decoded_image). Nothing is copied.
+
+        Returns None if the state of the image cannot be cached, i.e. if only its preview has been decoded, or if its file has been overwritten since it was loaded.
+        """
+        if not self.full_resolution or self.file_overwritten:
+            return None
+
+        decoded = DecodedImage(self.image_path, self.file_stat, self.image_format, self.pixels, self.orientation_rotation, self._exif_data, self.exif_source, self.analyzed_image)
+        decoded.preview = preview
+
+        return decoded
+
+    @property
+    def exif_data(self):
+        """EXIF data getter, processing the EXIF data of the image the first time it is called."""
+        if self.exif_source is not None:
+            exif_source = self.exif_source
+            self.exif_source = None
+
+            self._exif_data = get_exif_data(exif_source)
+
+        return self._exif_data
+
+    @exif_data.setter
+    def exif_data(self, exif_data):
+        """EXIF data setter."""
+        self.exif_source = None
+        self._exif_data = exif_data
+
+    def set_full_pixels(self, pixels):
+        """Replaces the preview of the loaded image with its full resolution pixels (decoded by get_pixels), displaying them if the preview was displayed."""
+        original_displayed = self.original_displayed
+
+        self.pixels = pixels
+        self.full_resolution = True
+
+        if original_displayed:
+            self.display_pixels(pixels)
+
+    def load_full_resolution(self):
+        """Decodes the loaded image at full resolution, if only its preview has been decoded so far."""
+        if not self.full_resolution:
+            self.set_full_pixels(get_pixels(Image.open(self.image_path)))
+
+    def display_pixels(self, pixels):
+        """Sets the displayed image to a view of the given pixels (either the loaded image's pixels or its manipulation map), without copying them."""
+        self.image = get_qimage(pixels)
+        self.original_displayed = pixels is self.pixels
+
+    def rotate(self, degree):
+        """Adds a clockwise rotation to the edit stack, composing it with the last edit if it is a rotation too (rotations which cancel out are removed)."""
+        if self.edits and self.edits[-1][0] == 'rotate':
+            degree += self.edits.pop()[1]
+
+        degree %= 360
+        if degree != 0:
+            self.edits.append(('rotate', degree))
+
+    def get_rotation(self):
+        """Returns the total clockwise rotation of the edit stack (degrees, between 0 and 360)."""
+        return sum(value for name, value in self.edits if name == 'rotate') % 360
+
+    def reset_edits(self):
+        """Empties the edit stack, restoring the displayed image to its original state (i.e. to its EXIF orientation)."""
+        self.edits = []
+        self.rotate(self.orientation_rotation)
+
+    def get_edited_image(self):
+        """Materializes the edit stack, returning the full resolution displayed image with all edits applied (QImage). Intended to be used only for saving."""
+        image = self.image
+
+        for name, value in self.edits:
+            if name == 'rotate':
+                image = rotate_image(image, value)
+
+        return image
+
+    def save_image(self, image_path):
+        """Saves the displayed image with all edits applied.
+
+        JPEG images which have only been rotated by multiples of 90 degrees are saved as JPEG without being decoded or re-encoded, i.e. losslessly and much faster,
+        by copying the original file and only rewriting its EXIF orientation (see exif.py), which also preserves all other EXIF data.
+        All other images (or formats) are materialized at full resolution (see get_edited_image) and re-encoded.
+        """
+        if os.path.abspath(image_path) == os.path.abspath(self.image_path):
+            self.file_overwritten = True
+
+        if self.can_save_losslessly(image_path):
+            try:
+                save_rotated_jpeg(self.image_path, image_path, self.get_rotation())
+            except ValueError:  # Invalid JPEG or EXIF data (nothing has been written)
+                pass
+            else:
+                if os.path.abspath(image_path) == os.path.abspath(self.image_path):  # The original file has been updated, and still holds the loaded pixels
+                    self.file_stat = get_file_stat(image_path)
+                return
+
+        self.load_full_resolution()
+        self.get_edited_image().save(image_path)
+
+    def can_save_losslessly(self, image_path):
+        """Checks whether the displayed image can be saved by only rewriting the EXIF orientation of the original file (see save_image)."""
+        extension = image_path.split('.')[-1].lower()
+
+        return self.image_format == 'JPEG' and extension in ('jpg', 'jpeg') and self.original_displayed \
+            and all(name == 'rotate' for name, value in self.edits) and self.get_rotation() % 90 == 0 \
+            and self.file_stat is not None and get_file_stat(self.image_path) == self.file_stat  # The original file has not changed since it was loaded
 
     def close_image(self):
         """Reset all the attributes to their original state. Intended to be used for properly closing an image."""
+        self.pixels = None
+        self.full_resolution = False
         self.image = None
+        self.original_displayed = False
+        self.image_format = None
+        self.file_stat = None
+        self.file_overwritten = False
+        self.edits = []
+        self.orientation_rotation = 0
         self.analyzed_image = None
         self.exif_data = None
         self.filename = None
         self.manipulation_flag = False
 
-    def set_gps_data(self):
-        """EXIF data setter."""
-        exif_data_gps = self.process_gps_data()
 
-        if exif_data_gps is not None:
-            self.exif_data = exif_data_gps
-        else:
-            return
+def read_image(image_path):
+    """Opens an image file and decodes it at full resolution, also processing its EXIF data (unlike ImageModel.load_image, which defers both).
+
+    Intended to be called from worker threads (e.g. the prefetcher, see worker.py), so that the image can later be loaded without reading the file again (see ImageModel.load_decoded_image).
+    Raises IOError if the file is not a valid image.
+    """
+    file_stat = get_file_stat(image_path)  # Before reading the file, so that changes made while reading it are detected later
 
-    def process_gps_data(self):
-        """Process GPS EXIF data, if available.
+    filename = image_path.split('/')
+    filename = filename[len(filename) - 1]
 
-        PIL's _getexif() function behaves differently according to where the main program has been run from.
-        In particular, it returns data in a different format if it has been started from the terminal, or an IDE.
-        Failing to acknowledge this fact will result in a crash.
-        """
-        exif_data = self.exif_data  # EXIF data
-        gps_data = self.exif_data.get('GPSInfo')  # Dictionary for storing the GPS EXIF data
-
-        if gps_data is not None:  # GPS EXIF data available
-            gps_data_dict = {}  # Contains all GPS EXIF tags with their proper names (and relative values)
-
-            # EXIF GPS tags' numbers taken from: https://exiftool.org/TagNames/GPS.html
-            if gps_data.get(0) is not None:
-                gps_data_dict['GPSVersionID'] = gps_data.get(0)
-            if gps_data.get(1) is not None:
-                gps_data_dict['GPSLatitudeRef'] = gps_data.get(1)
-            if gps_data.get(2) is not None:
-                gps_data_dict['GPSLatitude'] = gps_data.get(2)
-            if gps_data.get(3) is not None:
-                gps_data_dict['GPSLongitudeRef'] = gps_data.get(3)
-            if gps_data.get(4) is not None:
-                gps_data_dict['GPSLongitude'] = gps_data.get(4)
-            if gps_data.get(5) is not None:
-                gps_data_dict['GPSAltitudeRef'] = gps_data.get(5)
-            if gps_data.get(6) is not None:
-                gps_data_dict['GPSAltitude'] = gps_data.get(6)
-            if gps_data.get(7) is not None:
-                gps_data_dict['GPSTimeStamp'] = gps_data.get(7)
-            if gps_data.get(8) is not None:
-                gps_data_dict['GPSSatellites'] = gps_data.get(8)
-            if gps_data.get(9) is not None:
-                gps_data_dict['GPSStatus'] = gps_data.get(9)
-            if gps_data.get(10) is not None:
-                gps_data_dict['GPSMeasureMode'] = gps_data.get(10)
-            if gps_data.get(11) is not None:
-                gps_data_dict['GPSDOP'] = gps_data.get(11)
-            if gps_data.get(12) is not None:
-                gps_data_dict['GPSSpeedRef'] = gps_data.get(12)
-            if gps_data.get(13) is not None:
-                gps_data_dict['GPSSpeed'] = gps_data.get(13)
-            if gps_data.get(14) is not None:
-                gps_data_dict['GPSTrackRef'] = gps_data.get(14)
-            if gps_data.get(15) is not None:
-                gps_data_dict['GPSTrack'] = gps_data.get(15)
-            if gps_data.get(16) is not None:
-                gps_data_dict['GPSImgDirectionRef'] = gps_data.get(16)
-            if gps_data.get(17) is not None:
-                gps_data_dict['GPSImgDirection'] = gps_data.get(17)
-            if gps_data.get(18) is not None:
-                gps_data_dict['GPSMapDatum'] = gps_data.get(18)
-            if gps_data.get(19) is not None:
-                gps_data_dict['GPSDestLatitudeRef'] = gps_data.get(19)
-            if gps_data.get(20) is not None:
-                gps_data_dict['GPSDestLatitude'] = gps_data.get(20)
-            if gps_data.get(21) is not None:
-                gps_data_dict['GPSDestLongitudeRef'] = gps_data.get(21)
-            if gps_data.get(22) is not None:
-                gps_data_dict['GPSDestLongitude'] = gps_data.get(22)
-            if gps_data.get(23) is not None:
-                gps_data_dict['GPSDestBearingRef'] = gps_data.get(23)
-            if gps_data.get(24) is not None:
-                gps_data_dict['GPSDestBearing'] = gps_data.get(24)
-            if gps_data.get(25) is not None:
-                gps_data_dict['GPSDestDistanceRef'] = gps_data.get(25)
-            if gps_data.get(26) is not None:
-                gps_data_dict['GPSDestDistance'] = gps_data.get(26)
-            if gps_data.get(27) is not None:
-                gps_data_dict['GPSProcessingMethod'] = gps_data.get(27)
-            if gps_data.get(28) is not None:
-                gps_data_dict['GPSAreaInformation'] = gps_data.get(28)
-            if gps_data.get(29) is not None:
-                gps_data_dict['GPSDateStamp'] = gps_data.get(29)
-            if gps_data.get(30) is not None:
-                gps_data_dict['GPSDifferential'] = gps_data.get(30)
-            if gps_data.get(31) is not None:
-                gps_data_dict['GPSHPositioningError'] = gps_data.get(31)
-
-            # Remove original GPS EXIF data (which is too short and non-descriptive)
-            # and replace it with the new, processed dictionary
-            exif_data.pop('GPSInfo')
-
-            exif_data_updated = {}  # Contains the original EXIF data + the new GPS EXIF data
-
-            exif_data_updated.update({'GPSLocation': self.build_gmaps_link(gps_data_dict['GPSLatitude'], gps_data_dict['GPSLatitudeRef'], gps_data_dict['GPSLongitude'], gps_data_dict['GPSLongitudeRef'])})
-            exif_data_updated.update(gps_data_dict)
-            exif_data_updated.update(exif_data)
-
-            return exif_data_updated
-        else:  # No GPS EXIF data available
-            return None
+    with Image.open(image_path) as image:
+        pixels = get_pixels(image)
+        exif = image.getexif()
+        orientation_rotation = get_orientation_rotation(exif.get(orientation_tag))
+        exif_source = get_exif_source(image, exif, filename)
+
+        return DecodedImage(image_path, file_stat, image.format, pixels, orientation_rotation, get_exif_data(exif_source) if exif_source is not None else None)
+
+
+def get_exif_source(image, exif, filename):
+    """Returns the unprocessed EXIF data of a PIL image (its Image.Exif, as returned by getexif), the metadata dictionary of PNG images, or None if there is none.
+
+    PIL only gets EXIF data from JPEG images.
+    To an extent, it also supports PNG EXIF data; however,
+    the image must be loaded before trying to extract these attributes (which get_pixels does).
+    """
+    # Get file format (needed for the check below)
+    format = filename.split('.')
+    format = format[len(format)-1]
+
+    if len(exif) > 0:  # JPEG with EXIF data
+        return exif
+    elif format == 'png':  # PNG
+        return image.info
+
+    return None
+
+
+def get_exif_data(exif_source):
+    """Processes unprocessed EXIF data (see get_exif_source) into a dictionary indexed by tag name,
+    replacing raw GPS data with processed GPS data (and a Google Maps link to the GPS location), if available (see exif.process_gps_data)."""
+    if isinstance(exif_source, dict):  # PNG metadata
+        return exif_source
+
+    exif_data = get_exif_dict(exif_source)
+    exif_data_gps = process_gps_data(exif_data)
+
+    return exif_data_gps if exif_data_gps is not None else exif_data
+
+
+def get_pixels(image, preview_size=None):
+    """Decodes a PIL image into a NumPy array (RGB, or RGBA for images with transparency), converting it first if needed.
+
+    If preview_size is given, JPEG images are decoded at the lowest reduced resolution (1/2, 1/4 or 1/8, see PIL's Image.draft) at which they still fill
+    a preview_size x preview_size box when scaled to fit it. Reduced resolutions are decoded directly from the DCT coefficients, so this is several times faster than a full decode.
+    """
+    if preview_size is not None and image.format == 'JPEG':
+        scale = max(image.size) / preview_size
+        if scale > 1:
+            image.draft(None, (math.ceil(image.width / scale), math.ceil(image.height / scale)))
+
+    if image.mode in ('RGBA', 'LA', 'PA') or 'transparency' in image.info:
+        mode = 'RGBA'
+    else:
+        mode = 'RGB'
+
+    if image.mode != mode:
+        image = image.convert(mode)
+
+    return np.asarray(image)
+
+
+def get_qimage(pixels):
+    """Returns a QImage sharing the memory of a NumPy array (RGB, RGBA or grayscale, 8 bits per channel).
+
+    The QImage does not own its memory: the array is attached to it, so that it is kept alive as long as the QImage itself.
+    """
+    pixels = np.ascontiguousarray(pixels)  # QImage rows must be contiguous (no copy for arrays which already are)
+
+    if len(pixels.shape) == 2:
+        image_format = QImage.Format_Grayscale8
+    elif pixels.shape[2] == 4:
+        image_format = QImage.Format_RGBA8888
+    else:
+        image_format = QImage.Format_RGB888
+
+    image = QImage(pixels.data, pixels.shape[1], pixels.shape[0], pixels.strides[0], image_format)
+    image.pixels = pixels
+
+    return image
+
+
+def rotate_image(image, degree):
+    """Rotates an image (QImage or QPixmap) clockwise.
+
+    Rotations by multiples of 90 degrees are lossless, i.e. they only transpose pixels, without resampling them; other rotations are smoothly interpolated.
+    """
+    if degree % 360 == 0:
+        return image
+
+    if degree % 90 == 0:
+        transform_mode = Qt.FastTransformation  # Exact for 90 degrees turns (and handled by Qt as plain pixel transpositions)
+    else:
+        transform_mode = Qt.SmoothTransformation
 
-    def build_gmaps_link(self, lat, lat_ref, lon, lon_ref):
-        """Builds a Google Maps link for the specified GPS location.
-
-        Here is where the distinction between terminal and IDE script actually comes in play (see main.py and above)."""
-        if not self.terminal_flag:  # IDE
-            lat = tuple(lat)
-            lon = tuple(lon)
-            latitude = str(int(lat[0])) + '°' + str(int(lat[1])) + '\'' + str(lat[2]) + '\"' + lat_ref
-            longitude = str(int(lon[0])) + '°' + str(int(lon[1])) + '\'' + str(lon[2]) + '\"' + lon_ref
-        else:  # Terminal
-            # Latitude and longitude result as integer tuples from the terminal, and need to be divided in order to get the correct float number
-            lat_s = float(lat[2][0]/10 ** (len(str(lat[2][1]))-1))
-            lon_s = float(lon[2][0] / 10 ** (len(str(lon[2][1])) - 1))
-            latitude = str(int(lat[0][0])) + '°' + str(int(lat[1][0])) + '\'' + str(lat_s) + '\"' + lat_ref
-            longitude = str(int(lon[0][0])) + '°' + str(int(lon[1][0])) + '\'' + str(lon_s) + '\"' + lon_ref
-
-        link = 'https://www.google.com/maps/place/' + latitude + '+' + longitude
-
-        return link
+    return image.transformed(QTransform().rotate(degree), transform_mode)
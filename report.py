@@ -0,0 +1,132 @@
+import time
+import tracemalloc
+import numpy as np
+from contextlib import contextmanager
+
+
+class AnalysisReport():
+    """Structured timing and statistics of a manipulation analysis.
+
+    A report is filled by the analysis functions which accept one (see analyze.main), so that it is possible to see where the time of each image is spent.
+    Stage times are measured with time.perf_counter; peak memory is measured with tracemalloc (which traces NumPy and OpenCV arrays) only if track_memory is set,
+    as tracing slows down memory allocations, and only while the report is used as a context manager. Analyses which are not given a report do not measure anything.
+    Subclasses can follow the progress of an analysis by overriding on_stage and on_iteration, which are called at the start of each stage and at the end of each EM iteration.
+
+    Attributes:
+        track_memory: Whether the peak memory of each stage is measured.
+        cached: Whether the manipulation map was read from the cache (in which case no stage is measured).
+        windows: The number of analyzed windows.
+        stages: A dictionary of stage times (seconds), in execution order.
+        stage_peak_memory: A dictionary of the peak memory allocated during each stage (bytes), including the memory still allocated by previous stages.
+        iteration_times: The time of each EM iteration (seconds).
+        diff_history: The average difference between successive estimates of the template c, for each EM iteration after the first one.
+        template: The final template c.
+    """
+    def __init__(self, track_memory=False):
+        """Inits the class."""
+        self.track_memory = track_memory
+        self.cached = False
+        self.windows = None
+        self.stages = {}
+        self.stage_peak_memory = {}
+        self.iteration_times = []
+        self.diff_history = []
+        self.template = None
+
+        self._iteration_start = None
+        self._started_tracing = []  # One flag per (nested) use as a context manager
+
+    def __enter__(self):
+        """Starts tracing memory allocations, if tracked (the report is used as a context manager around the whole analysis)."""
+        started_tracing = self.track_memory and not tracemalloc.is_tracing()
+        if started_tracing:
+            tracemalloc.start()
+
+        self._started_tracing.append(started_tracing)
+
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        """Stops tracing memory allocations, if started by the report."""
+        if self._started_tracing.pop():
+            tracemalloc.stop()
+
+    @contextmanager
+    def stage(self, name):
+        """Context manager which measures the time (and peak memory, if tracked) of an analysis stage; times of stages with the same name are added up."""
+        self.on_stage(name)
+
+        track_memory = self.track_memory and tracemalloc.is_tracing()
+        if track_memory:
+            tracemalloc.reset_peak()
+
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0) + time.perf_counter() - start
+
+            if track_memory:
+                self.stage_peak_memory[name] = max(self.stage_peak_memory.get(name, 0), tracemalloc.get_traced_memory()[1])
+
+    def start_iterations(self):
+        """Marks the start of the EM iterations."""
+        self.iteration_times = []
+        self._iteration_start = time.perf_counter()
+
+    def end_iteration(self, diff=None):
+        """Marks the end of an EM iteration (and the start of the next one), given the average difference between its template and the previous one (None for the first iteration)."""
+        now = time.perf_counter()
+        self.iteration_times.append(now - self._iteration_start)
+        self._iteration_start = now
+
+        self.on_iteration(diff)
+
+    def on_stage(self, name):
+        """Called at the start of each stage; does nothing (meant to be overridden)."""
+        pass
+
+    def on_iteration(self, diff):
+        """Called at the end of each EM iteration (see end_iteration); does nothing (meant to be overridden)."""
+        pass
+
+    def set_em_result(self, c, diff_history, iteration_times=None):
+        """Stores the result of the EM algorithm (and the iteration times of the chosen start, for multi-start EM)."""
+        self.template = np.array(c)
+        self.diff_history = [float(d) for d in diff_history]
+
+        if iteration_times is not None:
+            self.iteration_times = list(iteration_times)
+
+    @property
+    def iterations(self):
+        """The number of EM iterations."""
+        return len(self.iteration_times)
+
+    @property
+    def total_time(self):
+        """The total time of all stages (seconds)."""
+        return sum(self.stages.values())
+
+    @property
+    def peak_memory(self):
+        """The peak memory allocated by the analysis (bytes), or None if memory is not tracked."""
+        if not self.track_memory:
+            return None
+
+        return max(self.stage_peak_memory.values(), default=0)
+
+    def to_dict(self):
+        """Returns the report as a JSON-serializable dictionary."""
+        return {
+            'cached': self.cached,
+            'windows': self.windows,
+            'stages': dict(self.stages),
+            'stage_peak_memory': dict(self.stage_peak_memory) if self.track_memory else None,
+            'peak_memory': self.peak_memory,
+            'total_time': self.total_time,
+            'iterations': self.iterations,
+            'iteration_times': list(self.iteration_times),
+            'diff_history': list(self.diff_history),
+            'template': self.template.tolist() if self.template is not None else None,
+        }
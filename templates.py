@@ -0,0 +1,119 @@
+import json
+import os
+import numpy as np
+from PIL import Image
+from exif import get_header_exif
+
+
+class TemplateLibrary():
+    """Persistent library of EM templates, indexed by camera identity.
+
+    The rounding artifacts template c which the EM algorithm converges to is largely a property of the camera (and its encoding pipeline),
+    so a template learned from previous images of the same camera can be a better starting point than a random one.
+    Each camera's template is the running average of the templates converged to by its analyses (the most recent max_count analyses weigh the most).
+    Each image is only averaged once: the images whose templates have been added are recorded (by the hash of their contents), and analyzing them again leaves the template unchanged.
+    The library is stored as a JSON file, which is re-read before each update so that it can be shared by concurrent processes (the last writer wins).
+
+    Attributes:
+        path: The path of the JSON file containing the library.
+        max_count: The maximum number of analyses averaged into a template.
+        max_images: The maximum number of images recorded for each camera (the most recent ones).
+        templates: A dictionary of templates (as flattened lists), analysis counts and recorded images, indexed by camera key.
+    """
+    def __init__(self, path=None, max_count=100, max_images=1000):
+        """Inits the class."""
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.ieviewer', 'templates.json')
+
+        self.path = path
+        self.max_count = max_count
+        self.max_images = max_images
+        self.templates = {}
+
+        self.load()
+
+    def load(self):
+        """Loads the library from its file (if it exists)."""
+        try:
+            with open(self.path) as f:
+                self.templates = json.load(f)['templates']
+        except (OSError, ValueError, KeyError):  # Missing or invalid library
+            self.templates = {}
+
+    def save(self):
+        """Saves the library to its file (atomically)."""
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        tmp_path = self.path + '.' + str(os.getpid()) + '.tmp'
+        with open(tmp_path, 'w') as f:
+            json.dump({'version': 1, 'templates': self.templates}, f)
+        os.replace(tmp_path, self.path)
+
+    def get_key(self, camera):
+        """Returns the library key of a camera, given as a (make, model) tuple (None if the camera is unknown)."""
+        if camera is None:
+            return None
+
+        make, model = [str(v).strip().strip('\x00').strip() if v is not None else '' for v in camera]
+
+        if make == '' and model == '':
+            return None
+        else:
+            return make + '|' + model
+
+    def get(self, camera):
+        """Returns the template of a camera as an 8x8 array (None if there is none)."""
+        key = self.get_key(camera)
+
+        if key is None or key not in self.templates:
+            return None
+
+        return np.array(self.templates[key]['template'], dtype=np.float64).reshape(8, 8)
+
+    def update(self, camera, c, image_key=None):
+        """Adds a converged template c to the running average of its camera, then saves the library.
+
+        If given, image_key identifies the analyzed image (e.g. the hash of its contents): the template is not added again if the image has already been recorded.
+        """
+        key = self.get_key(camera)
+
+        if key is None or not np.all(np.isfinite(c)):
+            return
+
+        self.load()  # Include updates made by other processes
+
+        images = self.templates[key].get('images', []) if key in self.templates else []
+        if image_key is not None:
+            if image_key in images:  # Image already averaged into the template
+                return
+            images = (images + [image_key])[-self.max_images:]
+
+        if key in self.templates:
+            count = self.templates[key]['count']
+            template = np.array(self.templates[key]['template'], dtype=np.float64)
+            template = (template * count + np.ravel(c)) / (count + 1)
+            count = min(count + 1, self.max_count)
+        else:
+            count = 1
+            template = np.ravel(c)
+
+        self.templates[key] = {'count': count, 'template': template.tolist(), 'images': images}
+
+        self.save()
+
+
+def get_camera(image_path):
+    """Returns the camera of an image as a (make, model) tuple, reading its EXIF data (without decoding the image). Returns None if unknown."""
+    try:
+        with Image.open(image_path) as image:
+            exif_data = get_header_exif(image)
+    except (OSError, SyntaxError):  # Invalid image or EXIF data
+        return None
+
+    make = exif_data.get(271)  # EXIF Make tag
+    model = exif_data.get(272)  # EXIF Model tag
+
+    if make is None and model is None:
+        return None
+    else:
+        return make, model
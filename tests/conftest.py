@@ -0,0 +1,66 @@
+import os
+import sys
+import numpy as np
+import pytest
+from PIL import Image
+
+
+# The modules of the application are top-level scripts in the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+# Writes a synthetic photo-like JPEG image (smooth random texture) of the given size, optionally with the EXIF Make and Model of a camera, and returns its path
+def write_jpeg(path, width=256, height=256, camera=None, seed=0):
+    rng = np.random.default_rng(seed)
+    pixels = np.cumsum(np.cumsum(rng.normal(0, 3, (height, width, 3)), axis=0), axis=1)
+    pixels = (pixels - pixels.min()) / (pixels.max() - pixels.min()) * 255
+
+    exif = Image.Exif()
+    if camera is not None:
+        exif[271], exif[272] = camera  # EXIF Make and Model tags
+
+    Image.fromarray(pixels.astype(np.uint8)).save(str(path), 'JPEG', quality=85, exif=exif.tobytes())
+
+    return str(path)
+
+
+@pytest.fixture
+def jpeg_path(tmp_path):
+    """A synthetic JPEG image taken with a known camera."""
+    return write_jpeg(tmp_path / 'image.jpg', camera=('IEViewer', 'Test Camera'))
+
+
+@pytest.fixture
+def png_loads(monkeypatch, tmp_path):
+    """Records (and fails) every decoding of a PNG image, including in worker processes (forked, as on Linux), returning a function which lists the decoded files."""
+    from PIL import PngImagePlugin
+
+    log_path = tmp_path / 'png_loads.log'
+    log_path.touch()
+
+    def load(image):
+        with open(str(log_path), 'a') as log:
+            log.write(str(image.filename) + '\n')
+        raise AssertionError('PNG image decoded: ' + str(image.filename))
+
+    monkeypatch.setattr(PngImagePlugin.PngImageFile, 'load', load)
+
+    return lambda: log_path.read_text().splitlines()
+
+
+# Writes a PNG image, optionally with the EXIF Make and Model of a camera and GPS tags (by tag number) in an eXIf chunk (which PIL writes before the image data), and returns its path
+def write_png(path, camera=None, gps=None):
+    image = Image.new('RGB', (64, 48), (128, 64, 32))
+
+    if camera is None:
+        image.save(str(path), 'PNG')
+        return str(path)
+
+    exif = Image.Exif()
+    exif[271], exif[272] = camera  # EXIF Make and Model tags
+    if gps is not None:
+        exif.get_ifd(0x8825).update(gps)  # GPS IFD
+
+    image.save(str(path), 'PNG', exif=exif.tobytes())
+
+    return str(path)
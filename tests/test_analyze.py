@@ -0,0 +1,91 @@
+import analyze
+import numpy as np
+from cache import AnalysisCache
+from conftest import write_jpeg, write_png
+from report import AnalysisReport
+from templates import TemplateLibrary, get_camera
+
+
+def analyze_twice(image_path, tmp_path, progressive=False):
+    """Analyzes an image twice with the same cache and template library, returning whether each analysis was read from the cache."""
+    cache = AnalysisCache(str(tmp_path / 'cache'))
+    templates = TemplateLibrary(str(tmp_path / 'templates.json'))
+
+    cached = []
+    for _ in range(2):
+        report = AnalysisReport()
+        if progressive:
+            list(analyze.main_progressive(image_path, cache=cache, templates=templates, report=report))
+        else:
+            analyze.main(image_path, cache=cache, templates=templates, report=report)
+        cached.append(report.cached)
+
+    return cached
+
+
+def test_warm_started_analysis_is_cached(jpeg_path, tmp_path):
+    assert get_camera(jpeg_path) is not None
+    assert analyze_twice(jpeg_path, tmp_path) == [False, True]
+
+
+def test_warm_started_progressive_analysis_is_cached(jpeg_path, tmp_path):
+    assert analyze_twice(jpeg_path, tmp_path, progressive=True) == [False, True]
+
+
+def test_template_library_averages_each_image_once(jpeg_path, tmp_path):
+    templates = TemplateLibrary(str(tmp_path / 'templates.json'))
+    camera = get_camera(jpeg_path)
+
+    analyze.main(jpeg_path, templates=templates)
+    template = templates.get(camera)
+
+    analyze.main(jpeg_path, templates=templates)  # Not cached: analyzed again
+
+    assert (templates.get(camera) == template).all()
+    assert templates.templates[templates.get_key(camera)]['count'] == 1
+
+
+def analyze_directly(img):
+    """Analyzes an image by running the steps of the analysis pipeline one by one (see analyze_image)."""
+    filtered_lum = analyze.mfr(analyze.luminance(img), 3)
+    blocks, blocks_map = analyze.get_average_window_blocks(filtered_lum, 64, 8, 8)
+    assert blocks.shape[0] > 0
+
+    prob_b_in_c1_r, c, diff_history = analyze.expectation_maximization(blocks, 1e-3, 0.5)
+
+    return analyze.get_output_map(prob_b_in_c1_r, blocks_map, img.shape[1], img.shape[0], win_size=64)
+
+
+def test_image_padded_to_window_size_is_analyzed(tmp_path):
+    img = analyze.load_image(write_jpeg(tmp_path / 'image.jpg', width=256, height=56, seed=1))  # Padded to 64 rows
+    output_map = analyze_directly(img)
+
+    assert (analyze.main(None, img=img) == output_map).all()
+    assert (analyze.main(None, img=img, tiled=True) == output_map).all()
+    assert (list(analyze.main_progressive(None, img=img))[-1][1] == output_map).all()
+
+
+def test_image_smaller_than_window_has_empty_map(tmp_path):
+    img = analyze.load_image(write_jpeg(tmp_path / 'image.jpg', width=256, height=55, seed=1))  # Padded to 56 rows only
+
+    for output_map in (analyze.main(None, img=img), analyze.main(None, img=img, tiled=True), list(analyze.main_progressive(None, img=img))[-1][1]):
+        assert output_map.shape == (55, 256)
+        assert not output_map.any()
+
+
+def test_png_camera_is_read_without_decoding(png_loads, tmp_path):
+    assert get_camera(write_png(tmp_path / 'camera.png', ('IEViewer', 'Test Camera'))) == ('IEViewer', 'Test Camera')
+    assert get_camera(write_png(tmp_path / 'no_exif.png')) is None
+    assert png_loads() == []
+
+
+def test_multistart_analysis_without_seed_uses_default_seed(jpeg_path, tmp_path):
+    cache = AnalysisCache(str(tmp_path / 'cache'))
+
+    args = analyze.get_args(jpeg_path, cache=cache, n_starts=2)
+    assert args.seed == 0
+    assert analyze.get_cache_key(args) == analyze.get_cache_key(analyze.get_args(jpeg_path, cache=cache, n_starts=2, seed=0))
+
+    output_map = analyze.main(jpeg_path, n_starts=2)
+    assert np.array_equal(output_map, analyze.main(jpeg_path, n_starts=2))
+    assert np.array_equal(output_map, analyze.main(jpeg_path, n_starts=2, seed=0))
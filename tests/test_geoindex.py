@@ -0,0 +1,51 @@
+from conftest import write_png
+from geoindex import GeoIndex
+
+
+camera = ('IEViewer', 'Test Camera')
+gps = {1: 'N', 2: (45.0, 30.0, 0.0), 3: 'E', 4: (9.0, 15.0, 0.0)}  # 45.5 N, 9.25 E
+gps_near = {1: 'N', 2: (45.0, 30.0, 36.0), 3: 'E', 4: (9.0, 15.0, 0.0)}  # 45.51 N, 9.25 E (about 1.1 km away)
+
+
+def test_png_images_are_indexed_without_decoding(png_loads, tmp_path):
+    photos = tmp_path / 'photos'
+    photos.mkdir()
+    photo = write_png(photos / 'photo.png', camera, gps)
+    write_png(photos / 'no_exif.png')
+
+    index = GeoIndex(str(tmp_path / 'geoindex.sqlite'))
+    try:
+        assert index.update(str(photos), workers=1) == (2, 0, 0)
+        assert index.count() == (2, 1)
+        assert index.get_location(photo) == (45.5, 9.25)
+    finally:
+        index.close()
+
+    assert png_loads() == []
+
+
+def test_near_reads_png_image_without_decoding(png_loads, tmp_path):
+    photos = tmp_path / 'photos'
+    photos.mkdir()
+    photo = write_png(photos / 'photo.png', camera, gps)
+    query = write_png(tmp_path / 'query.png', camera, gps_near)
+
+    index = GeoIndex(str(tmp_path / 'geoindex.sqlite'))
+    try:
+        index.update(str(photos), workers=1)
+        results = index.near(query, 2)
+    finally:
+        index.close()
+
+    assert [r[0] for r in results] == [photo]
+    assert png_loads() == []
+
+
+def test_near_png_image_without_exif_is_not_decoded(png_loads, tmp_path):
+    index = GeoIndex(str(tmp_path / 'geoindex.sqlite'))
+    try:
+        assert index.near(write_png(tmp_path / 'query.png'), 2) is None
+    finally:
+        index.close()
+
+    assert png_loads() == []
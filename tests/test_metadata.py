@@ -0,0 +1,22 @@
+import os
+from conftest import write_png
+from metadata import read_metadata
+
+
+test_dir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'test')
+
+
+def test_png_without_exif_is_not_decoded(png_loads):
+    record = read_metadata(os.path.join(test_dir, 'png_test.png'))
+
+    assert png_loads() == []
+    assert record['status'] == 'ok'
+    assert record['exif'] == {}
+
+
+def test_png_exif_is_read_without_decoding(png_loads, tmp_path):
+    record = read_metadata(write_png(tmp_path / 'image.png', ('IEViewer', 'Test Camera')))
+
+    assert png_loads() == []
+    assert record['status'] == 'ok'
+    assert (record['exif']['Make'], record['exif']['Model']) == ('IEViewer', 'Test Camera')
@@ -0,0 +1,120 @@
+import io
+import os
+import sqlite3
+import time
+from PIL import Image, ImageOps
+
+
+# Global parameters
+
+# Maximum dimension (width or height) of thumbnails (pixels)
+thumbnail_size = 128
+
+# JPEG quality of stored thumbnails
+thumbnail_quality = 85
+
+
+class ThumbnailCache():
+    """Persistent cache of image thumbnails (JPEG data), indexed by image path and valid as long as the size and modification time of the image file do not change.
+
+    Thumbnails are stored in an SQLite database (a single file, instead of one file per thumbnail), along with the folder of their image,
+    so that the thumbnails of a whole folder are checked with a single query (see get_folder) and only read when displayed (see get).
+    The total size of the cache is capped: whenever it is exceeded, the thumbnails of the least recently used folders are evicted.
+
+    Attributes:
+        path: The path of the SQLite database containing the thumbnails.
+        max_size: The maximum total size of the cached thumbnails, in bytes.
+        connection: The connection to the database.
+    """
+    def __init__(self, path=None, max_size=256 * 2 ** 20):
+        """Inits the class."""
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.ieviewer', 'thumbnails.sqlite')
+
+        self.path = path
+        self.max_size = max_size
+
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS thumbnails (path TEXT PRIMARY KEY, folder TEXT, size INTEGER, mtime_ns INTEGER, last_used REAL, length INTEGER, data BLOB)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS thumbnails_folder ON thumbnails (folder)')
+        self.connection.execute('CREATE INDEX IF NOT EXISTS thumbnails_last_used ON thumbnails (last_used)')
+        self.connection.commit()
+
+    def close(self):
+        """Closes the connection to the database."""
+        self.connection.close()
+
+    def get_folder(self, folder):
+        """Returns the file stats (size, modification time, see imagecache.get_file_stat) of the images of a folder whose thumbnails are cached, indexed by path, marking them as recently used."""
+        self.connection.execute('UPDATE thumbnails SET last_used = ? WHERE folder = ?', (time.time(), folder))
+        self.connection.commit()
+
+        return {path: (size, mtime_ns) for path, size, mtime_ns in self.connection.execute('SELECT path, size, mtime_ns FROM thumbnails WHERE folder = ?', (folder,))}
+
+    def get(self, image_path, file_stat):
+        """Returns the cached thumbnail of an image (JPEG data; empty for invalid images), or None if there is none for its current file stat."""
+        if file_stat is None:
+            return None
+
+        row = self.connection.execute('SELECT data FROM thumbnails WHERE path = ? AND size = ? AND mtime_ns = ?', (image_path, file_stat[0], file_stat[1])).fetchone()
+
+        return row[0] if row is not None else None
+
+    def put(self, thumbnails):
+        """Stores thumbnails, given as (image path, file stat, JPEG data) tuples, then evicts the least recently used thumbnails if needed."""
+        now = time.time()
+
+        self.connection.executemany('INSERT OR REPLACE INTO thumbnails VALUES (?, ?, ?, ?, ?, ?, ?)',
+                                    [(path, get_folder(path), file_stat[0], file_stat[1], now, len(data), data) for path, file_stat, data in thumbnails])
+        self.evict()
+        self.connection.commit()
+
+    def evict(self):
+        """Removes the least recently used thumbnails until the cache size is within its limit."""
+        total_size = self.connection.execute('SELECT COALESCE(SUM(length), 0) FROM thumbnails').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+
+        evicted = []
+        for path, length in self.connection.execute('SELECT path, length FROM thumbnails ORDER BY last_used'):
+            if total_size <= self.max_size:
+                break
+            evicted.append((path,))
+            total_size -= length
+
+        self.connection.executemany('DELETE FROM thumbnails WHERE path = ?', evicted)
+
+    def clear(self):
+        """Removes all thumbnails from the cache."""
+        self.connection.execute('DELETE FROM thumbnails')
+        self.connection.commit()
+
+
+def get_folder(image_path):
+    """Returns the folder of an image, as stored in the cache (paths use forward slashes, as returned by Qt file dialogs)."""
+    return image_path[:image_path.rindex('/')] if '/' in image_path else '.'
+
+
+def make_thumbnail(image_path):
+    """Returns the thumbnail of an image file as JPEG data (empty for invalid images), oriented according to its EXIF orientation.
+
+    JPEG images are decoded directly at a reduced resolution (1/2, 1/4 or 1/8 of the original size, see PIL's Image.draft), so only a fraction of their data is decoded.
+    Only PIL is involved (which releases the GIL while decoding), so thumbnails can be made by a pool of threads.
+    """
+    try:
+        with Image.open(image_path) as image:
+            image.draft('RGB', (thumbnail_size, thumbnail_size))
+            image = ImageOps.exif_transpose(image)
+            image.thumbnail((thumbnail_size, thumbnail_size))
+
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+
+            data = io.BytesIO()
+            image.save(data, 'JPEG', quality=thumbnail_quality)
+    except Exception:  # Invalid or truncated file
+        return b''
+
+    return data.getvalue()
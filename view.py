@@ -1,8 +1,8 @@
-from PyQt5.QtCore import Qt, QEvent
-from PyQt5.QtGui import QPixmap, QTransform, QStatusTipEvent
+from PyQt5.QtCore import QEvent
+from PyQt5.QtGui import QStatusTipEvent
 from PyQt5.QtWidgets import QMainWindow, QFileDialog, QMessageBox
 from observer import Subject
-from widgets import ExifWidget, ImageWidget, StatusBar, MenuBar, ToolBar, Layout, AboutWidget
+from widgets import ExifWidget, ImageWidget, ThumbnailStrip, StatusBar, MenuBar, ToolBar, Layout, AboutWidget
 
 
 class View(Subject, QMainWindow):
@@ -14,8 +14,15 @@ class View(Subject, QMainWindow):
         tool_bar: A tool bar derived from QToolBar.
         exif_area: The widget containing any available EXIF data.
         image_area: The widget containing the displayed image.
+        thumbnail_strip: The widget containing the thumbnails of the images in the folder of the displayed image (see thumbnails.py).
         status_bar: A status bar derived from QStatusBar.
         about: The classic "About" informative widget (actually a new, separate window).
+        analysis_result: The last result received from an analysis worker, as a (worker, stride, output map) tuple (see worker.py).
+        analysis_end: The final status of the last ended analysis, as a (worker, status, error message) tuple (see worker.py).
+        decoded_image: The last full resolution image received from a decoding worker, as a (worker, pixels) tuple (see worker.py).
+        prefetched_image: The last neighbouring image received from the prefetching worker, as a (worker, decoded image) tuple (see worker.py).
+        generated_thumbnails: The last batch of thumbnails received from the thumbnail worker, as a (worker, thumbnails) tuple (see worker.py).
+        selected_image: The path of the image whose thumbnail has been clicked last.
     """
     def __init__(self, model):
         """Inits the class."""
@@ -25,11 +32,20 @@ class View(Subject, QMainWindow):
         # Set model
         self.model = model
 
+        # Analysis worker notifications (passed on to the controller)
+        self.analysis_result = None
+        self.analysis_end = None
+        self.decoded_image = None
+        self.prefetched_image = None
+        self.generated_thumbnails = None
+        self.selected_image = None
+
         # Create interface elements
         self.menu_bar = MenuBar(self)
         self.tool_bar = ToolBar(self)
         self.exif_area = ExifWidget(self)
         self.image_area = ImageWidget(self)
+        self.thumbnail_strip = ThumbnailStrip(self)
         self.status_bar = StatusBar()
         about_text = 'IEViewer 2.0' \
                      '<br><br>' \
@@ -51,6 +67,7 @@ class View(Subject, QMainWindow):
         # Disable GUI elements that are unavailable when no image is opened
         self.menu_bar.disable_widgets()
         self.exif_area.hide()
+        self.thumbnail_strip.hide()
 
         # Set layout
         self.setCentralWidget(Layout(self).central_widget)
@@ -96,6 +113,10 @@ class View(Subject, QMainWindow):
 
         info_box.show()
 
+    def show_progress(self, message):
+        """Shows a progress message in the status bar (connected to the analysis worker, see worker.py)."""
+        self.status_bar.showMessage(message)
+
     def event(self, e):
         """Defines the default status bar message (when nothing else is displayed)."""
         if e.type() == QEvent.StatusTip:
@@ -107,11 +128,22 @@ class View(Subject, QMainWindow):
         """Only needed to notify observers (i.e. the controller) that they should load an image."""
         self.set_state('open')
 
-    def load_image(self):
-        """Displays the image contained in the model."""
-        # Get original image dimensions
+    def previous_image(self):
+        """Only needed to notify observers (i.e. the controller) that they should open the previous image in the folder of the opened image."""
+        self.set_state('previous')
+
+    def next_image(self):
+        """Only needed to notify observers (i.e. the controller) that they should open the next image in the folder of the opened image."""
+        self.set_state('next')
+
+    def load_image(self, preview=None):
+        """Displays the image contained in the model (from its downsampled level, if already computed, e.g. by the prefetcher; see ImageWidget.set_image)."""
+        # Get original image dimensions (of the rotated image, if rotated by the user)
+        rotation = self.model.get_rotation()
         width = self.model.image.width()
         height = self.model.image.height()
+        if rotation % 180 == 90:
+            width, height = height, width
 
         # Recalculate image dimensions so as to have a maximum dimension (height or width) of 512 pixels
         if width >= height and width > 512:
@@ -125,7 +157,7 @@ class View(Subject, QMainWindow):
             h = height
 
         # Generate and set a pixmap from the image
-        self.image_area.set_image(self.model.image, w, h)
+        self.image_area.set_image(self.model.image, w, h, rotation, preview)
 
         # Resize the window and pixmap (generated from the image),
         # so as to display correctly the window title, menu bar and image (actually, its pixmap)
@@ -136,29 +168,56 @@ class View(Subject, QMainWindow):
         # (despite having been resized to 512 pixels).
 
         diff = 130  # This value is good for both Windows 10 and Ubuntu 20.04
+        if not self.thumbnail_strip.isHidden():
+            diff += self.thumbnail_strip.height()
         if w < 280:  # Again, this should suffice for both OSs
             self.resize(280, h + diff)
         else:
             self.resize(w, h + diff)
         self.image_area.pixmap.scaled(w, h)
 
-        # Add EXIF data from the model
-        self.exif_area.load_exif()
-
         # Update window title
         self.setWindowTitle('IEViewer - ' + self.model.filename)
 
         # Enable menus
         self.menu_bar.enable_widgets()
 
+    def refresh_image(self):
+        """Displays the image contained in the model again, at the current size and rotation (e.g. once it has been decoded at full resolution), without resizing the window."""
+        self.image_area.set_image(self.model.image, self.image_area.w, self.image_area.h, self.model.get_rotation())
+
+    def set_thumbnails(self, image_paths, file_stats, thumbnails):
+        """Displays the thumbnails of the given images (those of the folder of the opened image) in the thumbnail strip (see ThumbnailStrip.set_images)."""
+        self.thumbnail_strip.set_images(image_paths, file_stats, thumbnails)
+
+    def select_thumbnail(self, image_path):
+        """Selects the thumbnail of the opened image, and shows the thumbnail strip (unless hidden by the user)."""
+        self.thumbnail_strip.select_image(image_path)
+        self.show_thumbnails()
+
+    def show_thumbnails(self):
+        """Shows the thumbnail strip (if the "Show Thumbnails" action is checked and there are thumbnails to show), or hides it."""
+        if self.menu_bar.menus['view']['showthumbnails'].isChecked() and self.thumbnail_strip.get_image_paths():
+            self.thumbnail_strip.show()
+        else:
+            self.thumbnail_strip.hide()
+
+    def open_thumbnail(self, index):
+        """Only needed to notify observers (i.e. the controller) that they should open the image whose thumbnail has been clicked."""
+        self.selected_image = self.thumbnail_strip.get_image_path(index)
+        self.set_state('open_thumbnail')
+
+    def receive_thumbnails(self, worker, thumbnails):
+        """Receives a batch of thumbnails from the thumbnail worker (in the GUI thread) and notifies observers (i.e. the controller) that they should be cached and displayed."""
+        self.generated_thumbnails = (worker, thumbnails)
+        self.set_state('thumbnails')
+
     def save(self):
-        """Saves the modified image. Uses the stored original image, not the modified version currently displayed in the window."""
-        self.model.set_image(self.model.image.transformed(QTransform().rotate(self.image_area.rot), Qt.SmoothTransformation))
+        """Only needed to notify observers (i.e. the controller) that they should save the modified image (materialized from the original image and the model's edit stack, not from the displayed pixmap)."""
         self.set_state('save')
 
     def saveas(self):
-        """Saves the modified image with another name. Uses the stored original image, not the modified version currently displayed in the window."""
-        self.model.set_image(self.model.image.transformed(QTransform().rotate(self.image_area.rot), Qt.SmoothTransformation))
+        """Only needed to notify observers (i.e. the controller) that they should save the modified image with another name (see save)."""
         self.set_state('saveas')
 
     def eventFilter(self, widget, event):
@@ -166,11 +225,9 @@ class View(Subject, QMainWindow):
 
         # Resize event
         # Or what should happen to the image widget when the user resizes the main window
+        # The image is rescaled from cached pixmaps, quickly while resizing and smoothly once resizing has settled (see ImageWidget.rescale)
         if event.type() == QEvent.Resize and widget is self.image_area and self.image_area.pixmap is not None:
-            self.image_area.setPixmap(QPixmap.fromImage(self.model.modified_image).scaled(self.image_area.width(), self.image_area.height(), aspectRatioMode=Qt.KeepAspectRatio, transformMode=Qt.SmoothTransformation))
-            # Update new dimensions for later use
-            self.image_area.w = self.image_area.width()
-            self.image_area.h = self.image_area.height()
+            self.image_area.rescale(self.image_area.width(), self.image_area.height())  # Also updates the new dimensions for later use
             return True
 
         return QMainWindow.eventFilter(self, widget, event)
@@ -179,17 +236,18 @@ class View(Subject, QMainWindow):
         """Closes an image."""
         self.set_state('close')
 
-        # Clear image area widget and adjust layout
+        # Clear image area and EXIF area widgets (the layout is kept)
         self.image_area.clear_image()
-        self.exif_area = ExifWidget(self)
-        self.setCentralWidget(Layout(self).central_widget)
+        self.exif_area.clear_exif()
 
         # Disable unavailable menus
         self.menu_bar.disable_widgets()
 
         # Hide EXIF area (if visible) and show blank image widget
+        # The thumbnail strip keeps showing the folder of the closed image, so that its images can still be opened
         self.exif_area.hide()
         self.image_area.show()
+        self.thumbnail_strip.select_image(None)
 
         # Update window title
         self.setWindowTitle('IEViewer')
@@ -203,10 +261,10 @@ class View(Subject, QMainWindow):
 
         Subsequent rotation functions are only needed as hooks for menu actions; actual rotations happen here.
         Here, the View directly changes the Model. Arguably, this is a violation of the MVC pattern. It happens that, for some reason, returning a reference to the rotated image to the Controller in order to have the Controller itself change the Model does not work, probably because it only returns a reference and not a copy of the rotated image. PyQt5 does not allow deep copies of its objects, so the following seems to be the only way to make it work.
+        Rotations are lazy: they are only added to the model's edit stack (which composes them), and only the displayed pixmap is rotated; the full resolution image is rotated only when saved.
         """
-        self.model.set_modified_image(self.model.image.transformed(QTransform().rotate(self.image_area.rot+degree), Qt.SmoothTransformation))  # Rotate image
-        self.image_area.set_image(self.model.modified_image, self.image_area.w, self.image_area.h)  # Display rotated image
-        self.image_area.rot += degree  # Update rotation history
+        self.model.rotate(degree)  # Update rotation history
+        self.image_area.set_rotation(self.model.get_rotation())  # Display rotated image
 
     def rotate180(self):
         """Rotate the displayed image by 180 degrees."""
@@ -221,12 +279,15 @@ class View(Subject, QMainWindow):
         self.rotate(-90)
 
     def reset_image(self):
-        """Reset the displayed image to its original orientation."""
-        self.rotate(-self.image_area.rot)
+        """Reset the displayed image to its original orientation (i.e. to its EXIF orientation, see ImageModel.reset_edits)."""
+        self.model.reset_edits()
+        self.image_area.set_rotation(self.model.get_rotation())
 
     def show_exif(self):
         """Display EXIF data (and at the same time hide the image)."""
         if self.exif_area.isHidden():
+            if not self.exif_area.loaded:  # EXIF data is only loaded (and processed) when first shown
+                self.exif_area.load_exif()
             self.image_area.hide()
             self.exif_area.show()
         else:
@@ -237,6 +298,34 @@ class View(Subject, QMainWindow):
         """Analyze image to find photo manipulations using an EM algorithm (and at the same time hide the image)."""
         self.set_state('analyze')
 
+    def cancel_analysis(self):
+        """Only needed to notify observers (i.e. the controller) that they should stop the running analysis."""
+        self.set_state('cancel_analysis')
+
+    def set_analysis_running(self, running):
+        """Enables the "Cancel Analysis" action while an analysis is running (and disables it otherwise)."""
+        self.menu_bar.menus['view']['cancelanalysis'].setEnabled(running)
+
+    def receive_analysis_result(self, worker, stride, output_map):
+        """Receives a manipulation map from the analysis worker (in the GUI thread) and notifies observers (i.e. the controller) that it should be displayed."""
+        self.analysis_result = (worker, stride, output_map)
+        self.set_state('analysis_result')
+
+    def receive_analysis_end(self, worker, status, message):
+        """Receives the final status of an analysis from its worker (in the GUI thread) and notifies observers (i.e. the controller)."""
+        self.analysis_end = (worker, status, message)
+        self.set_state('analysis_end')
+
+    def receive_decoded_image(self, worker, pixels):
+        """Receives a full resolution image from the decoding worker (in the GUI thread) and notifies observers (i.e. the controller) that it should replace the preview."""
+        self.decoded_image = (worker, pixels)
+        self.set_state('decoded')
+
+    def receive_prefetched_image(self, worker, decoded):
+        """Receives a neighbouring image from the prefetching worker (in the GUI thread) and notifies observers (i.e. the controller) that it should be cached."""
+        self.prefetched_image = (worker, decoded)
+        self.set_state('prefetched')
+
     def about(self):
         """Display info about the program."""
         self.about.show()
@@ -1,8 +1,23 @@
 import webbrowser
 from collections import OrderedDict
-from PyQt5.QtCore import Qt
+from PyQt5.QtCore import Qt, QTimer, QAbstractTableModel, QAbstractListModel, QModelIndex, QSize
 from PyQt5.QtGui import QPixmap, QIcon
-from PyQt5.QtWidgets import QLabel, QMenu, QMenuBar, QAction, QMessageBox, QSizePolicy, QWidget, QHBoxLayout, QVBoxLayout, QTableWidget, QFrame, QTableWidgetItem, QToolBar, QAbstractItemView, QStatusBar
+from PyQt5.QtWidgets import QLabel, QMenu, QMenuBar, QAction, QMessageBox, QSizePolicy, QWidget, QHBoxLayout, QVBoxLayout, QTableView, QListView, QFrame, QToolBar, QAbstractItemView, QStatusBar
+from model import rotate_image
+from thumbnails import thumbnail_size
+
+
+# Maximum dimension (width or height) of the downsampled level of the image, from which it is displayed (and rescaled) whenever the widget is not larger than it
+preview_size = 2048
+
+# Time (milliseconds) without resize events after which resizing is considered finished, and the image is smoothly rescaled
+rescale_delay = 150
+
+# Maximum length (characters, or bytes for binary data) of EXIF values displayed in the EXIF table (longer values, e.g. MakerNote or XMP data, are truncated unless expanded)
+exif_value_max_length = 256
+
+# Maximum number of thumbnails kept in memory by the thumbnail strip (the others are read again from the thumbnail cache when scrolled back to)
+thumbnail_memory_count = 512
 
 
 class ImageWidget(QLabel):
@@ -12,9 +27,13 @@ class ImageWidget(QLabel):
         view: The view of the MVC pattern.
         image: The original, loaded image, which is used as base for all transformations.
         pixmap: The currently displayed pixmap (built from the original image).
+        source: The full resolution pixmap of the displayed image (converted from the image only once, when first needed, and cached for rescaling).
+        preview: A downsampled level of the image (at most preview_size pixels wide and high, see get_preview_image), used for rescaling whenever the widget is not larger than it.
+        rescale_timer: Single shot timer which smoothly rescales the image once resizing has settled (see rescale).
         w: The current width of the pixmap.
         h: The current width of the pixmap.
-        rot: The current rotation of the displayed pixmap (needed to keep track of all rotations, so as to be able to eventually reset the image).
+        rotation: The current clockwise rotation of the displayed pixmap (degrees), i.e. the total rotation of the model's edit stack.
+                  Only the displayed pixmap is rotated: the cached source and preview pixmaps are never transformed.
     """
 
     def __init__(self, view):
@@ -24,19 +43,28 @@ class ImageWidget(QLabel):
         self.view = view
         self.image = None
         self.pixmap = None
+        self.source = None
+        self.preview = None
         self.w = 0
         self.h = 0
-        self.rot = 0
+        self.rotation = 0
+
+        # Smooth rescaling (once resizing has settled)
+        self.rescale_timer = QTimer(self)
+        self.rescale_timer.setSingleShot(True)
+        self.rescale_timer.setInterval(rescale_delay)
+        self.rescale_timer.timeout.connect(self.smooth_rescale)
 
         # Alignment and resizing
         self.setAlignment(Qt.AlignCenter)
         self.setSizePolicy(QSizePolicy.Ignored, QSizePolicy.Ignored)  # Allow resizing
         self.setScaledContents(False)  # Avoid stretching the image
 
-    def set_image(self, image, width, height):
+    def set_image(self, image, width, height, rotation=0, preview=None):
         """Displays and image by generating a pixmap from it.
 
         Keeping the original image is needed in order to avoid generating an increasingly bad quality pixmap with each transformation.
+        Large images are displayed from their downsampled level: the full resolution pixmap is only converted when the widget is larger than the level (see get_level).
 
         Args:
             image:
@@ -45,35 +73,210 @@ class ImageWidget(QLabel):
                 The width of the displayed image (not its original width).
             height:
                 The height of the displayed image (not its original height).
+            rotation:
+                The clockwise rotation of the displayed image (degrees).
+            preview:
+                The downsampled level of the image (see get_preview_image), if already computed (e.g. by the prefetcher, see worker.py).
         """
+        self.image = image
         self.w = width
         self.h = height
+        self.rotation = rotation
 
         self.installEventFilter(self)  # Install the new event handler
 
-        # Add pixmap from image and resize it accordingly
-        pixmap = QPixmap.fromImage(image).scaled(self.w, self.h, aspectRatioMode=Qt.KeepAspectRatio, transformMode=Qt.SmoothTransformation)
+        # Cache the downsampled level of the image (so that resizing does not convert the image again); the full resolution pixmap is converted when first needed
+        self.rescale_timer.stop()
+        if preview is None:
+            preview = get_preview_image(image)
+        self.preview = QPixmap.fromImage(preview)
+        self.source = None
+
+        # Add pixmap from image and resize (and rotate) it accordingly
+        pixmap = self.get_pixmap(self.get_level(), Qt.SmoothTransformation)
+        self.setPixmap(pixmap)
+        self.pixmap = QPixmap(pixmap)
+
+    def set_rotation(self, rotation):
+        """Rotates the displayed image (only its displayed pixmap, whose size is that of the widget, is transformed)."""
+        self.rotation = rotation
+        self.smooth_rescale()
+
+    def get_pixmap(self, level, transform_mode):
+        """Returns a pixmap of the image scaled from the given level (source or preview) to fit the current dimensions, and then rotated.
+
+        The pixmap is scaled before being rotated, so that only a pixmap of the size of the widget is rotated; rotations by multiples of 90 degrees are lossless (see model.rotate_image).
+        """
+        if self.rotation % 90 != 0:  # Arbitrary rotation: the rotated pixmap is scaled again to fit the widget
+            pixmap = rotate_image(level.scaled(self.w, self.h, aspectRatioMode=Qt.KeepAspectRatio, transformMode=transform_mode), self.rotation)
+            return pixmap.scaled(self.w, self.h, aspectRatioMode=Qt.KeepAspectRatio, transformMode=transform_mode)
+
+        w, h = self.get_unrotated_size()
+
+        return rotate_image(level.scaled(w, h, aspectRatioMode=Qt.KeepAspectRatio, transformMode=transform_mode), self.rotation)
+
+    def get_level(self):
+        """Returns the pixmap from which the image is scaled to the current dimensions: its downsampled level whenever it is large enough, otherwise its full resolution pixmap (converted only once).
+
+        The downsampled level is large enough if the image fits the current dimensions at a scale which is not larger than the level's own.
+        """
+        w, h = self.get_unrotated_size()
+        if w <= self.preview.width() or h <= self.preview.height() or self.preview.size() == self.image.size():
+            return self.preview
+
+        if self.source is None:
+            self.source = QPixmap.fromImage(self.image)
+
+        return self.source
+
+    def get_unrotated_size(self):
+        """Returns the dimensions which the unrotated image has to fit, so that it fits the current dimensions once rotated (by a multiple of 90 degrees)."""
+        if self.rotation % 180 == 90:
+            return self.h, self.w
+        else:
+            return self.w, self.h
+
+    def rescale(self, width, height):
+        """Rescales the displayed image to new dimensions while the widget is being resized.
+
+        Intermediate sizes are displayed using a fast (nearest neighbour) transformation of the downsampled level of the image, whenever it is large enough
+        (otherwise of the full resolution pixmap, see get_level); the image is smoothly rescaled only once resizing has settled, i.e. rescale_delay milliseconds after the last call.
+        """
+        self.w = width
+        self.h = height
+
+        self.setPixmap(self.get_pixmap(self.get_level(), Qt.FastTransformation))
+        self.rescale_timer.start()  # Restarts the timer if already running
+
+    def smooth_rescale(self):
+        """Smoothly rescales the image to the current dimensions (called once resizing has settled, see rescale)."""
+        if self.preview is None:  # The image has been closed in the meantime
+            return
+
+        pixmap = self.get_pixmap(self.get_level(), Qt.SmoothTransformation)
         self.setPixmap(pixmap)
         self.pixmap = QPixmap(pixmap)
 
     def clear_image(self):
         """Reset all the attributes to their original state. Intended to be used for properly closing an image."""
+        self.rescale_timer.stop()
         self.clear()
         self.update()
+        self.image = None
         self.pixmap = None
+        self.source = None
+        self.preview = None
         self.w = 0
         self.h = 0
+        self.rotation = 0
+
+
+def get_preview_image(image):
+    """Returns the downsampled level of an image (QImage) used by ImageWidget for rescaling, i.e. the image smoothly scaled to fit a preview_size x preview_size box (or the image itself, if it already fits).
+
+    Only QImage objects are involved, so this can also be called from worker threads (e.g. the prefetcher, see worker.py).
+    """
+    if image.width() > preview_size or image.height() > preview_size:
+        return image.scaled(preview_size, preview_size, aspectRatioMode=Qt.KeepAspectRatio, transformMode=Qt.SmoothTransformation)
+
+    return image
+
+
+class ExifTableModel(QAbstractTableModel):
+    """Table model holding EXIF data, displayed by the EXIF table (QTableView).
+
+    The table is virtualized: values are formatted only when their rows are first displayed (and then cached), and long values
+    (e.g. MakerNote or XMP data) are truncated to exif_value_max_length, unless expanded by the user (see toggle_expanded).
+
+    Attributes:
+        keys: The EXIF properties (tag names), in display order.
+        values: The EXIF values (not formatted).
+        texts: The formatted values of the rows displayed so far, as (text, truncated) tuples indexed by row.
+        expanded: The rows whose values are displayed in full.
+    """
+
+    headers = ('Property', 'Value')
+
+    def __init__(self, exif_data):
+        """Inits the class."""
+        super().__init__()
+
+        self.keys = list(exif_data)
+        self.values = list(exif_data.values())
+        self.texts = {}
+        self.expanded = set()
+
+    def rowCount(self, parent=QModelIndex()):
+        """Returns the number of rows (EXIF properties)."""
+        return 0 if parent.isValid() else len(self.keys)
+
+    def columnCount(self, parent=QModelIndex()):
+        """Returns the number of columns (property and value)."""
+        return 0 if parent.isValid() else 2
+
+    def data(self, index, role=Qt.DisplayRole):
+        """Returns the data of a cell, formatting its value only when it is first displayed."""
+        if not index.isValid():
+            return None
+
+        if role == Qt.DisplayRole:
+            if index.column() == 0:
+                return str(self.keys[index.row()])
+            return self.get_text(index.row())[0]
+        elif role == Qt.ToolTipRole and index.column() == 1:
+            if self.get_text(index.row())[1]:
+                return 'Double click to show the whole value.'
+            elif index.row() in self.expanded:
+                return 'Double click to truncate the value.'
+
+        return None
+
+    def headerData(self, section, orientation, role=Qt.DisplayRole):
+        """Returns the header labels."""
+        if role == Qt.DisplayRole and orientation == Qt.Horizontal:
+            return self.headers[section]
+
+        return None
+
+    def get_text(self, row):
+        """Returns the formatted value of a row, and whether it has been truncated."""
+        if row not in self.texts:
+            max_length = None if row in self.expanded else exif_value_max_length
+            self.texts[row] = format_exif_value(self.values[row], max_length)
+
+        return self.texts[row]
+
+    def toggle_expanded(self, row):
+        """Displays the whole value of a row, if truncated (or truncates it again, if expanded)."""
+        if row in self.expanded:
+            self.expanded.remove(row)
+        elif self.get_text(row)[1]:
+            self.expanded.add(row)
+        else:  # Short value
+            return
+
+        self.texts.pop(row)
+        self.dataChanged.emit(self.index(row, 1), self.index(row, 1))
+
+    def get_link(self, row):
+        """Returns the value of a row if it is a link (e.g. the GPS location), None otherwise."""
+        value = self.values[row]
+        if isinstance(value, str) and value.startswith('http'):
+            return value
+
+        return None
 
 
 class ExifWidget(QFrame):
     """QWidget for visualizing EXIF data.
 
-    It combines a QTabletWidget into a QFrame.
+    It combines a QTableView (backed by an ExifTableModel) into a QFrame.
 
     Attributes:
         view: The view of the MVC pattern.
         exif_data: The EXIF data of the view as a dictionary.
-        exif_table: The QTableWidget object containing the EXIF data.
+        exif_table: The QTableView object containing the EXIF data.
+        loaded: Whether the EXIF data has been loaded (EXIF data is only loaded when first shown).
     """
 
     def __init__(self, view):
@@ -83,64 +286,241 @@ class ExifWidget(QFrame):
         self.view = view
         self.exif_data = None
         self.exif_table = None
+        self.loaded = False
+
+        self.set_layout()
 
     def load_exif(self):
-        """Loads the image's EXIF data.
+        """Loads the image's EXIF data (processing it, if not done yet, see ImageModel.exif_data).
 
-        Data is either stored into a QTableWidget if it exists,
+        Data is either stored into a QTableView if it exists,
         otherwise a QLabel saying that no EXIF data exists is displayed instead."""
         self.exif_data = self.view.model.exif_data
 
         if self.exif_data is not None:  # EXIF data exists
             self.get_table()
-            self.exif_table.resizeColumnsToContents()  # Resize table cells to fit their contents for better legibility
+            self.exif_table.resizeColumnToContents(0)  # Resize property names to fit their contents for better legibility (values use the remaining space)
         else:  # No EXIF data available
             self.exif_table = QLabel()
             self.exif_table.setText('No EXIF data available for this image.')
             self.exif_table.setAlignment(Qt.AlignCenter)
 
-        self.set_layout()  # Set the resulting QFrame layout
+        self.layout().addWidget(self.exif_table)  # Add the result to the QFrame layout
+        self.loaded = True
 
-    def get_table(self):
-        """Initializes the exif_table attribute of the widget with a QTableWidget object."""
-        self.exif_table = QTableWidget()
+    def clear_exif(self):
+        """Removes the loaded EXIF data (if any), so that the EXIF data of the next opened image is loaded when first shown. Intended to be used for properly closing an image.
+
+        The widget itself (along with its layout) is kept, so that the layout of the whole interface does not need to be created again.
+        """
+        if self.exif_table is not None:
+            self.layout().removeWidget(self.exif_table)
+            self.exif_table.deleteLater()
 
-        # Row and column number definition
-        self.exif_table.setRowCount(len(self.exif_data))
-        self.exif_table.setColumnCount(2)
+        self.exif_data = None
+        self.exif_table = None
+        self.loaded = False
+
+    def get_table(self):
+        """Initializes the exif_table attribute of the widget with a QTableView object."""
+        self.exif_table = QTableView()
+        self.exif_table.setModel(ExifTableModel(self.exif_data))
 
         # Graphic properties
-        self.exif_table.setHorizontalHeaderLabels(('Property', 'Value'))  # Set header labels
         self.exif_table.verticalHeader().setVisible(False)  # Hide rows' header (unneeded)
+        self.exif_table.horizontalHeader().setStretchLastSection(True)  # Values use all the remaining width
+        self.exif_table.setWordWrap(False)  # One line per row (so that rows do not need to be measured)
         self.exif_table.setVerticalScrollMode(QAbstractItemView.ScrollPerPixel)  # Smooth vertical scrolling
         self.exif_table.setHorizontalScrollMode(QAbstractItemView.ScrollPerPixel)  # Smooth horizontal scrolling
 
         # User should not be able to edit table cell values
-        self.exif_table.setEditTriggers(QTableWidget.NoEditTriggers)
+        self.exif_table.setEditTriggers(QAbstractItemView.NoEditTriggers)
 
-        # Populate table with EXIF data
-        i = 0
-        for key in self.exif_data:
-            self.exif_table.setItem(i, 0, QTableWidgetItem(key))
-            self.exif_table.setItem(i, 1, QTableWidgetItem(str(self.exif_data[key])))
-            if 'http' in self.exif_table.item(i, 1).text():  # Status bar description for clickable links
-                self.exif_table.setStatusTip('Double click on the GPS location link to open a map centered at those GPS coordinates.')
-            i += 1
+        # Status bar description for clickable links
+        if 'GPSLocation' in self.exif_data:
+            self.exif_table.setStatusTip('Double click on the GPS location link to open a map centered at those GPS coordinates.')
 
-        # Connects double clicking on the GPS location link to the browser.
-        self.exif_table.itemDoubleClicked.connect(self.open_link)
+        # Connects double clicking on the GPS location link to the browser (and on long values to their expansion).
+        self.exif_table.doubleClicked.connect(self.open_link)
 
     def set_layout(self):
-        """Sets the widget layout."""
+        """Sets the widget layout (the EXIF data is added to it when loaded)."""
         layout = QVBoxLayout()
-        layout.addWidget(self.exif_table)
 
         self.setLayout(layout)
 
-    def open_link(self, item):
-        """Connects double clicking on the GPS location link to the browser."""
-        if 'http' in item.text():
-            webbrowser.open(item.text())
+    def open_link(self, index):
+        """Connects double clicking on the GPS location link to the browser; double clicking on other values expands (or truncates) them."""
+        link = self.exif_table.model().get_link(index.row())
+
+        if link is not None:
+            webbrowser.open(link)
+        else:
+            self.exif_table.model().toggle_expanded(index.row())
+
+
+def format_exif_value(value, max_length=None):
+    """Formats an EXIF value as text, truncated to max_length characters (or bytes, for binary data) if given.
+
+    Returns the text and whether it has been truncated. Binary data is truncated before being formatted, so that large values are never formatted whole.
+    """
+    if isinstance(value, bytes):
+        if max_length is not None and len(value) > max_length:
+            return '{}... ({} bytes)'.format(value[:max_length], len(value)), True
+        return str(value), False
+
+    text = str(value)
+    if max_length is not None and len(text) > max_length:
+        return '{}... ({} characters)'.format(text[:max_length], len(text)), True
+
+    return text, False
+
+
+class ThumbnailListModel(QAbstractListModel):
+    """List model holding the thumbnails of the images of a folder, displayed by the thumbnail strip (QListView).
+
+    The list is virtualized: thumbnails are only read from the thumbnail cache (see thumbnails.py) when their rows are displayed,
+    and only the thumbnail_memory_count most recently displayed ones are kept in memory.
+
+    Attributes:
+        image_paths: The paths of the images, in display order.
+        file_stats: The file stats of the images (see imagecache.get_file_stat), which their cached thumbnails must match.
+        rows: The rows of the images, indexed by path.
+        thumbnails: The thumbnail cache.
+        pixmaps: The thumbnails kept in memory, indexed by row, from the least to the most recently displayed.
+    """
+
+    def __init__(self):
+        """Inits the class."""
+        super().__init__()
+
+        self.image_paths = []
+        self.file_stats = []
+        self.rows = {}
+        self.thumbnails = None
+        self.pixmaps = OrderedDict()
+
+    def set_images(self, image_paths, file_stats, thumbnails):
+        """Replaces the displayed images."""
+        self.beginResetModel()
+
+        self.image_paths = image_paths
+        self.file_stats = file_stats
+        self.rows = {p: i for i, p in enumerate(image_paths)}
+        self.thumbnails = thumbnails
+        self.pixmaps = OrderedDict()
+
+        self.endResetModel()
+
+    def rowCount(self, parent=QModelIndex()):
+        """Returns the number of rows (images)."""
+        return 0 if parent.isValid() else len(self.image_paths)
+
+    def data(self, index, role=Qt.DisplayRole):
+        """Returns the thumbnail (reading it only when it is first displayed), file name or size of an image."""
+        if not index.isValid():
+            return None
+
+        if role == Qt.DecorationRole:
+            return self.get_pixmap(index.row())
+        elif role == Qt.ToolTipRole:
+            return self.image_paths[index.row()].split('/')[-1]
+        elif role == Qt.SizeHintRole:
+            return QSize(thumbnail_size + 8, thumbnail_size + 8)
+
+        return None
+
+    def get_pixmap(self, row):
+        """Returns the thumbnail of an image, or None if it has not been made yet (or the image is invalid)."""
+        pixmap = self.pixmaps.get(row)
+
+        if pixmap is not None:
+            self.pixmaps.move_to_end(row)
+            return pixmap
+
+        data = self.thumbnails.get(self.image_paths[row], self.file_stats[row])
+        if not data:
+            return None
+
+        pixmap = QPixmap()
+        pixmap.loadFromData(data, 'JPEG')
+
+        self.pixmaps[row] = pixmap
+        if len(self.pixmaps) > thumbnail_memory_count:
+            self.pixmaps.popitem(last=False)
+
+        return pixmap
+
+    def update_thumbnails(self, image_paths):
+        """Displays the thumbnails of the given images again (e.g. once they have been made)."""
+        for image_path in image_paths:
+            row = self.rows.get(image_path)
+            if row is not None:
+                self.pixmaps.pop(row, None)
+                self.dataChanged.emit(self.index(row), self.index(row), [Qt.DecorationRole])
+
+
+class ThumbnailStrip(QListView):
+    """QWidget for visualizing the thumbnails of the images in the folder of the opened image, as a horizontal strip below it.
+
+    Clicking on a thumbnail opens its image.
+
+    Attributes:
+        view: The view of the MVC pattern.
+        thumbnail_model: The list model holding the thumbnails (see ThumbnailListModel).
+    """
+
+    def __init__(self, view):
+        """Inits the class."""
+        super().__init__()
+
+        self.view = view
+        self.thumbnail_model = ThumbnailListModel()
+        self.setModel(self.thumbnail_model)
+
+        # Graphic properties
+        self.setViewMode(QListView.IconMode)
+        self.setFlow(QListView.LeftToRight)  # A single row of thumbnails
+        self.setWrapping(False)
+        self.setMovement(QListView.Static)  # Thumbnails cannot be dragged around
+        self.setIconSize(QSize(thumbnail_size, thumbnail_size))
+        self.setUniformItemSizes(True)  # All thumbnails have the same size, so that only the displayed ones are queried
+        self.setHorizontalScrollMode(QAbstractItemView.ScrollPerPixel)  # Smooth scrolling
+        self.setSelectionMode(QAbstractItemView.SingleSelection)
+        self.setEditTriggers(QAbstractItemView.NoEditTriggers)
+        self.setFixedHeight(thumbnail_size + 32)  # Thumbnails and horizontal scroll bar
+        self.setStatusTip('Click on a thumbnail to open its image.')
+
+        # Clicking on a thumbnail opens its image
+        self.clicked.connect(self.view.open_thumbnail)
+
+    def set_images(self, image_paths, file_stats, thumbnails):
+        """Displays the thumbnails of the given images, read from the thumbnail cache (see ThumbnailListModel)."""
+        self.thumbnail_model.set_images(image_paths, file_stats, thumbnails)
+
+    def get_image_paths(self):
+        """Returns the paths of the displayed images."""
+        return self.thumbnail_model.image_paths
+
+    def get_image_path(self, index):
+        """Returns the path of the image of a thumbnail."""
+        return self.thumbnail_model.image_paths[index.row()]
+
+    def select_image(self, image_path):
+        """Selects the thumbnail of an image, scrolling the strip to it (or clears the selection, if the image is not displayed)."""
+        row = self.thumbnail_model.rows.get(image_path)
+
+        if row is None:
+            self.clearSelection()
+            return
+
+        index = self.thumbnail_model.index(row)
+        self.setCurrentIndex(index)
+        self.scrollTo(index, QAbstractItemView.PositionAtCenter)
+
+    def update_thumbnails(self, image_paths):
+        """Displays the thumbnails of the given images again (e.g. once they have been made)."""
+        self.thumbnail_model.update_thumbnails(image_paths)
 
 
 class StatusBar(QStatusBar):
@@ -183,7 +563,9 @@ class MenuBar(QMenuBar):
         self.setMaximumHeight(25)
 
         self.disabled_menus = ['edit', 'view']
-        self.disabled_actions = [('file', 'save'),
+        self.disabled_actions = [('file', 'previousimage'),
+                                 ('file', 'nextimage'),
+                                 ('file', 'save'),
                                  ('file', 'saveas'),
                                  ('file', 'close'),
                                  ('edit', 'ir_submenu_'),
@@ -226,6 +608,18 @@ class MenuBar(QMenuBar):
         self.menus['file']['open'].setIcon(QIcon('icons/open.png'))
         self.menus['file']['open'].triggered.connect(self.view.open)
 
+        # Previous image
+        self.menus['file']['previousimage'] = QAction('&Previous Image', self.view)
+        self.menus['file']['previousimage'].setShortcut('Alt+Left')
+        self.menus['file']['previousimage'].setStatusTip('Open the previous image in the folder.')
+        self.menus['file']['previousimage'].triggered.connect(self.view.previous_image)
+
+        # Next image
+        self.menus['file']['nextimage'] = QAction('&Next Image', self.view)
+        self.menus['file']['nextimage'].setShortcut('Alt+Right')
+        self.menus['file']['nextimage'].setStatusTip('Open the next image in the folder.')
+        self.menus['file']['nextimage'].triggered.connect(self.view.next_image)
+
         # Separator
         self.menus['file']['sep_1'] = QAction(self.view)
         self.menus['file']['sep_1'].setSeparator(True)
@@ -307,6 +701,14 @@ class MenuBar(QMenuBar):
         self.menus['view']['showexif'].setCheckable(True)
         self.menus['view']['showexif'].triggered.connect(self.view.show_exif)
 
+        # Show thumbnails
+        self.menus['view']['showthumbnails'] = QAction('Show &Thumbnails', self.view)
+        self.menus['view']['showthumbnails'].setShortcut('Ctrl+T')
+        self.menus['view']['showthumbnails'].setStatusTip('Show the thumbnails of the images in the folder of the current image.')
+        self.menus['view']['showthumbnails'].setCheckable(True)
+        self.menus['view']['showthumbnails'].setChecked(True)
+        self.menus['view']['showthumbnails'].triggered.connect(self.view.show_thumbnails)
+
         # Analyze
         self.menus['view']['analyze'] = QAction('Analyze', self.view)
         self.menus['view']['analyze'].setShortcut('Ctrl+A')
@@ -315,6 +717,14 @@ class MenuBar(QMenuBar):
         self.menus['view']['analyze'].setCheckable(True)
         self.menus['view']['analyze'].triggered.connect(self.view.analyze)
 
+        # Cancel Analysis (only enabled while an analysis is running)
+        self.menus['view']['cancelanalysis'] = QAction('&Cancel Analysis', self.view)
+        self.menus['view']['cancelanalysis'].setShortcut('Esc')
+        self.menus['view']['cancelanalysis'].setStatusTip('Stop the running analysis.')
+        self.menus['view']['cancelanalysis'].setIcon(QIcon('icons/close.png'))
+        self.menus['view']['cancelanalysis'].setEnabled(False)
+        self.menus['view']['cancelanalysis'].triggered.connect(self.view.cancel_analysis)
+
         # About
         self.menus['help']['about'] = QAction('&About', self.view)
         self.menus['help']['about'].setShortcut('F1')
@@ -395,7 +805,7 @@ class ToolBar(QToolBar):
 
         self.view = view
         self.actions = OrderedDict()
-        self.excluded_actions = ['sep_2', 'sep_3', 'exit']
+        self.excluded_actions = ['previousimage', 'nextimage', 'sep_2', 'sep_3', 'exit', 'showthumbnails', 'cancelanalysis']
 
         self.get_actions()
         self.add_actions()
@@ -477,6 +887,7 @@ class Layout(QVBoxLayout):
         # Complete layout
         self.addLayout(toolbars_layout)
         self.addLayout(image_exif_layout)
+        self.addWidget(self.view.thumbnail_strip)
         self.addWidget(self.view.status_bar)
 
     def get_central_widget(self):
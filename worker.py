@@ -0,0 +1,237 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from PyQt5.QtCore import QThread, pyqtSignal
+from analyze import main_progressive
+from model import get_pixels, get_qimage, read_image
+from report import AnalysisReport
+from thumbnails import make_thumbnail
+from widgets import get_preview_image
+
+
+# Status bar descriptions of the analysis stages (see analyze.main_progressive)
+stage_descriptions = {'load_image': 'loading image',
+                      'luminance': 'extracting luminance',
+                      'mfr': 'computing median filter residual',
+                      'get_average_window_blocks': 'averaging window blocks',
+                      'expectation_maximization': 'running EM algorithm',
+                      'get_output_map': 'computing manipulation map'}
+
+# Number of thumbnails made at once by the thumbnail worker's thread pool, and sent to the GUI thread together (see ThumbnailWorker)
+thumbnail_batch_size = 16
+
+
+class AnalysisCancelled(Exception):
+    """Raised in the analysis thread when the user cancels the analysis."""
+    pass
+
+
+class ProgressReport(AnalysisReport):
+    """Analysis report (see report.py) which forwards the progress of an analysis to its worker, and stops the analysis if it has been cancelled.
+
+    Attributes:
+        worker: The worker running the analysis.
+    """
+    def __init__(self, worker):
+        """Inits the class."""
+        super().__init__()
+
+        self.worker = worker
+
+    def on_stage(self, name):
+        """Notifies the worker of a new stage (unless the analysis has been cancelled)."""
+        self.worker.check_cancelled()
+
+        self.worker.progress.emit(self.worker.get_progress_message(stage_descriptions.get(name, name)))
+
+    def on_iteration(self, diff):
+        """Notifies the worker of the end of an EM iteration (unless the analysis has been cancelled, which stops the EM algorithm at the iteration boundary)."""
+        self.worker.check_cancelled()
+
+        message = 'running EM algorithm, iteration {}'.format(self.iterations)
+        if diff is not None:
+            message += ' (template change {:.4f})'.format(diff)
+
+        self.worker.progress.emit(self.worker.get_progress_message(message))
+
+
+class AnalysisWorker(QThread):
+    """Thread running a progressive manipulation analysis (see analyze.main_progressive) in the background, so that the GUI stays responsive.
+
+    Progress messages and results are sent to the GUI thread through Qt signals: each signal carries the worker itself, so that results of
+    analyses which have been replaced by newer ones can be told apart and ignored.
+
+    Attributes:
+        image_path: The path of the analyzed image.
+        img: The decoded pixels of the analyzed image (NumPy array), if already decoded for display (otherwise the image is read from image_path).
+        rgb: Whether img is in RGB channel order (instead of OpenCV's BGR).
+        cache: The on-disk cache of manipulation maps (see cache.py).
+        templates: The library of EM templates (see templates.py).
+        camera: The camera (make, model) of the image.
+        cancel_event: Set when the analysis has been cancelled.
+        passes: The number of output maps produced so far.
+        progress: Signal carrying a progress message (str).
+        result: Signal carrying the worker, the stride and the output map of each pass (in order of increasing resolution).
+        ended: Signal carrying the worker, the final status of the analysis ('done', 'cancelled' or 'failed') and an error message (if failed).
+    """
+    progress = pyqtSignal(str)
+    result = pyqtSignal(object, int, object)
+    ended = pyqtSignal(object, str, str)
+
+    def __init__(self, image_path, img=None, rgb=False, cache=None, templates=None, camera=None):
+        """Inits the class."""
+        super().__init__()
+
+        self.image_path = image_path
+        self.img = img
+        self.rgb = rgb
+        self.cache = cache
+        self.templates = templates
+        self.camera = camera
+        self.cancel_event = threading.Event()
+        self.passes = 0
+
+    def run(self):
+        """Runs the analysis (in the worker thread)."""
+        try:
+            for stride, output_map in main_progressive(self.image_path, img=self.img, rgb=self.rgb, cache=self.cache, templates=self.templates, camera=self.camera, report=ProgressReport(self)):
+                self.passes += 1
+                self.result.emit(self, stride, output_map)
+        except AnalysisCancelled:
+            self.ended.emit(self, 'cancelled', '')
+        except Exception as e:
+            self.ended.emit(self, 'failed', str(e))
+        else:
+            self.ended.emit(self, 'done', '')
+
+    def cancel(self):
+        """Requests the analysis to stop at the next stage or EM iteration boundary (can be called from any thread)."""
+        self.cancel_event.set()
+
+    def check_cancelled(self):
+        """Raises AnalysisCancelled if the analysis has been cancelled (called in the worker thread)."""
+        if self.cancel_event.is_set():
+            raise AnalysisCancelled()
+
+    def get_progress_message(self, message):
+        """Returns a status bar message for the current step of the analysis."""
+        if self.passes == 0:
+            return 'Analyzing image (preview): ' + message + '...'
+        else:
+            return 'Analyzing image (full resolution): ' + message + '...'
+
+
+class DecodeWorker(QThread):
+    """Thread decoding an image at full resolution in the background, while a reduced resolution preview of it is displayed (see ImageModel.load_image).
+
+    The decoded pixels are sent to the GUI thread through a Qt signal carrying the worker itself (as for AnalysisWorker), and are also kept by the worker,
+    so that they can be retrieved without waiting for the signal if they are needed immediately (e.g. to analyze the image).
+
+    Attributes:
+        image_path: The path of the decoded image.
+        pixels: The decoded pixels (NumPy array, see model.get_pixels), None until decoded (or if decoding failed).
+        cancelled: Set when the decoded image is no longer needed; decoding itself cannot be interrupted, but its result is not sent.
+        decoded: Signal carrying the worker and the decoded pixels (None if decoding failed).
+    """
+    decoded = pyqtSignal(object, object)
+
+    def __init__(self, image_path):
+        """Inits the class."""
+        super().__init__()
+
+        self.image_path = image_path
+        self.pixels = None
+        self.cancelled = False
+
+    def run(self):
+        """Decodes the image (in the worker thread)."""
+        try:
+            self.pixels = get_pixels(Image.open(self.image_path))
+        except Exception:  # Invalid or truncated file: the preview is kept
+            self.pixels = None
+
+        if not self.cancelled:
+            self.decoded.emit(self, self.pixels)
+
+    def cancel(self):
+        """Discards the decoded image (can be called from any thread)."""
+        self.cancelled = True
+
+
+class PrefetchWorker(QThread):
+    """Thread decoding the images which are likely to be opened next (i.e. the neighbours of the opened image in its folder) in the background, so that they can be displayed instantly.
+
+    Each image is decoded at full resolution, its EXIF data is processed and its downsampled level for display is computed (see model.read_image and widgets.get_preview_image).
+    Decoded images are sent to the GUI thread (which caches them, see imagecache.py) through a Qt signal carrying the worker itself (as for AnalysisWorker).
+
+    Attributes:
+        image_paths: The paths of the images to decode, in order of priority.
+        cancelled: Set when the decoded images are no longer needed; the image being decoded is not interrupted, but no other image is decoded (nor sent) afterwards.
+        prefetched: Signal carrying the worker and a decoded image (imagecache.DecodedImage).
+    """
+    prefetched = pyqtSignal(object, object)
+
+    def __init__(self, image_paths):
+        """Inits the class."""
+        super().__init__()
+
+        self.image_paths = image_paths
+        self.cancelled = False
+
+    def run(self):
+        """Decodes the images (in the worker thread), skipping invalid ones."""
+        for image_path in self.image_paths:
+            if self.cancelled:
+                return
+
+            try:
+                decoded = read_image(image_path)
+                decoded.preview = get_preview_image(get_qimage(decoded.pixels))
+            except Exception:  # Invalid file: an error is shown if the user opens it
+                continue
+
+            if not self.cancelled:
+                self.prefetched.emit(self, decoded)
+
+    def cancel(self):
+        """Stops decoding images (can be called from any thread)."""
+        self.cancelled = True
+
+
+class ThumbnailWorker(QThread):
+    """Thread making the thumbnails of the images of a folder in the background (see thumbnails.make_thumbnail), using a pool of threads.
+
+    Thumbnails are sent to the GUI thread (which caches them, see thumbnails.py) in batches, through a Qt signal carrying the worker itself (as for AnalysisWorker).
+
+    Attributes:
+        images: The images whose thumbnails are made, as (path, file stat) tuples in order of priority.
+        workers: The number of threads making thumbnails.
+        cancelled: Set when the thumbnails are no longer needed; the current batch is not interrupted, but no other batch is made (nor sent) afterwards.
+        generated: Signal carrying the worker and a batch of thumbnails, as a list of (path, file stat, JPEG data) tuples.
+    """
+    generated = pyqtSignal(object, object)
+
+    def __init__(self, images, workers=None):
+        """Inits the class."""
+        super().__init__()
+
+        self.images = images
+        self.workers = workers
+        self.cancelled = False
+
+    def run(self):
+        """Makes the thumbnails (in the worker thread)."""
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for i in range(0, len(self.images), thumbnail_batch_size):
+                if self.cancelled:
+                    return
+
+                batch = self.images[i:i + thumbnail_batch_size]
+                thumbnails = list(executor.map(make_thumbnail, [path for path, file_stat in batch]))
+
+                if not self.cancelled:
+                    self.generated.emit(self, [(path, file_stat, data) for (path, file_stat), data in zip(batch, thumbnails)])
+
+    def cancel(self):
+        """Stops making thumbnails (can be called from any thread)."""
+        self.cancelled = True